@@ -88,6 +88,7 @@ install -m 0644 release/%{name}-%{version}/zabbix/templates/* $RPM_BUILD_ROOT/va
 #========NAGIOS========
 install -m 0755 -d $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
 install -m 0755 release/%{name}-%{version}/nagios/bin/pmp-* $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
+install -m 0644 release/%{name}-%{version}/nagios/bin/pmp_*.py $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
 #======================
 
 #========CACTI=========
@@ -26,6 +26,7 @@ and are delivered in the form of templates, plugins, and scripts.
 %install
 install -m 0755 -d $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
 install -m 0755 nagios/bin/pmp-* $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
+install -m 0644 nagios/bin/pmp_*.py $RPM_BUILD_ROOT%{_libdir}/nagios/plugins
 # exit 0 disables running helpers which generates *.pyc, *.pyo files.
 exit 0
 
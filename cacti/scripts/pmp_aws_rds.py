@@ -0,0 +1,1209 @@
+"""Helpers shared by the Amazon RDS Nagios plugin and Cacti script.
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+
+Copyright 2014-2015 Percona LLC and/or its affiliates
+"""
+
+import calendar
+import datetime
+import errno
+import fcntl
+import json
+import math
+import os
+import random
+import re
+import stat
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+import boto
+import boto.connection
+import boto.rds
+import boto.ec2.cloudwatch
+import boto.logs
+import boto.logs.exceptions
+
+# Where the pollers keep state between runs, one directory per user so nobody
+# else can plant or read the files
+STATUS_DIR = '/tmp/pmp-aws-rds-%d' % os.getuid()
+
+# Upper bound of concurrent API calls when probing regions
+REGION_THREADS = 8
+
+# CloudWatch requests per second per region allowed to all the pollers on the
+# host together, they hit the same per account quota.
+CW_RATE = 20
+
+# Retries of throttled requests, the delay before each one is picked at random
+# up to an exponentially growing cap (in seconds).
+CW_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Errors of the calls the credentials are not allowed to make
+ACCESS_DENIED_ERRORS = ('AccessDenied', 'AccessDeniedException', 'UnauthorizedOperation')
+
+# Metric queries sent in one GetMetricData request at most
+CW_BATCH = 100
+
+ISO_TIME = '%Y-%m-%dT%H:%M:%SZ'
+
+# RDS API version of the Aurora DB cluster calls, boto only knows an older one
+CLUSTER_API_VERSION = '2014-10-31'
+
+# The event table of a region is refreshed at most every EVENTS_INTERVAL
+# seconds, events up to EVENTS_OVERLAP seconds before the last poll are asked
+# for again in case they were published late, and the table is rebuilt from
+# DescribeDBInstances every EVENTS_RESYNC seconds.
+EVENTS_INTERVAL = 60
+EVENTS_OVERLAP = 300
+EVENTS_RESYNC = 3600
+
+# RDS events changing the state of an instance, the first match applies:
+# (event category, text the message contains, state)
+# http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_Events.html
+EVENT_STATES = (
+    ('failover', 'started', 'failover'),
+    ('failover', 'complete', 'available'),
+    ('availability', 'shutdown', 'rebooting'),
+    ('availability', 'restarted', 'available'),
+    ('maintenance', 'complete', 'available'),
+    ('maintenance', 'taking place', 'maintenance'),
+    ('maintenance', 'applying', 'maintenance'),
+    ('low storage', 'exhausted', 'storage-full'),
+    ('failure', '', 'failed'),
+    ('deletion', '', 'deleted'),
+)
+
+# Memory in GB of the DB instance classes as listed on
+# http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.DBInstanceClass.html
+DB_CLASSES = {
+    'db.t1.micro': 0.615,
+    'db.m1.small': 1.7,
+    'db.m1.medium': 3.75,
+    'db.m1.large': 7.5,
+    'db.m1.xlarge': 15,
+    'db.m4.large': 8,
+    'db.m4.xlarge': 16,
+    'db.m4.2xlarge': 32,
+    'db.m4.4xlarge': 64,
+    'db.m4.10xlarge': 160,
+    'db.m4.16xlarge': 256,
+    'db.m5.large': 8,
+    'db.m5.xlarge': 16,
+    'db.m5.2xlarge': 32,
+    'db.m5.4xlarge': 64,
+    'db.m5.12xlarge': 192,
+    'db.m5.24xlarge': 384,
+    'db.r3.large': 15,
+    'db.r3.xlarge': 30.5,
+    'db.r3.2xlarge': 61,
+    'db.r3.4xlarge': 122,
+    'db.r3.8xlarge': 244,
+    'db.r4.large': 15.25,
+    'db.r4.xlarge': 30.5,
+    'db.r4.2xlarge': 61,
+    'db.r4.4xlarge': 122,
+    'db.r4.8xlarge': 244,
+    'db.r4.16xlarge': 488,
+    'db.r5.large': 16,
+    'db.r5.xlarge': 32,
+    'db.r5.2xlarge': 64,
+    'db.r5.4xlarge': 128,
+    'db.r5.12xlarge': 384,
+    'db.r5.24xlarge': 768,
+    'db.t2.micro': 1,
+    'db.t2.small': 2,
+    'db.t2.medium': 4,
+    'db.t2.large': 8,
+    'db.t2.xlarge': 16,
+    'db.t2.2xlarge': 32,
+    'db.m3.medium': 3.75,
+    'db.m3.large': 7.5,
+    'db.m3.xlarge': 15,
+    'db.m3.2xlarge': 30,
+    'db.m2.xlarge': 17.1,
+    'db.m2.2xlarge': 34.2,
+    'db.m2.4xlarge': 68.4,
+    'db.cr1.8xlarge': 244,
+    'db.x1.16xlarge': 976,
+    'db.x1.32xlarge': 1952,
+    'db.x1e.xlarge': 122,
+    'db.x1e.2xlarge': 244,
+    'db.x1e.4xlarge': 488,
+    'db.x1e.8xlarge': 976,
+    'db.x1e.16xlarge': 1952,
+    'db.x1e.32xlarge': 3904,
+}
+
+# Memory in GB of the large size of the instance families, and the factor of
+# the other sizes to it, for the classes not listed above.  Unknown families
+# take the memory of their type, the first letter of the family.
+FAMILY_MEMORY = {
+    'm1': 7.5, 'm2': 8.55, 'm3': 7.5, 'm4': 8, 'm5': 8, 'm5d': 8, 'm6g': 8, 'm6gd': 8, 'm6i': 8, 'm6id': 8,
+    'm7g': 8, 'm7i': 8,
+    'r3': 15.25, 'r4': 15.25, 'r5': 16, 'r5b': 16, 'r5d': 16, 'r6g': 16, 'r6gd': 16, 'r6i': 16, 'r6id': 16,
+    'r7g': 16, 'r7i': 16,
+    't2': 8, 't3': 8, 't4g': 8,
+    'cr1': 15.25, 'x1': 30.5, 'x1e': 61, 'x2g': 32, 'x2idn': 32, 'x2iedn': 64, 'x2iezn': 64, 'z1d': 16,
+}
+TYPE_MEMORY = {'m': 8, 'r': 16, 't': 8, 'x': 32, 'z': 16}
+SIZE_FACTORS = {'micro': 0.125, 'small': 0.25, 'medium': 0.5, 'large': 1}
+
+# Local additions to and corrections of DB_CLASSES, lines of "class = GB"
+CLASSES_FILE = '/etc/pmp-aws-rds-classes.conf'
+
+# Top wait events and SQL digests reported by Performance Insights, and days the
+# SQL text of a digest which was not seen since is kept in the local cache
+PI_TOP = 5
+PI_CACHE_DAYS = 7
+
+# Log group Enhanced Monitoring publishes the OS metrics to, one stream per DB
+# instance named after its resource id, and the hours of them to catch up on
+# after a gap in the polls.
+EM_LOG_GROUP = 'RDSOSMetrics'
+EM_RESUME = 1
+# Seconds behind the current time a page of events may end at without asking
+# for the next one, the coarsest Enhanced Monitoring granularity
+EM_LAG = 60
+EM_PERCENTILE = 95
+
+# Statistics GetMetricStatistics returns, anything else is a percentile like p99
+STATISTICS = ('Average', 'Sum', 'Minimum', 'Maximum', 'SampleCount')
+PERCENTILE = re.compile(r'^p(\d{1,2}(\.\d{1,2})?|100)$')
+
+
+def _noop(val):
+    """Default logger"""
+    pass
+
+
+class StateFile(object):
+
+    """JSON document on disk shared between concurrent pollers.
+
+    Readers take a shared lock, writers an exclusive one, so a Nagios check and
+    a Cacti poll running at the same moment never see a half written file.
+    The directory is private to the user running the pollers and the files
+    are never followed if they are symlinks.
+    """
+
+    def __init__(self, status_dir, name):
+        self.path = os.path.join(status_dir, name)
+        try:
+            os.makedirs(status_dir, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        st = os.lstat(status_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise OSError(errno.EPERM, 'Status directory is not a directory owned by the current user', status_dir)
+
+    def _open(self):
+        return os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600), 'r+')
+
+    @staticmethod
+    def _load(fh):
+        fh.seek(0)
+        try:
+            data = json.loads(fh.read() or '{}')
+        except ValueError:
+            # Corrupted state is not worth failing a poll, start over
+            data = {}
+
+        return data
+
+    def read(self):
+        """Return the stored document"""
+        fh = self._open()
+        try:
+            fcntl.flock(fh, fcntl.LOCK_SH)
+            return self._load(fh)
+        finally:
+            fh.close()
+
+    def update(self, func):
+        """Apply func to the stored document and save it, return func's result"""
+        fh = self._open()
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            data = self._load(fh)
+            result = func(data)
+            fh.seek(0)
+            fh.truncate()
+            fh.write(json.dumps(data, sort_keys=True))
+            fh.flush()
+            return result
+        finally:
+            fh.close()
+
+
+def infer_memory(instance_class):
+    """Memory in GB of a DB instance class from its family and size, None if unknown"""
+    parts = (instance_class or '').split('.')
+    if len(parts) < 3 or parts[0] != 'db' or not parts[1]:
+        return None
+
+    base = FAMILY_MEMORY.get(parts[1]) or TYPE_MEMORY.get(parts[1][0])
+    match = re.match(r'^(\d*)xlarge$', parts[2])
+    if match:
+        factor = 2 * int(match.group(1) or 1)
+    else:
+        factor = SIZE_FACTORS.get(parts[2])
+
+    if not base or not factor:
+        return None
+
+    memory = base * factor
+    # Classes with more memory per vCPU, e.g. db.r5.2xlarge.tpc2.mem4x
+    for extra in parts[3:]:
+        match = re.match(r'^mem(\d+(\.\d+)?)x$', extra)
+        if match:
+            memory *= float(match.group(1))
+
+    return memory
+
+
+class InstanceClasses(object):
+
+    """Memory of the DB instance classes: listed, set in the local file or inferred"""
+
+    def __init__(self, path=CLASSES_FILE, log=_noop):
+        self.memory = dict(DB_CLASSES)
+        self.log = log
+        if path and os.path.exists(path):
+            self.memory.update(self._load(path))
+
+    def _load(self, path):
+        """Classes of the local file, invalid lines are skipped"""
+        classes = {}
+        try:
+            lines = open(path).readlines()
+        except IOError as err:
+            self.log('Unable to read %s: %s' % (path, err))
+            return classes
+
+        for num, line in enumerate(lines):
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+
+            name, _, value = line.partition('=')
+            try:
+                classes[name.strip()] = float(value)
+            except ValueError:
+                self.log('%s:%s: invalid line, expected "class = GB"' % (path, num + 1))
+
+        return classes
+
+    def get(self, instance_class):
+        """Memory of a class in GB, None if it cannot be inferred"""
+        if instance_class not in self.memory:
+            self.memory[instance_class] = infer_memory(instance_class)
+            if self.memory[instance_class]:
+                self.log('Memory of the DB instance class %s inferred: %s GB'
+                         % (instance_class, self.memory[instance_class]))
+
+        return self.memory[instance_class]
+
+
+# Catalogs loaded by this process per local file
+_catalogs = {}
+
+
+def instance_classes(path=CLASSES_FILE, log=_noop):
+    """Catalog of the DB instance classes with the local file at path, loaded once"""
+    if path not in _catalogs:
+        _catalogs[path] = InstanceClasses(path, log)
+
+    return _catalogs[path]
+
+
+class RegionIndex(object):
+
+    """Persisted DB instance identifier to region map used with "--region all"."""
+
+    def __init__(self, status_dir=STATUS_DIR, profile=None):
+        self.state = StateFile(status_dir, 'regions.json')
+        self.profile = profile
+
+    def _key(self, identifier):
+        return '%s/%s' % (self.profile or '', identifier)
+
+    def get(self, identifier):
+        """Return the region an instance was last found in"""
+        return self.state.read().get(self._key(identifier))
+
+    def set(self, identifier, region):
+        """Remember the region of an instance"""
+        self.state.update(lambda data: data.__setitem__(self._key(identifier), region))
+
+    def forget(self, identifier):
+        """Drop a stale entry"""
+        self.state.update(lambda data: data.pop(self._key(identifier), None))
+
+
+class ResourceIds(object):
+
+    """Persisted DB instance identifier to resource id (DbiResourceId) map.
+
+    Performance Insights and Enhanced Monitoring identify an instance by its
+    resource id, it never changes for the life of the instance.
+    """
+
+    def __init__(self, status_dir=STATUS_DIR, profile=None):
+        self.state = StateFile(status_dir, 'resources.json')
+        self.profile = profile
+
+    def get(self, region, identifier, describe):
+        """Return the resource id of an instance, describe() returns it when it is not known"""
+        key = '%s/%s/%s' % (self.profile or '', region, identifier)
+        resource = self.state.read().get(key)
+        if not resource:
+            resource = describe()
+            if resource:
+                self.state.update(lambda data: data.__setitem__(key, resource))
+
+        return resource
+
+
+class ApiStats(object):
+
+    """AWS API usage of the process: calls, retries, throttles, datapoints and seconds per API"""
+
+    FIELDS = ('calls', 'retries', 'throttles', 'datapoints', 'seconds')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apis = {}
+
+    def reset(self):
+        """Start counting over, e.g. for the next poll of a long running process"""
+        with self.lock:
+            self.apis = {}
+
+    def record(self, api, **counts):
+        """Add counts to an API"""
+        with self.lock:
+            entry = self.apis.setdefault(api, dict.fromkeys(self.FIELDS, 0))
+            for key, val in counts.items():
+                entry[key] += val
+
+    def totals(self):
+        """Counts of all the APIs together"""
+        with self.lock:
+            return dict((key, sum(entry[key] for entry in self.apis.values())) for key in self.FIELDS)
+
+    def perfdata(self):
+        """Totals as Nagios perfdata"""
+        return ('api_calls=%(calls)d api_retries=%(retries)d api_throttles=%(throttles)d '
+                'api_datapoints=%(datapoints)d api_time=%(seconds).3fs' % self.totals())
+
+    def log(self, path, **fields):
+        """Append the stats and fields as a JSON line to a file shared by concurrent runs"""
+        with self.lock:
+            apis = dict((api, dict(entry, seconds=round(entry['seconds'], 3))) for (api, entry) in self.apis.items())
+
+        record = self.totals()
+        record.update(fields, time=int(time.time()), apis=apis, seconds=round(record['seconds'], 3))
+        # A single write to a file opened for appending is not interleaved with others
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            os.write(fd, json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            os.close(fd)
+
+
+# API usage of this process
+stats = ApiStats()
+
+
+def timed(api, func, *args, **kwargs):
+    """Call func and count it as a call of api"""
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stats.record(api, calls=1, seconds=time.time() - start)
+
+
+def get_dbinstances(region, profile=None, identifier=None, log=_noop):
+    """Describe DB instances in a region, None on error or when nothing found"""
+    try:
+        rds = boto.rds.connect_to_region(region, profile_name=profile)
+        return timed('DescribeDBInstances', rds.get_all_dbinstances, identifier) or None
+    except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
+        log(msg)
+
+
+def map_regions(func, regions):
+    """Run func for every region concurrently, yield (region, result) as they complete"""
+    pool = ThreadPool(min(REGION_THREADS, len(regions)) or 1)
+    try:
+        for item in pool.imap_unordered(lambda reg: (reg, func(reg)), regions):
+            yield item
+    finally:
+        # Outstanding probes are of no interest once the caller stops iterating
+        pool.terminate()
+
+
+def _connect_clusters(region, profile=None):
+    """RDS connection speaking the API version of the cluster calls"""
+    conn = boto.rds.connect_to_region(region, profile_name=profile)
+    conn.APIVersion = CLUSTER_API_VERSION
+    return conn
+
+
+def describe_cluster(region, profile, identifier, log=_noop):
+    """Describe an Aurora DB cluster, None on error or when not found.
+
+    Returns a dict with id, status, engine, version and members keys, members
+    is the list of dicts with the id and writer flag of the cluster instances.
+    """
+    try:
+        conn = _connect_clusters(region, profile)
+        response = timed('DescribeDBClusters', conn.make_request, 'DescribeDBClusters',
+                         {'DBClusterIdentifier': identifier})
+        body = response.read()
+        if response.status != 200:
+            raise conn.ResponseError(response.status, response.reason, body)
+    except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
+        log(msg)
+        return None
+
+    clusters = _find(ElementTree.fromstring(body), 'DescribeDBClustersResult', 'DBClusters')
+    if not clusters:
+        return None
+
+    return {
+        'id': _text(clusters[0], 'DBClusterIdentifier'),
+        'status': _text(clusters[0], 'Status'),
+        'engine': _text(clusters[0], 'Engine'),
+        'version': _text(clusters[0], 'EngineVersion'),
+        'members': [{'id': _text(member, 'DBInstanceIdentifier'),
+                     'writer': _text(member, 'IsClusterWriter') == 'true'}
+                    for member in _find(clusters[0], 'DBClusterMembers')],
+    }
+
+
+def get_cluster_instances(region, profile, identifier, log=_noop):
+    """Describe all the DB instances of an Aurora DB cluster with one request, None on error"""
+    params = {'Filters.Filter.1.Name': 'db-cluster-id', 'Filters.Filter.1.Values.Value.1': identifier}
+    try:
+        conn = _connect_clusters(region, profile)
+        return timed('DescribeDBInstances', conn.get_list, 'DescribeDBInstances', params,
+                     [('DBInstance', boto.rds.DBInstance)])
+    except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
+        log(msg)
+
+
+def _locate(key, name, describe, regions, profile, status_dir, log):
+    """Find the region of a resource using the index, return (region, description) or (None, None)"""
+    index = RegionIndex(status_dir, profile)
+    region = index.get(key)
+    if region:
+        info = describe(region)
+        if info:
+            return region, info
+
+        log('%s is no longer in %s, rescanning regions' % (name, region))
+        index.forget(key)
+
+    for reg, info in map_regions(describe, regions):
+        if info:
+            index.set(key, reg)
+            return reg, info
+
+    return None, None
+
+
+def locate_instance(identifier, regions, profile=None, status_dir=STATUS_DIR, log=_noop):
+    """Find the region of a DB instance, return (region, instances) or (None, None).
+
+    The index is consulted first, so only the very first lookup of an instance
+    or one that has moved scans the regions, which is done concurrently.
+    """
+    return _locate(identifier, 'Instance "%s"' % identifier,
+                   lambda reg: get_dbinstances(reg, profile, identifier, log), regions, profile, status_dir, log)
+
+
+def locate_cluster(identifier, regions, profile=None, status_dir=STATUS_DIR, log=_noop):
+    """Find the region of an Aurora DB cluster like locate_instance(), return (region, cluster)
+    or (None, None)
+    """
+    # Clusters and instances may share names
+    return _locate('cluster:%s' % identifier, 'Cluster "%s"' % identifier,
+                   lambda reg: describe_cluster(reg, profile, identifier, log), regions, profile, status_dir, log)
+
+
+class Watermarks(object):
+
+    """Timestamp and value of the last datapoint consumed per instance and metric.
+
+    Loaded once per run, changes are merged back into the file by save().
+    """
+
+    def __init__(self, status_dir=STATUS_DIR):
+        self.state = StateFile(status_dir, 'watermarks.json')
+        self.data = None
+        self.changed = {}
+
+    def get(self, key):
+        """Return (timestamp, value) of the last datapoint, (None, None) if unknown"""
+        if self.data is None:
+            self.data = self.state.read()
+
+        stamp, value = self.data.get(key, (None, None))
+        if stamp is not None:
+            stamp = datetime.datetime.utcfromtimestamp(stamp)
+
+        return stamp, value
+
+    def set(self, key, stamp, value):
+        """Remember the last datapoint consumed"""
+        entry = (calendar.timegm(stamp.timetuple()), value)
+        if self.data is not None:
+            self.data[key] = entry
+
+        self.changed[key] = entry
+
+    def save(self):
+        """Write the changes"""
+        if self.changed:
+            self.state.update(lambda data: data.update(self.changed))
+            self.changed = {}
+
+
+def split_statistic(spec, default='Average'):
+    """Split "metric:statistic" into (metric, statistic), the statistic is a percentile like p99"""
+    metric, _, stat = spec.partition(':')
+    if not stat:
+        return metric, default
+    elif not PERCENTILE.match(stat):
+        raise ValueError('Invalid statistic "%s", it should be a percentile like p90 or p99.9' % stat)
+
+    return metric, stat
+
+
+def parse_time(value):
+    """Datetime of an ISO 8601 UTC time as returned by the APIs"""
+    return datetime.datetime.strptime(re.sub(r'(\.\d+)?(Z|\+00:00)?$', 'Z', value), ISO_TIME)
+
+
+def sorted_datapoints(points):
+    """Datapoints sorted by timestamp, duplicates of a timestamp collapsed into the last one"""
+    return sorted(dict((p['Timestamp'], p) for p in points).values(), key=lambda k: k['Timestamp'])
+
+
+def event_state(event):
+    """State an RDS event puts the instance in, None if it does not change it"""
+    category = getattr(event, 'EventCategory', None)
+    message = (event.message or '').lower()
+    for cat, text, state in EVENT_STATES:
+        if category == cat and text in message:
+            return state
+
+    return None
+
+
+class EventStatus(object):
+
+    """State of every DB instance of a region, kept current from RDS events.
+
+    Instead of describing each instance on every check, the table of the whole
+    region is refreshed by one incremental DescribeEvents call per interval.
+    The refresh holds the lock of the state file, so concurrent checks wait
+    for it and use its result rather than calling the API too.
+    """
+
+    def __init__(self, region, profile=None, status_dir=STATUS_DIR, log=_noop):
+        self.state = StateFile(status_dir, 'events.json')
+        self.region = region
+        self.profile = profile
+        self.key = '%s/%s' % (profile or '', region)
+        self.log = log
+
+    def _describe(self, conn):
+        """Current state of all the instances of the region"""
+        instances = {}
+        marker = None
+        while True:
+            result = timed('DescribeDBInstances', conn.get_all_dbinstances, marker=marker)
+            for inst in result:
+                instances[inst.id] = {
+                    'state': inst.status,
+                    'engine': inst.engine,
+                    'version': getattr(inst, 'engine_version', None) or getattr(inst, 'EngineVersion', ''),
+                    'class': inst.instance_class,
+                    'storage': inst.allocated_storage,
+                    'message': None,
+                    # Event times are in whole seconds
+                    'since': int(time.time()),
+                }
+
+            marker = result.marker
+            if not marker:
+                return instances
+
+    def _events(self, conn, start_time):
+        """db-instance events since start_time in the order they happened"""
+        events = []
+        marker = None
+        while True:
+            result = timed('DescribeEvents', conn.get_all_events, start_time=start_time, marker=marker)
+            events.extend(e for e in result if e.source_type == 'db-instance')
+            marker = result.marker
+            if not marker:
+                return sorted(events, key=lambda e: parse_time(e.date))
+
+    def _refresh(self, data, interval):
+        entry = data.setdefault(self.key, {})
+        now = time.time()
+        if entry.get('polled', 0) > now - interval:
+            return entry
+
+        conn = boto.rds.connect_to_region(self.region, profile_name=self.profile)
+        if entry.get('synced', 0) < now - EVENTS_RESYNC:
+            self.log('Describing the DB instances of %s' % self.region)
+            entry['instances'] = self._describe(conn)
+            entry['synced'] = entry['watermark'] = now
+
+        start_time = datetime.datetime.utcfromtimestamp(entry['watermark'] - EVENTS_OVERLAP)
+        for event in self._events(conn, start_time):
+            since = calendar.timegm(parse_time(event.date).timetuple())
+            inst = entry['instances'].setdefault(event.source_identifier,
+                                                 {'state': None, 'engine': None, 'version': None, 'since': 0})
+            state = event_state(event)
+            # Events seen by the previous poll, or older than the state, are no news
+            if since < inst['since']:
+                continue
+
+            self.log('Event of %s: %s' % (event.source_identifier, event.message))
+            inst['message'] = event.message
+            inst['since'] = since
+            if state:
+                inst['state'] = state
+
+        entry['watermark'] = entry['polled'] = now
+        return entry
+
+    def get(self, identifier, interval=EVENTS_INTERVAL):
+        """State of an instance: dict with state, engine, version, message and since keys,
+        None if it is unknown
+        """
+        try:
+            entry = self.state.update(lambda data: self._refresh(data, interval))
+        except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
+            self.log(msg)
+            return None
+
+        return entry.get('instances', {}).get(identifier)
+
+
+class RateLimiter(object):
+
+    """Token bucket shared by all the processes using the same status directory.
+
+    Callers take a token on credit and sleep outside of the lock until it is
+    due, so the bucket is never held while waiting.
+    """
+
+    def __init__(self, status_dir, name, rate, burst=None):
+        self.state = StateFile(status_dir, 'ratelimit.json')
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst or max(rate, 1)
+
+    def _take(self, data):
+        now = time.time()
+        tokens, stamp = data.get(self.name, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+        data[self.name] = (tokens, now)
+        return max(0.0, -tokens / self.rate)
+
+    def acquire(self):
+        """Wait for a token, return the seconds waited"""
+        if self.rate <= 0:
+            return 0.0
+
+        wait = self.state.update(self._take)
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+
+class RateLimitedClient(object):
+
+    """AWS API client rate limited across processes, retrying throttled requests"""
+
+    # Name of the service in the rate limiter and the messages
+    SERVICE = None
+
+    def __init__(self, region, status_dir=STATUS_DIR, rate=CW_RATE, log=_noop):
+        self.limiter = RateLimiter(status_dir, '%s/%s' % (self.SERVICE.lower(), region), rate)
+        self.log = log
+        # Seconds spent waiting for the limiter and backing off
+        self.waited = 0.0
+
+    def call(self, api, func, *args, **kwargs):
+        """Call a connection method honouring the rate limit, count it as a call of api"""
+        attempt = 0
+        while True:
+            self.waited += self.limiter.acquire()
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+                stats.record(api, calls=1, seconds=time.time() - start)
+                return result
+            except boto.exception.BotoServerError as err:
+                throttled = err.error_code in THROTTLING_ERRORS
+                stats.record(api, calls=1, seconds=time.time() - start, throttles=int(throttled))
+                if not throttled or attempt >= CW_RETRIES:
+                    raise
+
+                stats.record(api, retries=1)
+
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                self.log('%s throttled the request, retrying in %.2f sec.' % (self.SERVICE, delay))
+                time.sleep(delay)
+                self.waited += delay
+                attempt += 1
+
+
+class CloudWatch(RateLimitedClient):
+
+    """CloudWatch connection rate limited across processes, retrying throttled requests"""
+
+    SERVICE = 'CloudWatch'
+
+    def __init__(self, region, profile=None, status_dir=STATUS_DIR, rate=CW_RATE, log=_noop):
+        RateLimitedClient.__init__(self, region, status_dir, rate, log)
+        self.conn = boto.ec2.cloudwatch.connect_to_region(region, profile_name=profile)
+        # Whether the credentials are not allowed to call GetMetricData
+        self.denied = False
+
+    def get_metric_statistics(self, *args, **kwargs):
+        """Rate limited get_metric_statistics"""
+        result = self.call('GetMetricStatistics', self.conn.get_metric_statistics, *args, **kwargs)
+        stats.record('GetMetricStatistics', datapoints=len(result))
+        return result
+
+    def _request(self, action, params):
+        """Make a query API request boto has no method for, return the response body"""
+        response = self.conn.make_request(action, params, '/', 'POST')
+        body = response.read()
+        if response.status != 200:
+            raise self.conn.ResponseError(response.status, response.reason, body)
+
+        return body
+
+    def get_metric_data(self, queries, start_time, end_time):
+        """Fetch several metrics at once with GetMetricData.
+
+        queries is a list of dicts with Id, MetricName, Dimensions (a dict),
+        Period and Stat keys, Namespace defaults to AWS/RDS.  Returns a dict
+        of Id to the list of (timestamp, value) sorted by time.
+
+        A single query of a plain statistic goes to GetMetricStatistics, which
+        credentials granted before GetMetricData existed are allowed to call.
+        If the credentials are denied GetMetricData, every query of a plain
+        statistic goes to GetMetricStatistics, one request each, and the
+        percentiles get no datapoints.
+        """
+        if len(queries) == 1 and queries[0]['Stat'] in STATISTICS or self.denied:
+            result = dict((q['Id'], []) for q in queries)
+            for query in queries:
+                if query['Stat'] in STATISTICS:
+                    result[query['Id']] = self._statistics(query, start_time, end_time)
+            return result
+
+        try:
+            return self._metric_data(queries, start_time, end_time)
+        except boto.exception.BotoServerError as err:
+            if err.error_code not in ACCESS_DENIED_ERRORS:
+                raise
+
+            self.log('GetMetricData is not allowed, falling back to GetMetricStatistics: %s' % err.error_message)
+            self.denied = True
+            return self.get_metric_data(queries, start_time, end_time)
+
+    def _statistics(self, query, start_time, end_time):
+        """Datapoints of a query of a plain statistic from GetMetricStatistics"""
+        points = self.get_metric_statistics(
+            query['Period'],
+            start_time,
+            end_time,
+            query['MetricName'],
+            query.get('Namespace', 'AWS/RDS'),
+            query['Stat'],
+            dimensions=dict((k, [v]) for (k, v) in query['Dimensions'].items())
+        )
+        return [(p['Timestamp'], p[query['Stat']]) for p in sorted_datapoints(points)]
+
+    def _metric_data(self, queries, start_time, end_time):
+        """Datapoints of the queries from GetMetricData"""
+        result = dict((q['Id'], []) for q in queries)
+        for chunk in range(0, len(queries), CW_BATCH):
+            params = {'StartTime': start_time.strftime(ISO_TIME),
+                      'EndTime': end_time.strftime(ISO_TIME),
+                      'ScanBy': 'TimestampAscending'}
+            for num, query in enumerate(queries[chunk:chunk + CW_BATCH]):
+                prefix = 'MetricDataQueries.member.%d.' % (num + 1)
+                params[prefix + 'Id'] = query['Id']
+                params[prefix + 'MetricStat.Metric.Namespace'] = query.get('Namespace', 'AWS/RDS')
+                params[prefix + 'MetricStat.Metric.MetricName'] = query['MetricName']
+                for dim, (name, value) in enumerate(sorted(query['Dimensions'].items())):
+                    params[prefix + 'MetricStat.Metric.Dimensions.member.%d.Name' % (dim + 1)] = name
+                    params[prefix + 'MetricStat.Metric.Dimensions.member.%d.Value' % (dim + 1)] = value
+                params[prefix + 'MetricStat.Period'] = query['Period']
+                params[prefix + 'MetricStat.Stat'] = query['Stat']
+
+            while True:
+                tree = ElementTree.fromstring(self.call('GetMetricData', self._request, 'GetMetricData', params))
+                for member in _find(tree, 'GetMetricDataResult', 'MetricDataResults'):
+                    ident = _text(member, 'Id')
+                    stamps = [parse_time(e.text) for e in _find(member, 'Timestamps')]
+                    values = [float(e.text) for e in _find(member, 'Values')]
+                    stats.record('GetMetricData', datapoints=len(values))
+                    result.setdefault(ident, []).extend(zip(stamps, values))
+
+                token = _text(tree, 'GetMetricDataResult', 'NextToken')
+                if not token:
+                    break
+
+                params['NextToken'] = token
+
+        for points in result.values():
+            points.sort()
+
+        return result
+
+
+class PerformanceInsightsConnection(boto.connection.AWSQueryConnection):
+
+    """Performance Insights API connection, boto has no support of it"""
+
+    APIVersion = '2018-02-27'
+    TargetPrefix = 'PerformanceInsightsv20180227'
+    ResponseError = boto.exception.JSONResponseError
+
+    def __init__(self, region, profile=None):
+        self.endpoint = 'pi.%s.amazonaws.com' % region
+        boto.connection.AWSQueryConnection.__init__(self, host=self.endpoint, profile_name=profile)
+
+    def _required_auth_capability(self):
+        return ['hmac-v4']
+
+    def make_request(self, action, params):
+        """Call an action with the params as JSON, return the decoded response"""
+        body = json.dumps(params)
+        headers = {'X-Amz-Target': '%s.%s' % (self.TargetPrefix, action), 'Host': self.endpoint,
+                   'Content-Type': 'application/x-amz-json-1.1', 'Content-Length': str(len(body))}
+        response = self._mexe(self.build_base_http_request('POST', '/', '/', {}, headers, body))
+        body = response.read().decode('utf-8')
+        try:
+            result = json.loads(body or '{}')
+        except ValueError:
+            result = {'message': body}
+
+        if response.status != 200:
+            raise self.ResponseError(response.status, response.reason, result)
+
+        return result
+
+
+class PerformanceInsights(RateLimitedClient):
+
+    """Performance Insights DB load of an instance by wait event and SQL digest.
+
+    The SQL text of the digests is cached in pi.json of the status directory,
+    so once it is known a poll takes a single GetResourceMetrics request.
+    """
+
+    SERVICE = 'PI'
+
+    def __init__(self, region, profile=None, status_dir=STATUS_DIR, rate=CW_RATE, log=_noop):
+        RateLimitedClient.__init__(self, region, status_dir, rate, log)
+        self.conn = PerformanceInsightsConnection(region, profile)
+        self.state = StateFile(status_dir, 'pi.json')
+        self.resources = ResourceIds(status_dir, profile)
+        self.region = region
+
+    def resource_id(self, identifier, describe):
+        """DbiResourceId of an instance, describe() returns it when it is not cached"""
+        return self.resources.get(self.region, identifier, describe)
+
+    def top_load(self, resource, start_time, end_time, period=60, limit=PI_TOP, describe=True):
+        """Average DB load in active sessions over the time range, in total and of the top wait
+        events and SQL digests.
+
+        Returns a dict with load, waits, the list of (wait event, load), and
+        sql, the list of (digest id, load, SQL text), the highest load first.
+        The SQL text is None unless describe is set.
+        """
+        params = {
+            'ServiceType': 'RDS',
+            'Identifier': resource,
+            'StartTime': calendar.timegm(start_time.timetuple()),
+            'EndTime': calendar.timegm(end_time.timetuple()),
+            'PeriodInSeconds': period,
+            'MetricQueries': [
+                {'Metric': 'db.load.avg'},
+                {'Metric': 'db.load.avg',
+                 'GroupBy': {'Group': 'db.wait_event', 'Dimensions': ['db.wait_event.name'], 'Limit': limit}},
+                {'Metric': 'db.load.avg',
+                 'GroupBy': {'Group': 'db.sql_tokenized', 'Dimensions': ['db.sql_tokenized.id'], 'Limit': limit}},
+            ],
+        }
+        result = self.call('GetResourceMetrics', self.conn.make_request, 'GetResourceMetrics', params)
+
+        # Periods without a datapoint had no load
+        periods = max(1, int((end_time - start_time).total_seconds()) // period)
+        load = 0.0
+        waits = []
+        digests = []
+        for metric in result.get('MetricList', []):
+            values = [point['Value'] for point in metric.get('DataPoints', []) if point.get('Value') is not None]
+            stats.record('GetResourceMetrics', datapoints=len(values))
+            dimensions = metric.get('Key', {}).get('Dimensions') or {}
+            if 'db.wait_event.name' in dimensions:
+                waits.append((dimensions['db.wait_event.name'], sum(values) / periods))
+            elif 'db.sql_tokenized.id' in dimensions:
+                digests.append((dimensions['db.sql_tokenized.id'], sum(values) / periods))
+            elif not dimensions:
+                load = sum(values) / periods
+
+        texts = self.statements(resource, [digest for (digest, _) in digests], params) if describe else {}
+        return {'load': load,
+                'waits': sorted(waits, key=lambda k: -k[1]),
+                'sql': sorted([(digest, val, texts.get(digest)) for (digest, val) in digests], key=lambda k: -k[1])}
+
+    def statements(self, resource, digests, params):
+        """SQL text of the digests, from the cache or described by one DescribeDimensionKeys request"""
+        now = time.time()
+        cache = self.state.read().get('statements', {})
+        keys = dict(('%s/%s' % (resource, digest), digest) for digest in digests)
+        missing = [key for key in keys if key not in cache]
+        # The last use is only recorded daily, not to rewrite the cache on every poll
+        stale = [key for key in keys if key in cache and cache[key][1] < now - 86400]
+        found = {}
+        if missing:
+            self.log('Describing the SQL text of %s digests' % len(missing))
+            request = dict((key, params[key]) for key in ('ServiceType', 'Identifier', 'StartTime', 'EndTime'))
+            request.update(Metric='db.load.avg', GroupBy={
+                'Group': 'db.sql_tokenized',
+                'Dimensions': ['db.sql_tokenized.id', 'db.sql_tokenized.statement'],
+                'Limit': max(len(digests), PI_TOP),
+            })
+            try:
+                result = self.call('DescribeDimensionKeys', self.conn.make_request, 'DescribeDimensionKeys', request)
+            except boto.exception.BotoServerError as err:
+                self.log(err)
+                return dict((digest, (cache.get(key) or [None])[0]) for (key, digest) in keys.items())
+
+            for item in result.get('Keys', []):
+                dimensions = item.get('Dimensions', {})
+                if 'db.sql_tokenized.id' in dimensions:
+                    found['%s/%s' % (resource, dimensions['db.sql_tokenized.id'])] = \
+                        dimensions.get('db.sql_tokenized.statement')
+
+            # Digests not described are not asked for again until they expire
+            found.update((key, None) for key in missing if key not in found)
+
+        if found or stale:
+            def save(data):
+                entries = data.setdefault('statements', {})
+                for key, text in found.items():
+                    entries[key] = [text, now]
+
+                for key in stale:
+                    if key in entries:
+                        entries[key][1] = now
+
+                for key in [key for (key, entry) in entries.items() if entry[1] < now - PI_CACHE_DAYS * 86400]:
+                    del entries[key]
+
+            self.state.update(save)
+            cache.update((key, [text, now]) for (key, text) in found.items())
+
+        return dict((digest, cache[key][0]) for (key, digest) in keys.items())
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of a list of values"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def _disks(sample, *fields):
+    """Values of the first of the fields present on each disk of an Enhanced Monitoring sample,
+    Aurora reports different ones
+    """
+    for disk in sample.get('diskIO') or []:
+        for field in fields:
+            if disk.get(field) is not None:
+                yield disk[field]
+                break
+
+
+# Enhanced Monitoring values reduced per interval, name: function returning the
+# value of a sample, or None if the sample does not have it
+OS_METRICS = {
+    'cpu': lambda s: s.get('cpuUtilization', {}).get('total'),
+    'cpu_wait': lambda s: s.get('cpuUtilization', {}).get('wait'),
+    'disk_await': lambda s: max(list(_disks(s, 'await', 'readLatency')) or [None]),
+    'disk_queue': lambda s: max(list(_disks(s, 'avgQueueLen', 'diskQueueDepth')) or [None]),
+    'disk_util': lambda s: max(list(_disks(s, 'util')) or [None]),
+    'read_iops': lambda s: sum(_disks(s, 'readIOsPS')) if s.get('diskIO') else None,
+    'write_iops': lambda s: sum(_disks(s, 'writeIOsPS')) if s.get('diskIO') else None,
+}
+
+
+class OSMetricsSummary(object):
+
+    """Maximum and percentile of the OS_METRICS values of the samples added"""
+
+    def __init__(self):
+        self.values = dict((name, []) for name in OS_METRICS)
+        self.samples = 0
+
+    def add(self, sample):
+        """Account one decoded Enhanced Monitoring log event"""
+        self.samples += 1
+        for name, func in OS_METRICS.items():
+            try:
+                value = func(sample)
+            except (TypeError, AttributeError):
+                value = None
+
+            if value is not None:
+                self.values[name].append(float(value))
+
+    def result(self, pct=EM_PERCENTILE):
+        """{name: [maximum, percentile]} of the metrics having values"""
+        return dict((name, [max(values), percentile(values, pct)]) for (name, values) in self.values.items()
+                    if values)
+
+
+class EnhancedMonitoring(RateLimitedClient):
+
+    """Enhanced Monitoring OS metrics of an instance read from CloudWatch Logs.
+
+    The log stream is read forward from where the previous poll stopped, its
+    position is kept in enhanced.json of the status directory, so each poll
+    summarizes the samples published since, at most one second apart, and the
+    short stalls a one minute CloudWatch average smooths out stay visible.
+    """
+
+    SERVICE = 'CloudWatchLogs'
+
+    def __init__(self, region, profile=None, status_dir=STATUS_DIR, rate=CW_RATE, log=_noop):
+        RateLimitedClient.__init__(self, region, status_dir, rate, log)
+        self.conn = boto.logs.connect_to_region(region, profile_name=profile)
+        self.state = StateFile(status_dir, 'enhanced.json')
+        self.resources = ResourceIds(status_dir, profile)
+        self.region = region
+        self.profile = profile
+
+    def resource_id(self, identifier, describe):
+        """DbiResourceId of an instance, describe() returns it when it is not cached"""
+        return self.resources.get(self.region, identifier, describe)
+
+    def samples(self, resource, token=None, start_time=None):
+        """Decode the log events from the token or start time (in ms) on, one page of them at a time.
+
+        Yields (timestamp in ms, sample, forward token of the page).
+        """
+        kwargs = {'next_token': token} if token else {'start_time': start_time}
+        while True:
+            page = self.call('GetLogEvents', self.conn.get_log_events, EM_LOG_GROUP, resource,
+                             start_from_head=True, **kwargs)
+            events = page.get('events', [])
+            stats.record('GetLogEvents', datapoints=len(events))
+            forward = page.get('nextForwardToken')
+            for event in events:
+                try:
+                    sample = json.loads(event['message'])
+                except ValueError:
+                    self.log('Skipping a malformed Enhanced Monitoring event at %s' % event.get('timestamp'))
+                    continue
+
+                yield event['timestamp'], sample, forward
+
+            # The same token comes back at the end of the stream, not asked for when
+            # the page is recent enough: anything published since is left for the next poll
+            if not events or not forward or forward == kwargs.get('next_token') or \
+                    events[-1]['timestamp'] > (time.time() - EM_LAG) * 1000:
+                break
+
+            kwargs = {'next_token': forward}
+
+    def summary(self, resource, start_time):
+        """Summarize the samples published since the previous poll, or since start_time on the
+        first one, return (OSMetricsSummary result, number of samples).
+
+        When there is nothing new, e.g. a second poll in the same interval, the
+        previous result is returned again.
+        """
+        key = '%s/%s/%s' % (self.profile or '', self.region, resource)
+        position = self.state.read().get(key) or {}
+        now = time.time() * 1000
+        start = int(calendar.timegm(start_time.timetuple()) * 1000)
+        token = position.get('token') if position.get('time', 0) > now - EM_RESUME * 3600000 else None
+
+        while True:
+            summary = OSMetricsSummary()
+            last = None
+            try:
+                for stamp, sample, forward in self.samples(resource, token, start):
+                    summary.add(sample)
+                    last = (stamp, forward)
+                break
+            except boto.logs.exceptions.InvalidParameterException as err:
+                if not token:
+                    raise
+
+                # Tokens expire, start over from the time
+                self.log('Stored log position rejected, reading from the start time: %s' % err)
+                token = None
+
+        if not summary.samples:
+            self.log('No new Enhanced Monitoring samples')
+            return position.get('result', {}), 0
+
+        result = summary.result()
+        self.state.update(lambda data: data.__setitem__(key, {'token': last[1], 'time': last[0], 'result': result}))
+        return result, summary.samples
+
+
+def _child(node, *path):
+    """Element at path below node ignoring XML namespaces, None if missing"""
+    for name in path:
+        for child in node:
+            if child.tag.split('}')[-1] == name:
+                node = child
+                break
+        else:
+            return None
+
+    return node
+
+
+def _find(node, *path):
+    """Children of the element at path"""
+    node = _child(node, *path)
+    return [] if node is None else list(node)
+
+
+def _text(node, *path):
+    """Text of the element at path"""
+    node = _child(node, *path)
+    return None if node is None else node.text
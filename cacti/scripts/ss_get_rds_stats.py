@@ -13,212 +13,309 @@ $version = '$VERSION$';
 import datetime
 import optparse
 import pprint
+import shlex
 import sys
+import time
 
 import boto
 import boto.rds
-import boto.ec2.cloudwatch
 
+import pmp_aws_rds
+
+# CloudWatch period to average datapoints over, in seconds
+PERIOD = 300
+
+# Datapoints published late are caught by requesting again the ones up to
+# OVERLAP seconds before the last one consumed, nothing older than MAX_LAG
+# seconds is reported.
+OVERLAP = 60
+MAX_LAG = 1800
+
+# In the server mode, values fetched are reused for CACHE_TTL seconds and the
+# instance details for INFO_TTL seconds.
+CACHE_TTL = 60
+INFO_TTL = 3600
 
 class RDS(object):
 
     """RDS connection class"""
 
-    def __init__(self, region, profile=None, identifier=None):
-        """Get RDS instance details"""
+    # CloudWatch dimension of the metrics
+    DIMENSION = 'DBInstanceIdentifier'
+
+    def __init__(self, region, profile=None, identifier=None, status_dir=pmp_aws_rds.STATUS_DIR,
+                 rate=pmp_aws_rds.CW_RATE, info=None):
+        """Get RDS instance details unless they are given"""
         self.region = region
         self.profile = profile
         self.identifier = identifier
+        self.status_dir = status_dir
+        self.rate = rate
+        self._cloudwatch = None
+        self.watermarks = pmp_aws_rds.Watermarks(status_dir)
+        self.datapoints = dict()
 
         if self.region == 'all':
             self.regions_list = [reg.name for reg in boto.rds.regions()]
         else:
             self.regions_list = [self.region]
 
-        self.info = None
-        if self.identifier:
-            for reg in self.regions_list:
-                try:
-                    rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                    self.info = rds.get_all_dbinstances(self.identifier)
-                except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
-                    debug(msg)
-                else:
-                    # Exit on the first region and identifier match
-                    self.region = reg
-                    break
+        self.info = info
+        if self.identifier and info is None:
+            if self.region == 'all':
+                region, self.info = pmp_aws_rds.locate_instance(self.identifier, self.regions_list, self.profile,
+                                                                status_dir, debug)
+                if region:
+                    self.region = region
+            else:
+                self.info = pmp_aws_rds.get_dbinstances(self.region, self.profile, self.identifier, debug)
 
     def get_info(self):
         """Get RDS instance info"""
         if not self.info:
-            print 'No DB instance "%s" found on your AWS account or %s region(s).' % (options.ident, options.region)
-            sys.exit(1)
+            raise PollError('No DB instance "%s" found on your AWS account or %s region(s).'
+                            % (self.identifier, self.region))
 
         return self.info[0]
 
     def get_list(self):
         """Get list of available instances by region(s)"""
-        result = dict()
-        for reg in self.regions_list:
+        def describe(reg):
             try:
                 rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                result[reg] = rds.get_all_dbinstances()
+                return pmp_aws_rds.timed('DescribeDBInstances', rds.get_all_dbinstances)
             except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
                 debug(msg)
 
-        return result
+        return dict((reg, info) for (reg, info) in pmp_aws_rds.map_regions(describe, self.regions_list)
+                    if info is not None)
+
+    @property
+    def cloudwatch(self):
+        """Rate limited CloudWatch connection to the instance region"""
+        if not self._cloudwatch:
+            self._cloudwatch = pmp_aws_rds.CloudWatch(self.region, self.profile, self.status_dir, self.rate, debug)
+
+        return self._cloudwatch
+
+    def fetch(self, metrics):
+        """Get new datapoints of several (metric, statistic) pairs from CloudWatch in one request.
+
+        Only datapoints from the last one consumed on are requested, with some
+        overlap to catch late writes, so the value reported never goes back in time.
+        """
+        now = datetime.datetime.utcnow()
+        queries, pending = self.pending(metrics, now)
+        if not queries:
+            return
+
+        data = self.cloudwatch.get_metric_data(queries, min(p[5] for p in pending), now)
+        debug('Result: %s' % data)
+        self.consume(data, queries, pending, now)
+
+    def pending(self, metrics, now):
+        """CloudWatch queries of the metrics not fetched lately and what to consume them with"""
+        queries = []
+        pending = []
+        for metric, stat in metrics:
+            fetched, _ = self.datapoints.get((metric, stat), (0, None))
+            if fetched > time.time() - CACHE_TTL:
+                continue
+
+            # Instances of different accounts may have the same identifier
+            key = '%s/%s/%s/%s' % (self.profile or '', self.region, self.identifier, metric)
+            if stat != 'Average':
+                key = '%s:%s' % (key, stat)
+
+            last_time, last_value = self.watermarks.get(key)
+            if last_time:
+                start_time = max(last_time - datetime.timedelta(seconds=OVERLAP),
+                                 now - datetime.timedelta(seconds=MAX_LAG))
+            else:
+                start_time = now - datetime.timedelta(seconds=PERIOD)
+
+            queries.append({'Id': 'm%s' % len(queries), 'MetricName': metric, 'Stat': stat, 'Period': PERIOD,
+                            'Dimensions': {self.DIMENSION: self.identifier}})
+            pending.append((metric, stat, key, last_time, last_value, start_time))
+
+        return queries, pending
+
+    def consume(self, data, queries, pending, now):
+        """Keep the last new datapoint of each metric fetched, update the watermarks"""
+        for query, (metric, stat, key, last_time, last_value, start_time) in zip(queries, pending):
+            # The periods overlapping the window of this metric, the request may span more
+            since = start_time - datetime.timedelta(seconds=PERIOD)
+            points = [p for p in data[query['Id']] if p[0] > since and (not last_time or p[0] >= last_time)]
+            result = None
+            if points:
+                result = points[-1][1]
+                self.watermarks.set(key, points[-1][0], result)
+            elif last_time and last_time >= now - datetime.timedelta(seconds=MAX_LAG):
+                # Nothing new was published yet
+                result = last_value
+
+            if result is not None:
+                if metric in ('ReadLatency', 'WriteLatency'):
+                    # Transform into miliseconds
+                    result = '%.2f' % float(result * 1000)
+                else:
+                    result = '%.2f' % float(result)
 
-    def get_metric(self, metric):
-        """Get RDS metric from CloudWatch"""
-        cw_conn = boto.ec2.cloudwatch.connect_to_region(self.region, profile_name=self.profile)
-        result = cw_conn.get_metric_statistics(
-            300,
-            datetime.datetime.utcnow() - datetime.timedelta(seconds=300),
-            datetime.datetime.utcnow(),
-            metric,
-            'AWS/RDS',
-            'Average',
-            dimensions={'DBInstanceIdentifier': [self.identifier]}
-        )
-        debug('Result: %s' % result)
-        if result:
-            if metric in ('ReadLatency', 'WriteLatency'):
-                # Transform into miliseconds
-                result = '%.2f' % float(result[0]['Average'] * 1000)
+            elif metric in ('ReplicaLag', 'AuroraReplicaLagMaximum'):
+                # This metric can be missed
+                result = 0
             else:
-                result = '%.2f' % float(result[0]['Average'])
+                continue
+
+            self.datapoints[(metric, stat)] = (time.time(), float(result))
 
-        elif metric == 'ReplicaLag':
-            # This metric can be missed
-            result = 0
+    def get_metric(self, metric, stat='Average'):
+        """Get RDS metric from CloudWatch"""
+        self.fetch([(metric, stat)])
+        if (metric, stat) not in self.datapoints:
+            raise PollError('Unable to get RDS statistics')
+
+        return self.datapoints[(metric, stat)][1]
+
+
+class Cluster(RDS):
+
+    """Aurora DB cluster, its metrics and the ones of all its members are fetched at once"""
+
+    DIMENSION = 'DBClusterIdentifier'
+
+    def __init__(self, region, profile=None, identifier=None, status_dir=pmp_aws_rds.STATUS_DIR,
+                 rate=pmp_aws_rds.CW_RATE):
+        """Get the Aurora DB cluster details and its members"""
+        RDS.__init__(self, region, profile, None, status_dir, rate)
+        self.identifier = identifier
+        if self.region == 'all':
+            region, self.info = pmp_aws_rds.locate_cluster(identifier, self.regions_list, profile, status_dir, debug)
+            if region:
+                self.region = region
         else:
-            print 'Unable to get RDS statistics'
-            sys.exit(1)
+            self.info = pmp_aws_rds.describe_cluster(self.region, profile, identifier, debug)
 
-        return float(result)
+        # The members are described by one request and share the watermarks of the cluster
+        self.members = []
+        if self.info:
+            instances = pmp_aws_rds.get_cluster_instances(self.region, profile, identifier, debug) or []
+            for inst in sorted(instances, key=lambda k: k.id):
+                member = RDS(self.region, profile, inst.id, status_dir, rate, info=[inst])
+                member.watermarks = self.watermarks
+                self.members.append(member)
+
+    def get_info(self):
+        """Get Aurora DB cluster info"""
+        if not self.info:
+            raise PollError('No DB cluster "%s" found on your AWS account or %s region(s).'
+                            % (self.identifier, self.region))
+
+        return self.info
+
+    def get_member(self, identifier):
+        """The member DB instance of the cluster with the identifier"""
+        for member in self.members:
+            if member.identifier == identifier:
+                return member
+
+        raise PollError('No DB instance "%s" found in the DB cluster "%s".' % (identifier, self.identifier))
+
+    def fetch(self, metrics):
+        """Get new datapoints of the cluster metrics of the cluster and the other metrics of all
+        its members from CloudWatch in one request
+        """
+        self.get_info()
+        now = datetime.datetime.utcnow()
+        batches = []
+        for num, rds in enumerate([self] + self.members):
+            selected = [spec for spec in metrics if (spec[0] in CLUSTER_METRICS) == (rds is self)]
+            queries, pending = rds.pending(selected, now)
+            for query in queries:
+                query['Id'] = 't%s_%s' % (num, query['Id'])
+
+            if queries:
+                batches.append((rds, queries, pending))
+
+        if not batches:
+            return
+
+        data = self.cloudwatch.get_metric_data([q for batch in batches for q in batch[1]],
+                                               min(p[5] for batch in batches for p in batch[2]), now)
+        debug('Result: %s' % data)
+        for rds, queries, pending in batches:
+            rds.consume(data, queries, pending, now)
 
 
 def debug(val):
-    """Debugging output"""
+    """Debugging output, to stderr in the server mode not to mix it with the answers"""
     global options
-    if options.debug:
+    if options.debug and options.server:
+        sys.stderr.write('DEBUG: %s\n' % val)
+    elif options.debug:
         print 'DEBUG: %s' % val
 
 
-def main():
-    """Main function"""
-    global options
+class PollError(Exception):
 
-    # DB instance classes as listed on
-    # http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.DBInstanceClass.html
-    db_classes = {
-        'db.t1.micro': 0.615,
-        'db.m1.small': 1.7,
-        'db.m1.medium': 3.75,
-        'db.m1.large': 7.5,
-        'db.m1.xlarge': 15,
-        'db.m4.large': 8,
-        'db.m4.xlarge': 16,
-        'db.m4.2xlarge': 32,
-        'db.m4.4xlarge': 64,
-        'db.m4.10xlarge': 160,
-        'db.r3.large': 15,
-        'db.r3.xlarge': 30.5,
-        'db.r3.2xlarge': 61,
-        'db.r3.4xlarge': 122,
-        'db.r3.8xlarge': 244,
-        'db.t2.micro': 1,
-        'db.t2.small': 2,
-        'db.t2.medium': 4,
-        'db.t2.large': 8,
-        'db.m3.medium': 3.75,
-        'db.m3.large': 7.5,
-        'db.m3.xlarge': 15,
-        'db.m3.2xlarge': 30,
-        'db.m2.xlarge': 17.1,
-        'db.m2.2xlarge': 34.2,
-        'db.m2.4xlarge': 68.4,
-        'db.cr1.8xlarge': 244,
-    }
-
-    # RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
-    metrics = {
-        'BinLogDiskUsage': 'binlog_disk_usage',  # The amount of disk space occupied by binary logs on the master.  Units: Bytes
-        'CPUUtilization': 'utilization',  # The percentage of CPU utilization.  Units: Percent
-        'DatabaseConnections': 'connections',  # The number of database connections in use.  Units: Count
-        'DiskQueueDepth': 'disk_queue_depth',  # The number of outstanding IOs (read/write requests) waiting to access the disk.  Units: Count
-        'ReplicaLag': 'replica_lag',  # The amount of time a Read Replica DB Instance lags behind the source DB Instance.  Units: Seconds
-        'SwapUsage': 'swap_usage',  # The amount of swap space used on the DB Instance.  Units: Bytes
-        'FreeableMemory': 'used_memory',  # The amount of available random access memory.  Units: Bytes
-        'FreeStorageSpace': 'used_space',  # The amount of available storage space.  Units: Bytes
-        'ReadIOPS': 'read_iops',  # The average number of disk I/O operations per second.  Units: Count/Second
-        'WriteIOPS': 'write_iops',  # The average number of disk I/O operations per second.  Units: Count/Second
-        'ReadLatency': 'read_latency',  # The average amount of time taken per disk I/O operation.  Units: Seconds
-        'WriteLatency': 'write_latency',  # The average amount of time taken per disk I/O operation.  Units: Seconds
-        'ReadThroughput': 'read_throughput',  # The average number of bytes read from disk per second.  Units: Bytes/Second
-        'WriteThroughput': 'write_throughput',  # The average number of bytes written to disk per second.  Units: Bytes/Second
-    }
-
-    # Parse options
-    parser = optparse.OptionParser()
-    parser.add_option('-l', '--list', help='list DB instances',
-                      action='store_true', default=False, dest='db_list')
-    parser.add_option('-n', '--profile', default=None,
-                      help='AWS profile from ~/.boto or /etc/boto.cfg. Default: None, fallbacks to "[Credentials]".')
-    parser.add_option('-r', '--region', default='us-east-1',
-                      help='AWS region. Default: us-east-1. If set to "all", we try to detect the instance region '
-                           'across all of them, note this will be slower than if you specify the region explicitly.')
-    parser.add_option('-i', '--ident', help='DB instance identifier')
-    parser.add_option('-p', '--print', help='print status and other details for a given DB instance',
-                      action='store_true', default=False, dest='printinfo')
-    parser.add_option('-m', '--metric', help='metrics to retrive separated by comma: [%s]' % ', '.join(metrics.keys()))
-    parser.add_option('-d', '--debug', help='enable debugging',
-                      action='store_true', default=False)
-    options, _ = parser.parse_args()
+    """Error printed instead of the poll result"""
 
-    # Strip a prefix _ which is sent by Cacti, so an empty argument is interpreted correctly.
-    # Than set defaults if argument is supposed to be empty.
-    options.region = options.region.lstrip('_')
-    options.profile = options.profile.lstrip('_')
-    if not options.region:
-        options.region = 'us-east-1'
+    pass
 
-    if not options.profile:
-        options.profile = None
 
-    if options.debug:
-        boto.set_stream_logger('boto')
+class OptionParsingError(RuntimeError):
 
-    rds = RDS(region=options.region, profile=options.profile, identifier=options.ident)
+    """Invalid request in the server mode"""
 
-    # Check args
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit()
-    elif options.db_list:
-        info = rds.get_list()
-        print 'List of all DB instances in %s region(s):' % (options.region,)
-        pprint.pprint(info)
-        sys.exit()
-    elif not options.ident:
-        parser.print_help()
-        parser.error('DB identifier is not set.')
-    elif options.printinfo:
-        info = rds.get_info()
-        pprint.pprint(vars(info))
-        sys.exit()
-    elif not options.metric:
-        parser.print_help()
-        parser.error('Metric is not set.')
+    pass
 
-    selected_metrics = options.metric.split(',')
-    for metric in selected_metrics:
-        if metric not in metrics.keys():
-            parser.print_help()
-            parser.error('Invalid metric.')
 
-    # Do not remove the empty lines in the start and end of this docstring
-    perl_magic_vars = """
+class ServerOptionParser(optparse.OptionParser):
+
+    """Option parser reporting errors instead of exiting, stdout is for the results only"""
+
+    def error(self, msg):
+        raise OptionParsingError(msg)
+
+    def print_help(self, file=None):
+        pass
+
+
+# RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
+METRICS = {
+    'BinLogDiskUsage': 'binlog_disk_usage',  # The amount of disk space occupied by binary logs on the master.  Units: Bytes
+    'CPUUtilization': 'utilization',  # The percentage of CPU utilization.  Units: Percent
+    'DatabaseConnections': 'connections',  # The number of database connections in use.  Units: Count
+    'DiskQueueDepth': 'disk_queue_depth',  # The number of outstanding IOs (read/write requests) waiting to access the disk.  Units: Count
+    'ReplicaLag': 'replica_lag',  # The amount of time a Read Replica DB Instance lags behind the source DB Instance.  Units: Seconds
+    'SwapUsage': 'swap_usage',  # The amount of swap space used on the DB Instance.  Units: Bytes
+    'FreeableMemory': 'used_memory',  # The amount of available random access memory.  Units: Bytes
+    'FreeStorageSpace': 'used_space',  # The amount of available storage space.  Units: Bytes
+    'ReadIOPS': 'read_iops',  # The average number of disk I/O operations per second.  Units: Count/Second
+    'WriteIOPS': 'write_iops',  # The average number of disk I/O operations per second.  Units: Count/Second
+    'ReadLatency': 'read_latency',  # The average amount of time taken per disk I/O operation.  Units: Seconds
+    'WriteLatency': 'write_latency',  # The average amount of time taken per disk I/O operation.  Units: Seconds
+    'ReadThroughput': 'read_throughput',  # The average number of bytes read from disk per second.  Units: Bytes/Second
+    'WriteThroughput': 'write_throughput',  # The average number of bytes written to disk per second.  Units: Bytes/Second
+}
+
+# Aurora DB cluster metrics, polled with --cluster
+CLUSTER_METRICS = {
+    'AuroraReplicaLagMaximum': 'aurora_replica_lag_max',  # The maximum lag of the Aurora Replicas.  Units: Milliseconds
+    'VolumeBytesUsed': 'volume_bytes_used',  # The amount of storage used by the cluster volume.  Units: Bytes
+}
+
+# Metrics of other services than CloudWatch, each one outputs several values
+SERVICE_METRICS = {
+    # Performance Insights DB load in total, on CPU, of the top wait event and SQL digest.  Units: Sessions
+    'PerformanceInsights': 'db_load',
+    # Enhanced Monitoring maximum and 95th percentile of the OS CPU, I/O wait, disk latency, queue,
+    # utilization and IOPS since the last poll.  Units: Percent, Milliseconds, Count/Second
+    'EnhancedMonitoring': 'os',
+}
+
+# Do not remove the empty lines in the start and end of this docstring
+PERL_MAGIC_VARS = """
 
     # Define the variables to output.  I use shortened variable names so maybe
     # it'll all fit in 1024 bytes for Cactid and Spine's benefit.  Strings must
@@ -242,47 +339,371 @@ def main():
        'write_latency'           =>  'gt',
        'read_throughput'         =>  'gu',
        'write_throughput'        =>  'gv',
+       'read_latency_p90'        =>  'gw',
+       'read_latency_p99'        =>  'gx',
+       'write_latency_p90'       =>  'gy',
+       'write_latency_p99'       =>  'gz',
+       'aurora_replica_lag_max'  =>  'hg',
+       'volume_bytes_used'       =>  'hh',
+       'db_load'                 =>  'hi',
+       'db_load_cpu'             =>  'hj',
+       'db_load_top_wait'        =>  'hk',
+       'db_load_top_sql'         =>  'hl',
+       'os_cpu_max'              =>  'hm',
+       'os_cpu_p95'              =>  'hn',
+       'os_cpu_wait_max'         =>  'ho',
+       'os_cpu_wait_p95'         =>  'hp',
+       'os_disk_await_max'       =>  'hq',
+       'os_disk_await_p95'       =>  'hr',
+       'os_disk_queue_max'       =>  'hs',
+       'os_disk_queue_p95'       =>  'ht',
+       'os_disk_util_max'        =>  'hu',
+       'os_disk_util_p95'        =>  'hv',
+       'os_read_iops_max'        =>  'hw',
+       'os_read_iops_p95'        =>  'hx',
+       'os_write_iops_max'       =>  'hy',
+       'os_write_iops_p95'       =>  'hz',
     );
 
+"""
+OUTPUT = dict()
+for row in PERL_MAGIC_VARS.split('\n'):
+    if row.find('=>') >= 0:
+        k = row.split(' => ')[0].strip().replace("'", '')
+        v = row.split(' => ')[1].strip().replace("'", '').replace(',', '')
+        OUTPUT[k] = v
+
+
+def get_parser(server=False):
+    """Return the command line parser"""
+    if server:
+        parser = ServerOptionParser()
+    else:
+        parser = optparse.OptionParser()
+
+    parser.add_option('-l', '--list', help='list DB instances',
+                      action='store_true', default=False, dest='db_list')
+    parser.add_option('-n', '--profile', default=None,
+                      help='AWS profile from ~/.boto or /etc/boto.cfg. Default: None, fallbacks to "[Credentials]".')
+    parser.add_option('-r', '--region', default='us-east-1',
+                      help='AWS region. Default: us-east-1. If set to "all", we try to detect the instance region '
+                           'across all of them, note this will be slower than if you specify the region explicitly.')
+    parser.add_option('-i', '--ident', help='DB instance identifier')
+    parser.add_option('-C', '--cluster', help='Aurora DB cluster identifier, to poll it together with all its '
+                      'instances. The metrics of the DB instance set by --ident or of every instance are printed')
+    parser.add_option('--statusdir', default=pmp_aws_rds.STATUS_DIR,
+                      help='directory to keep state between runs, e.g. the instance to region index. '
+                           'Default: %s' % pmp_aws_rds.STATUS_DIR)
+    parser.add_option('--rate', type='float', default=pmp_aws_rds.CW_RATE,
+                      help='CloudWatch requests per second shared by all the checks using the same status '
+                           'directory, 0 disables the limit. Default: %s' % pmp_aws_rds.CW_RATE)
+    parser.add_option('-p', '--print', help='print status and other details for a given DB instance',
+                      action='store_true', default=False, dest='printinfo')
+    parser.add_option('-m', '--metric', help='metrics to retrive separated by comma: [%s], and with --cluster: '
+                      '[%s], optionally followed by a percentile to get instead of the average, e.g. ReadLatency:p99'
+                      % (', '.join(METRICS.keys() + SERVICE_METRICS.keys()), ', '.join(CLUSTER_METRICS.keys())))
+    parser.add_option('--classes', default=pmp_aws_rds.CLASSES_FILE,
+                      help='file with the memory of DB instance classes not known or inferred correctly, one '
+                           '"class = GB" per line. Default: %s' % pmp_aws_rds.CLASSES_FILE)
+    parser.add_option('-S', '--server', help='keep running, read the options of a poll per line on stdin and '
+                                              'print the result for each',
+                      action='store_true', default=False)
+    parser.add_option('--stats-log', dest='stats_log',
+                      help='file to append the AWS API calls, retries, throttles, datapoints and time of each run '
+                           'to, as a JSON line')
+    parser.add_option('-d', '--debug', help='enable debugging',
+                      action='store_true', default=False)
+    return parser
+
+
+def fix_options(options):
+    """Strip a prefix _ which is sent by Cacti, so an empty argument is interpreted correctly.
+    Than set defaults if argument is supposed to be empty.
     """
-    output = dict()
-    for row in perl_magic_vars.split('\n'):
-        if row.find('=>') >= 0:
-            k = row.split(' => ')[0].strip().replace("'", '')
-            v = row.split(' => ')[1].strip().replace("'", '').replace(',', '')
-            output[k] = v
+    options.region = (options.region or '').lstrip('_')
+    options.profile = (options.profile or '').lstrip('_')
+    if not options.region:
+        options.region = 'us-east-1'
+
+    if not options.profile:
+        options.profile = None
+
+
+def check_metrics(parser, options):
+    """Validate the metric list and return it"""
+    if not options.ident and not options.cluster:
+        parser.print_help()
+        parser.error('DB identifier is not set.')
+    elif not options.metric:
+        parser.print_help()
+        parser.error('Metric is not set.')
 
-    debug('Perl magic vars: %s' % output)
-    debug('Metric associations: %s' % dict((k, output[v]) for (k, v) in metrics.iteritems()))
+    selected_metrics = []
+    for spec in options.metric.split(','):
+        try:
+            metric, stat = pmp_aws_rds.split_statistic(spec)
+        except ValueError as err:
+            parser.print_help()
+            parser.error(err)
 
-    # Handle metrics
+        if metric not in METRICS.keys() + SERVICE_METRICS.keys() and \
+                not (options.cluster and metric in CLUSTER_METRICS.keys()):
+            parser.print_help()
+            parser.error('Invalid metric.')
+        elif metric in SERVICE_METRICS and stat != 'Average':
+            parser.print_help()
+            parser.error('%s metric has no percentiles.' % metric)
+
+        selected_metrics.append((metric, stat))
+
+    return selected_metrics
+
+
+def poll(rds, selected_metrics, cluster=None):
+    """Return the output line for the metrics, cluster metrics are of the cluster given"""
+    debug('Perl magic vars: %s' % OUTPUT)
+    debug('Metric associations: %s' % dict((k, OUTPUT[v]) for (k, v) in METRICS.iteritems()))
+
+    # Handle metrics, all of them are fetched at once
+    (cluster or rds).fetch([spec for spec in selected_metrics if spec[0] not in SERVICE_METRICS])
     results = []
-    for metric in selected_metrics:
-        stats = rds.get_metric(metric)
-        if metric == 'FreeableMemory':
-            info = rds.get_info()
-            try:
-                memory = db_classes[info.instance_class] * 1024 ** 3
-            except IndexError:
-                print 'Unknown DB instance class "%s"' % info.instance_class
-                sys.exit(1)
+    for metric, stat in selected_metrics:
+        if metric == 'PerformanceInsights':
+            results.extend(poll_performance_insights(rds))
+            continue
+        elif metric == 'EnhancedMonitoring':
+            results.extend(poll_enhanced_monitoring(rds))
+            continue
+        elif metric in CLUSTER_METRICS:
+            stats = cluster.get_metric(metric, stat)
+        else:
+            stats = rds.get_metric(metric, stat)
+
+        name = METRICS.get(metric) or CLUSTER_METRICS[metric]
+        if stat != 'Average':
+            # Percentiles have their own keys, e.g. read_latency_p99
+            short_var = OUTPUT.get('%s_%s' % (name, stat.replace('.', '_')))
+            if not short_var:
+                raise PollError('Chosen metric does not have a correspondent entry in perl magic vars')
 
-            results.append('%s:%.0f' % (output['used_memory'], memory - stats))
-            results.append('%s:%.0f' % (output['total_memory'], memory))
+            results.append('%s:%s' % (short_var, stats))
+        elif metric == 'FreeableMemory':
+            info = rds.get_info()
+            memory = pmp_aws_rds.instance_classes(options.classes, debug).get(info.instance_class)
+            if not memory:
+                # The other metrics are still worth reporting
+                debug('Unknown DB instance class "%s", set its memory in %s' % (info.instance_class,
+                                                                               options.classes))
+                continue
+
+            memory *= 1024 ** 3
+            results.append('%s:%.0f' % (OUTPUT['used_memory'], memory - stats))
+            results.append('%s:%.0f' % (OUTPUT['total_memory'], memory))
         elif metric == 'FreeStorageSpace':
             info = rds.get_info()
             storage = float(info.allocated_storage) * 1024 ** 3
-            results.append('%s:%.0f' % (output['used_space'], storage - stats))
-            results.append('%s:%.0f' % (output['total_space'], storage))
+            results.append('%s:%.0f' % (OUTPUT['used_space'], storage - stats))
+            results.append('%s:%.0f' % (OUTPUT['total_space'], storage))
         else:
-            short_var = output.get(metrics[metric])
+            short_var = OUTPUT.get(name)
             if not short_var:
-                print 'Chosen metric does not have a correspondent entry in perl magic vars'
-                sys.exit(1)
+                raise PollError('Chosen metric does not have a correspondent entry in perl magic vars')
 
             results.append('%s:%s' % (short_var, stats))
 
-    print ' '.join(results)
+    rds.watermarks.save()
+    debug('Waited for CloudWatch: %.2f sec.' % (cluster or rds).cloudwatch.waited)
+    return ' '.join(results)
+
+
+def poll_performance_insights(rds):
+    """Return the DB load values of the instance over the last period"""
+    pi = pmp_aws_rds.PerformanceInsights(rds.region, rds.profile, rds.status_dir, rds.rate, debug)
+    resource = pi.resource_id(rds.identifier, lambda: getattr(rds.get_info(), 'DbiResourceId', None))
+    if not resource:
+        raise PollError('Unable to get the resource id of the DB instance "%s".' % rds.identifier)
+
+    end_time = datetime.datetime.utcnow()
+    try:
+        top = pi.top_load(resource, end_time - datetime.timedelta(seconds=PERIOD), end_time, describe=False)
+    except boto.exception.BotoServerError as err:
+        # Performance Insights is off on the instance
+        raise PollError('Unable to get Performance Insights data: %s' % (err.message or err.reason))
+
+    debug('Performance Insights: %s' % top)
+    waits = [val for (name, val) in top['waits'] if name != 'CPU']
+    return ['%s:%.2f' % (OUTPUT['db_load'], top['load']),
+            '%s:%.2f' % (OUTPUT['db_load_cpu'], sum(val for (name, val) in top['waits'] if name == 'CPU')),
+            '%s:%.2f' % (OUTPUT['db_load_top_wait'], max(waits or [0])),
+            '%s:%.2f' % (OUTPUT['db_load_top_sql'], max([val for (_, val, _) in top['sql']] or [0]))]
+
+
+def poll_enhanced_monitoring(rds):
+    """Return the maximum and percentile of the OS metrics since the last poll"""
+    em = pmp_aws_rds.EnhancedMonitoring(rds.region, rds.profile, rds.status_dir, rds.rate, debug)
+    resource = em.resource_id(rds.identifier, lambda: getattr(rds.get_info(), 'DbiResourceId', None))
+    if not resource:
+        raise PollError('Unable to get the resource id of the DB instance "%s".' % rds.identifier)
+
+    try:
+        result, samples = em.summary(resource, datetime.datetime.utcnow() - datetime.timedelta(seconds=PERIOD))
+    except boto.exception.BotoServerError as err:
+        # Enhanced Monitoring is off, or its log stream is not readable
+        raise PollError('Unable to get Enhanced Monitoring data: %s' % (err.message or err.reason))
+
+    debug('Enhanced Monitoring, %s new samples: %s' % (samples, result))
+    values = []
+    for name in sorted(result):
+        values.append('%s:%.2f' % (OUTPUT['os_%s_max' % name], result[name][0]))
+        values.append('%s:%.2f' % (OUTPUT['os_%s_p95' % name], result[name][1]))
+
+    return values
+
+
+def poll_cluster(cluster, selected_metrics, identifier=None):
+    """Return the output line of a member of the cluster, or one line per member prefixed with
+    its identifier, and one of the cluster if cluster metrics are selected
+    """
+    cluster.fetch([spec for spec in selected_metrics if spec[0] not in SERVICE_METRICS])
+    if identifier:
+        return poll(cluster.get_member(identifier), selected_metrics, cluster)
+
+    lines = []
+    cluster_metrics = [spec for spec in selected_metrics if spec[0] in CLUSTER_METRICS]
+    member_metrics = [spec for spec in selected_metrics if spec[0] not in CLUSTER_METRICS]
+    if cluster_metrics:
+        lines.append('%s %s' % (cluster.identifier, poll(cluster, cluster_metrics, cluster)))
+
+    for member in cluster.members:
+        if member_metrics:
+            try:
+                lines.append('%s %s' % (member.identifier, poll(member, member_metrics, cluster)))
+            except PollError as err:
+                lines.append('%s %s' % (member.identifier, err))
+
+    return '\n'.join(lines)
+
+
+def log_stats(rds):
+    """Append the AWS API usage of the poll to the --stats-log file"""
+    debug('AWS API calls: %s' % pmp_aws_rds.stats.apis)
+    if options.stats_log:
+        pmp_aws_rds.stats.log(options.stats_log, script='ss_get_rds_stats.py', region=rds.region,
+                              ident=options.ident, metric=options.metric)
+
+
+def serve():
+    """Answer polls read from stdin one per line, keeping connections and data between them.
+
+    A line holds the same options as the command line, optionally preceded by
+    the script path.  An empty line or "quit" stops the server.
+    """
+    global options
+
+    parser = get_parser(server=True)
+    parser.set_defaults(server=True)
+    instances = dict()
+    while True:
+        line = sys.stdin.readline()
+        if not line.strip() or line.strip() == 'quit':
+            break
+
+        pmp_aws_rds.stats.reset()
+        rds = None
+        try:
+            args = shlex.split(line)
+            if args[0].endswith('.py'):
+                args = args[1:]
+
+            options, _ = parser.parse_args(args)
+            fix_options(options)
+            selected_metrics = check_metrics(parser, options)
+            # The polls of the members of a cluster share it
+            key = (options.region, options.profile, options.cluster, options.cluster is None and options.ident,
+                   options.statusdir, options.rate)
+            rds, created = instances.get(key, (None, None))
+            if not rds or created < time.time() - INFO_TTL:
+                if options.cluster:
+                    rds = Cluster(region=options.region, profile=options.profile, identifier=options.cluster,
+                                  status_dir=options.statusdir, rate=options.rate)
+                else:
+                    rds = RDS(region=options.region, profile=options.profile, identifier=options.ident,
+                              status_dir=options.statusdir, rate=options.rate)
+                # Not found is asked again on the next poll
+                if rds.info:
+                    instances[key] = (rds, time.time())
+
+            if options.cluster:
+                print poll_cluster(rds, selected_metrics, options.ident)
+            else:
+                print poll(rds, selected_metrics)
+        except (OptionParsingError, PollError) as err:
+            print err
+        except boto.exception.BotoServerError as err:
+            # Do not let a failed API call take the server down
+            print 'ERROR: %s %s' % (err.status, err.reason)
+        except Exception as err:
+            # Nor anything else wrong with a single request
+            print 'ERROR: %s' % err
+        finally:
+            if rds:
+                log_stats(rds)
+
+        sys.stdout.flush()
+
+
+def main():
+    """Main function"""
+    global options
+
+    parser = get_parser()
+    options, _ = parser.parse_args()
+    fix_options(options)
+
+    if options.debug:
+        boto.set_stream_logger('boto')
+
+    if options.server:
+        serve()
+        sys.exit()
+
+    if options.cluster:
+        rds = Cluster(region=options.region, profile=options.profile, identifier=options.cluster,
+                      status_dir=options.statusdir, rate=options.rate)
+    else:
+        rds = RDS(region=options.region, profile=options.profile, identifier=options.ident,
+                  status_dir=options.statusdir, rate=options.rate)
+
+    # Check args
+    try:
+        if len(sys.argv) == 1:
+            parser.print_help()
+            sys.exit()
+        elif options.db_list:
+            info = rds.get_list()
+            print 'List of all DB instances in %s region(s):' % (options.region,)
+            pprint.pprint(info)
+            sys.exit()
+        elif not options.ident and not options.cluster:
+            parser.print_help()
+            parser.error('DB identifier is not set.')
+        elif options.printinfo and options.cluster:
+            pprint.pprint(rds.get_info())
+            sys.exit()
+        elif options.printinfo:
+            info = rds.get_info()
+            pprint.pprint(vars(info))
+            sys.exit()
+
+        if options.cluster:
+            print poll_cluster(rds, check_metrics(parser, options), options.ident)
+        else:
+            print poll(rds, check_metrics(parser, options))
+    except PollError as err:
+        print err
+        sys.exit(1)
+    finally:
+        log_stats(rds)
 
 
 if __name__ == '__main__':
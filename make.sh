@@ -34,10 +34,13 @@ TEMPFILE=$(mktemp /tmp/${0##*/}.XXXX)
 rm -rf release
 mkdir -p release/code
 cp -R docs release/docs
-cp -R nagios release/code/nagios
+# Dereference symlinks, e.g. the RDS helper module shared with the Cacti script.
+cp -RL nagios release/code/nagios
 cp -R cacti release/code/cacti
 cp -R zabbix release/code/zabbix
 cp cacti/scripts/ss_get_mysql_stats.php release/code/zabbix/scripts
+cp zabbix/bin/perlhash.py release/code/zabbix/scripts
+cp cacti/scripts/ss_get_by_ssh.php release/code/zabbix/scripts
 cp COPYING Changelog release/code
 cp Changelog release/docs/changelog.rst
 mkdir release/{docs/html,code/cacti/templates,code/zabbix/templates}
@@ -49,7 +52,7 @@ find release/ -name "*.pyc" -exec rm -f {} \;
 # Update the version number and other important macros in the temporary
 # directory.
 YEAR=$(date +%Y)
-for f in release/code/nagios/bin/pmp* release/docs/config/conf.py release/code/cacti/scripts/ss* release/code/cacti/definitions/*.def release/code/zabbix/scripts/* ; do
+for f in release/code/nagios/bin/pmp* release/docs/config/conf.py release/code/cacti/scripts/ss* release/code/cacti/scripts/pmp* release/code/cacti/definitions/*.def release/code/zabbix/scripts/* ; do
    sed -i "s/\\\$PROJECT_NAME\\\$/$PROJECT_NAME/g" "$f"
    sed -i "s/\\\$VERSION\\\$/$VERSION/g" "$f"
    sed -i "s/\\\$CURRENT_YEAR\\\$/${YEAR}/g" "$f"
@@ -92,6 +95,18 @@ FILE="release/code/zabbix/templates/zabbix_agent_template_percona_mysql_server_h
 python zabbix/bin/pmp-zabbix-template.py -o xml > "${FILE}"
 FILE="release/code/zabbix/templates/userparameter_percona_mysql.conf"
 python zabbix/bin/pmp-zabbix-template.py -o config > "${FILE}"
+FILE="release/code/zabbix/templates/zabbix_agent_template_percona_mysql_dependent_ht_3.4-sver${VERSION}.xml"
+python zabbix/bin/pmp-zabbix-template.py -t dependent -o xml > "${FILE}"
+FILE="release/code/zabbix/templates/userparameter_percona_mysql_dependent.conf"
+python zabbix/bin/pmp-zabbix-template.py -t dependent -o config > "${FILE}"
+FILE="release/code/zabbix/templates/zabbix_agent_template_percona_mysql_trapper_ht_2.0.9-sver${VERSION}.xml"
+python zabbix/bin/pmp-zabbix-template.py -t trapper -o xml > "${FILE}"
+FILE="release/code/zabbix/templates/userparameter_percona_mysql_trapper.conf"
+python zabbix/bin/pmp-zabbix-template.py -t trapper -o config > "${FILE}"
+FILE="release/code/zabbix/scripts/percona_mysql_keys.json"
+python zabbix/bin/pmp-zabbix-template.py -o index > "${FILE}"
+# The GNU/Linux template discovers the disks, network interfaces and volumes
+python zabbix/bin/pmp-zabbix-template.py -a -n -d release/code/zabbix/templates gnu_linux
 
 # Make the Nagios documentation into Sphinx .rst format.  The Cacti docs are
 # already in Sphinx format.
@@ -8,14 +8,18 @@ Author Roman Vynar
 Copyright 2014-2015 Percona LLC and/or its affiliates
 """
 
+import calendar
 import datetime
 import optparse
 import pprint
+import re
 import sys
+import time
 
 import boto
 import boto.rds
-import boto.ec2.cloudwatch
+
+import pmp_aws_rds
 
 # Nagios status codes
 OK = 0
@@ -23,16 +27,81 @@ WARNING = 1
 CRITICAL = 2
 UNKNOWN = 3
 
+# RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
+METRICS = {
+    'status': 'RDS availability',
+    'load': 'CPUUtilization',
+    'memory': 'FreeableMemory',
+    'storage': 'FreeStorageSpace',
+    'read_latency': 'ReadLatency',
+    'write_latency': 'WriteLatency',
+    'disk_queue': 'DiskQueueDepth',
+    'replica_lag': 'ReplicaLag',
+    'swap': 'SwapUsage',
+    'storage_forecast': 'FreeStorageSpace',
+    'memory_forecast': 'FreeableMemory',
+    'cluster_replica_lag': 'AuroraReplicaLagMaximum',
+    'volume_used': 'VolumeBytesUsed',
+    'db_load': 'Performance Insights DB load'
+}
+
+# Metrics of an Aurora DB cluster as a whole rather than of its instances
+CLUSTER_METRICS = ('cluster_replica_lag', 'volume_used')
+
+# Forecasts fit a trend through the datapoints of FORECAST_PERIOD seconds over
+# the --window, the time to full reported is capped at FORECAST_HORIZON hours.
+FORECASTS = ('storage_forecast', 'memory_forecast')
+FORECAST_PERIOD = 300
+FORECAST_HORIZON = 24 * 365
+
+# Metrics checked against a single threshold, the higher the worse:
+# unit, multiplier from the CloudWatch unit, description
+GAUGES = {
+    'read_latency': ('ms', 1000, 'Read latency'),
+    'write_latency': ('ms', 1000, 'Write latency'),
+    'disk_queue': ('', 1, 'Disk queue depth'),
+    'replica_lag': ('s', 1, 'Replica lag'),
+    'swap': ('MB', 1.0 / 1024 ** 2, 'Swap usage'),
+    'cluster_replica_lag': ('ms', 1, 'Replica lag maximum'),
+    'volume_used': ('GB', 1.0 / 1024 ** 3, 'Volume used')
+}
+
+# Gauges CloudWatch has no datapoints of when there is no replication
+REPLICATION_GAUGES = ('replica_lag', 'cluster_replica_lag')
+
+UNITS = ('percent', 'GB')
+
+# Instance states the status check alerts on with --events, any other is OK
+STATE_STATUS = {
+    'failover': WARNING,
+    'rebooting': WARNING,
+    'maintenance': WARNING,
+    'storage-full': CRITICAL,
+    'failed': CRITICAL,
+    'deleted': CRITICAL,
+}
+
 
 class RDS(object):
 
     """RDS connection class"""
 
-    def __init__(self, region, profile=None, identifier=None):
-        """Get RDS instance details"""
+    # CloudWatch dimension of the metrics
+    DIMENSION = 'DBInstanceIdentifier'
+
+    def __init__(self, region, profile=None, identifier=None, status_dir=pmp_aws_rds.STATUS_DIR,
+                 rate=pmp_aws_rds.CW_RATE, describe=True, cluster=None):
+        """Get RDS instance details, on the first use of them unless describe is set.
+
+        The details of the members of a cluster are described all at once by it.
+        """
         self.region = region
         self.profile = profile
         self.identifier = identifier
+        self.status_dir = status_dir
+        self.rate = rate
+        self.cluster = cluster
+        self._cloudwatch = None
 
         if self.region == 'all':
             self.regions_list = [reg.name for reg in boto.rds.regions()]
@@ -40,20 +109,33 @@ class RDS(object):
             self.regions_list = [self.region]
 
         self.info = None
-        if self.identifier:
-            for reg in self.regions_list:
-                try:
-                    rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                    self.info = rds.get_all_dbinstances(self.identifier)
-                except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
-                    debug(msg)
-                else:
-                    # Exit on the first region and identifier match
-                    self.region = reg
-                    break
+        self.described = False
+        if self.identifier and not describe and self.region == 'all':
+            # The region the instance was last found in will do if we may not need the details
+            region = pmp_aws_rds.RegionIndex(status_dir, profile).get(self.identifier)
+            if region:
+                self.region = region
+                return
+
+        if self.identifier and (describe or self.region == 'all'):
+            self.described = True
+            if self.region == 'all':
+                region, self.info = pmp_aws_rds.locate_instance(self.identifier, self.regions_list, self.profile,
+                                                                status_dir, debug)
+                if region:
+                    self.region = region
+            else:
+                self.info = pmp_aws_rds.get_dbinstances(self.region, self.profile, self.identifier, debug)
 
     def get_info(self):
         """Get RDS instance info"""
+        if self.identifier and not self.described:
+            if self.cluster:
+                self.cluster.describe_members()
+            else:
+                self.described = True
+                self.info = pmp_aws_rds.get_dbinstances(self.region, self.profile, self.identifier, debug)
+
         if self.info:
             return self.info[0]
         else:
@@ -61,37 +143,99 @@ class RDS(object):
 
     def get_list(self):
         """Get list of available instances by region(s)"""
-        result = dict()
-        for reg in self.regions_list:
+        def describe(reg):
             try:
                 rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                result[reg] = rds.get_all_dbinstances()
+                return pmp_aws_rds.timed('DescribeDBInstances', rds.get_all_dbinstances)
             except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
                 debug(msg)
 
-        return result
+        return dict((reg, info) for (reg, info) in pmp_aws_rds.map_regions(describe, self.regions_list)
+                    if info is not None)
+
+    @property
+    def cloudwatch(self):
+        """Rate limited CloudWatch connection to the instance region"""
+        if not self._cloudwatch:
+            self._cloudwatch = pmp_aws_rds.CloudWatch(self.region, self.profile, self.status_dir, self.rate, debug)
+
+        return self._cloudwatch
+
+    def get_metrics(self, queries, end_time):
+        """Get the last datapoint of several RDS metrics with a single CloudWatch request.
+
+        queries is a list of (id, metric, statistic, period, time window) with
+        times in seconds, returns a dict of id to the list of (timestamp, value).
+        """
+        return fetch_metrics(self.cloudwatch, [(self, queries)], end_time)[0]
+
+
+class Cluster(RDS):
+
+    """Aurora DB cluster, checked together with all its members"""
+
+    DIMENSION = 'DBClusterIdentifier'
+
+    def __init__(self, region, profile=None, identifier=None, status_dir=pmp_aws_rds.STATUS_DIR,
+                 rate=pmp_aws_rds.CW_RATE):
+        """Get the Aurora DB cluster details and its members"""
+        RDS.__init__(self, region, profile, None, status_dir, rate)
+        self.identifier = identifier
+        self.described = True
+        if self.region == 'all':
+            region, self.info = pmp_aws_rds.locate_cluster(identifier, self.regions_list, profile, status_dir, debug)
+            if region:
+                self.region = region
+        else:
+            self.info = pmp_aws_rds.describe_cluster(self.region, profile, identifier, debug)
+
+        self.members = []
+        self.roles = {}
+        for member in (self.info or {}).get('members', []):
+            self.members.append(RDS(self.region, profile, member['id'], status_dir, rate, describe=False,
+                                    cluster=self))
+            self.roles[member['id']] = 'writer' if member['writer'] else 'reader'
+
+    def get_info(self):
+        """Get Aurora DB cluster info"""
+        return self.info
+
+    def describe_members(self):
+        """Get the details of all the members with one request"""
+        instances = pmp_aws_rds.get_cluster_instances(self.region, self.profile, self.identifier, debug) or []
+        found = dict((inst.id, inst) for inst in instances)
+        for member in self.members:
+            member.described = True
+            member.info = [found[member.identifier]] if member.identifier in found else None
+
+
+def fetch_metrics(cloudwatch, requests, end_time):
+    """Get the datapoints of several instances or clusters with a single CloudWatch request.
+
+    requests is a list of (RDS instance or cluster, queries) with queries as
+    taken by RDS.get_metrics(), returns the dict of id to datapoints of each.
+    """
+    batch = []
+    for num, (rds, queries) in enumerate(requests):
+        batch.extend({'Id': 'q%s_%s' % (num, q[0]), 'MetricName': q[1], 'Stat': q[2], 'Period': q[3],
+                      'Dimensions': {rds.DIMENSION: rds.identifier}} for q in queries)
+
+    if not batch:
+        return [{} for _ in requests]
 
-    def get_metric(self, metric, start_time, end_time, step):
-        """Get RDS metric from CloudWatch"""
-        cw_conn = boto.ec2.cloudwatch.connect_to_region(self.region, profile_name=self.profile)
-        result = cw_conn.get_metric_statistics(
-            step,
-            start_time,
-            end_time,
-            metric,
-            'AWS/RDS',
-            'Average',
-            dimensions={'DBInstanceIdentifier': [self.identifier]}
-        )
-        if result:
-            if len(result) > 1:
-                # Get the last point
-                result = sorted(result, key=lambda k: k['Timestamp'])
-                result.reverse()
+    window = max(q[4] for (_, queries) in requests for q in queries)
+    data = cloudwatch.get_metric_data(batch, end_time - datetime.timedelta(seconds=window), end_time)
+    results = []
+    for num, (rds, queries) in enumerate(requests):
+        result = {}
+        for ident, metric, stat, period, window in queries:
+            # Only the periods overlapping the window of the query, like GetMetricStatistics does
+            since = end_time - datetime.timedelta(seconds=window + period)
+            result[ident] = [(stamp, val) for (stamp, val) in data['q%s_%s' % (num, ident)] if stamp > since]
 
-            result = float('%.2f' % result[0]['Average'])
+        results.append(result)
 
-        return result
+    return results
 
 
 def debug(val):
@@ -101,6 +245,376 @@ def debug(val):
         print 'DEBUG: %s' % val
 
 
+def last_value(values, ident):
+    """The last datapoint fetched for a query, None if there is none"""
+    if values.get(ident):
+        return values[ident][-1][1]
+
+    return None
+
+
+def suffix(stat):
+    """Suffix of the names of a check with a statistic other than the average"""
+    if stat == 'Average':
+        return ''
+
+    return '_' + stat.replace('.', '_')
+
+
+def metric_queries(metric, stat, rds, options):
+    """CloudWatch datapoints a check needs: list of (id, metric, statistic, period, time window),
+    times in seconds
+    """
+    if metric == 'load':
+        # Some stats are delaying to update on CloudWatch.
+        # Let's pick a few points for 1-min load avg and get the last point.
+        return [('load1' + suffix(stat), METRICS[metric], stat, 60, 300),
+                ('load5' + suffix(stat), METRICS[metric], stat, 300, 300),
+                ('load15' + suffix(stat), METRICS[metric], stat, 900, 900)]
+    elif metric in FORECASTS:
+        if get_forecast(rds, metric, stat, options, options.forecast_ttl * 60):
+            return []
+
+        return [(metric + suffix(stat), METRICS[metric], stat, FORECAST_PERIOD, options.window * 3600)]
+    elif metric not in ('status', 'db_load'):
+        return [(metric + suffix(stat), METRICS[metric], stat, options.avg * 60, options.time * 60)]
+
+    return []
+
+
+def parse_thresholds(metric, warn, crit, options):
+    """Validate the thresholds of a check, return them parsed or raise ValueError"""
+    if metric == 'status':
+        return None, None
+    elif metric == 'load':
+        try:
+            warns = [float(x) for x in warn.split(',')]
+            crits = [float(x) for x in crit.split(',')]
+            fail = len(warns) + len(crits)
+        except:
+            fail = 0
+
+        if fail != 6:
+            raise ValueError('Warning and critical thresholds should be 3 comma separated numbers, e.g. 20,15,10')
+
+        for j in range(3):
+            if warns[j] > crits[j]:
+                raise ValueError('Parameter inconsistency: warning threshold is greater than critical.')
+
+        return warns, crits
+    elif metric in FORECASTS:
+        try:
+            warn = float(warn)
+            crit = float(crit)
+        except:
+            raise ValueError('Warning and critical thresholds should be numbers of hours.')
+
+        if crit > warn:
+            raise ValueError('Parameter inconsistency: critical threshold is greater than warning.')
+
+        return warn, crit
+    elif metric in ('storage', 'memory'):
+        try:
+            warn = float(warn)
+            crit = float(crit)
+        except:
+            raise ValueError('Warning and critical thresholds should be integers.')
+
+        if crit > warn:
+            raise ValueError('Parameter inconsistency: critical threshold is greater than warning.')
+
+        if options.unit not in UNITS:
+            raise ValueError('Unit is not valid.')
+
+        return warn, crit
+    else:
+        try:
+            warn = float(warn)
+            crit = float(crit)
+        except:
+            raise ValueError('Warning and critical thresholds should be numbers.')
+
+        if warn > crit:
+            raise ValueError('Parameter inconsistency: warning threshold is greater than critical.')
+
+        return warn, crit
+
+
+def check_status(metric, stat, rds, values, warn, crit, options):
+    """RDS Status"""
+    if options.events:
+        return check_events(rds, options)
+
+    info = rds.get_info()
+    if not info:
+        return UNKNOWN, 'Unable to get RDS instance', None
+
+    try:
+        version = info.EngineVersion
+    except:
+        version = info.engine_version
+
+    return OK, '%s %s. Status: %s' % (info.engine, version, info.status), None
+
+
+def check_events(rds, options):
+    """RDS Status from the event table of the region"""
+    events = pmp_aws_rds.EventStatus(rds.region, rds.profile, options.statusdir, debug)
+    inst = events.get(rds.identifier)
+    if not inst or not inst['state']:
+        return UNKNOWN, 'Unable to get RDS instance', None
+
+    note = 'Status: %s' % inst['state']
+    if inst['engine']:
+        note = '%s %s. %s' % (inst['engine'], inst['version'], note)
+
+    if inst['message']:
+        note = '%s since %s UTC, %s' % (note, datetime.datetime.utcfromtimestamp(inst['since']), inst['message'])
+
+    return STATE_STATUS.get(inst['state'], OK), note, None
+
+
+def check_cluster_status(metric, stat, cluster, values, warn, crit, options):
+    """Aurora DB cluster Status"""
+    info = cluster.get_info()
+    if not info:
+        return UNKNOWN, 'Unable to get Aurora DB cluster', None
+
+    engine = ' '.join(val for val in (info['engine'], info['version']) if val)
+    readers = len([role for role in cluster.roles.values() if role == 'reader'])
+    return OK, '%s. Status: %s, %s members, %s readers' % (engine, info['status'], len(cluster.members),
+                                                            readers), None
+
+
+def check_load(metric, stat, rds, values, warns, crits, options):
+    """RDS Load Average"""
+    status = OK
+    loads = []
+    perf_data = []
+    for j, i in enumerate([1, 5, 15]):
+        load = last_value(values, 'load%s%s' % (i, suffix(stat)))
+        if load is None:
+            return UNKNOWN, 'Unable to get RDS statistics', None
+
+        load = float('%.2f' % load)
+        loads.append(str(load))
+        perf_data.append('load%s%s=%s;%s;%s;0;100' % (i, suffix(stat), load, warns[j], crits[j]))
+
+        # Compare thresholds
+        if status != CRITICAL:
+            if load >= crits[j]:
+                status = CRITICAL
+            elif load >= warns[j]:
+                status = WARNING
+
+    label = 'Load average' if stat == 'Average' else 'Load %s' % stat
+    return status, '%s: %s%%' % (label, '%, '.join(loads)), ' '.join(perf_data)
+
+
+def instance_details(rds, options):
+    """Class and allocated storage of the instance, (None, None) if unknown.
+
+    With --events they come from the event table of the region, which saves
+    describing the instance.
+    """
+    if options.events and not rds.described:
+        inst = pmp_aws_rds.EventStatus(rds.region, rds.profile, options.statusdir, debug).get(rds.identifier)
+        if inst and inst.get('class'):
+            return inst['class'], inst['storage']
+
+    info = rds.get_info()
+    if not info:
+        return None, None
+
+    return info.instance_class, info.allocated_storage
+
+
+def check_free(metric, stat, rds, values, warn, crit, options):
+    """RDS Free Storage and RDS Free Memory"""
+    instance_class, allocated_storage = instance_details(rds, options)
+    free = last_value(values, metric + suffix(stat))
+    if not instance_class or free is None:
+        return UNKNOWN, 'Unable to get RDS details and statistics', None
+
+    if metric == 'storage':
+        storage = float(allocated_storage)
+    elif metric == 'memory':
+        storage = pmp_aws_rds.instance_classes(options.classes, debug).get(instance_class)
+        if not storage:
+            return UNKNOWN, 'Unknown DB instance class "%s", set its memory in %s' % (instance_class,
+                                                                                   options.classes), None
+
+    free = '%.2f' % (free / 1024 ** 3)
+    free_pct = '%.2f' % (float(free) / storage * 100)
+    if options.unit == 'percent':
+        val = float(free_pct)
+        val_max = 100
+    elif options.unit == 'GB':
+        val = float(free)
+        val_max = storage
+
+    # Compare thresholds
+    status = OK
+    if val <= crit:
+        status = CRITICAL
+    elif val <= warn:
+        status = WARNING
+
+    label = metric if stat == 'Average' else '%s %s' % (metric, stat)
+    note = 'Free %s: %s GB (%.0f%%) of %s GB' % (label, free, float(free_pct), storage)
+    return status, note, 'free_%s%s=%s;%s;%s;0;%s' % (metric, suffix(stat), val, warn, crit, val_max)
+
+
+def check_gauge(metric, stat, rds, values, warn, crit, options):
+    """RDS I/O latency, disk queue depth, replica lag and swap usage, the higher the worse"""
+    unit, scale, label = GAUGES[metric]
+    if stat != 'Average':
+        label = '%s %s' % (label, stat)
+
+    val = last_value(values, metric + suffix(stat))
+    if val is None:
+        if metric not in REPLICATION_GAUGES:
+            return UNKNOWN, 'Unable to get RDS statistics', None
+
+        # CloudWatch has no datapoints of ReplicaLag for instances which do not replicate,
+        # nor of AuroraReplicaLagMaximum for clusters without readers
+        val = 0.0
+
+    val = float('%.2f' % (val * scale))
+    status = OK
+    if val >= crit:
+        status = CRITICAL
+    elif val >= warn:
+        status = WARNING
+
+    perf_data = '%s%s=%s%s;%s;%s;0' % (metric, suffix(stat), val, unit, warn, crit)
+    return status, '%s: %s%s' % (label, val, unit), perf_data
+
+
+def shorten(text, length=60):
+    """SQL text on one line, cut to length"""
+    text = ' '.join(text.split())
+    if len(text) > length:
+        return text[:length - 3] + '...'
+
+    return text
+
+
+def check_db_load(metric, stat, rds, values, warn, crit, options):
+    """RDS DB load, the average active sessions, and what they wait on from Performance Insights"""
+    pi = pmp_aws_rds.PerformanceInsights(rds.region, rds.profile, options.statusdir, options.rate, debug)
+    end_time = datetime.datetime.utcnow()
+    try:
+        resource = pi.resource_id(rds.identifier, lambda: getattr(rds.get_info(), 'DbiResourceId', None))
+        if not resource:
+            return UNKNOWN, 'Unable to get RDS instance', None
+
+        top = pi.top_load(resource, end_time - datetime.timedelta(minutes=options.time), end_time)
+    except boto.exception.BotoServerError as err:
+        return UNKNOWN, 'Unable to get Performance Insights: %s' % (err.error_message or err.reason), None
+
+    load = float('%.2f' % top['load'])
+    status = OK
+    if load >= crit:
+        status = CRITICAL
+    elif load >= warn:
+        status = WARNING
+
+    note = 'DB load: %.2f sessions, waits: %s' % (load, ', '.join('%s %.2f' % wait for wait in top['waits'])
+                                                  or 'none')
+    if top['sql']:
+        digest, val, text = top['sql'][0]
+        note = '%s, top SQL: %.2f %s' % (note, val, shorten(text or digest))
+
+    perf_data = ['db_load=%s;%s;%s;0' % (load, warn, crit)]
+    # Wait event names like io/table/sql/handler are not valid perfdata labels
+    perf_data.extend('wait_%s=%.2f' % (re.sub(r'\W', '_', name), val) for (name, val) in top['waits'])
+    return status, note, ' '.join(perf_data)
+
+
+def linear_fit(points):
+    """Least squares line through (timestamp, value) datapoints.
+
+    Returns a dict with the value of the line at the last timestamp (epoch time)
+    and its slope per second.
+    """
+    end = calendar.timegm(points[-1][0].timetuple())
+    xs = [calendar.timegm(stamp.timetuple()) - end for (stamp, _) in points]
+    ys = [val for (_, val) in points]
+    n = len(points)
+    sum_x = sum(xs)
+    sum_y = sum(ys)
+    sum_xx = sum(x * x for x in xs)
+    sum_xy = sum(x * y for (x, y) in zip(xs, ys))
+    slope = (n * sum_xy - sum_x * sum_y) / float(n * sum_xx - sum_x * sum_x)
+    return {'time': end, 'value': (sum_y - slope * sum_x) / n, 'slope': slope, 'fetched': time.time()}
+
+
+def forecast_state(rds, metric, stat, options):
+    """Forecast cache and the key of a check in it"""
+    # Instances of different accounts may have the same identifier
+    key = '%s/%s/%s/%s%s/%sh' % (rds.profile or '', rds.region, rds.identifier, metric, suffix(stat), options.window)
+    return pmp_aws_rds.StateFile(options.statusdir, 'forecasts.json'), key
+
+
+def get_forecast(rds, metric, stat, options, ttl=None):
+    """Cached trend of a check, None if there is none or it is older than ttl seconds"""
+    state, key = forecast_state(rds, metric, stat, options)
+    fit = state.read().get(key)
+    if fit and ttl is not None and fit['fetched'] < time.time() - ttl:
+        return None
+
+    return fit
+
+
+def check_forecast(metric, stat, rds, values, warn, crit, options):
+    """RDS Free Storage and Free Memory time to full, projected from the trend over the window"""
+    ident = metric + suffix(stat)
+    if ident in values:
+        if len(values[ident]) < 3:
+            return UNKNOWN, 'Not enough datapoints to forecast', None
+
+        fit = linear_fit(values[ident])
+        state, key = forecast_state(rds, metric, stat, options)
+        state.update(lambda data: data.__setitem__(key, fit))
+    else:
+        # Fitted by a previous run not long ago
+        fit = get_forecast(rds, metric, stat, options)
+        if not fit:
+            return UNKNOWN, 'Unable to get RDS statistics', None
+
+    free = max(0.0, fit['value'] + fit['slope'] * (time.time() - fit['time']))
+    if fit['slope'] < 0:
+        hours = min(FORECAST_HORIZON, free / -fit['slope'] / 3600)
+        trend = 'full in %.1f hours' % hours
+    else:
+        hours = FORECAST_HORIZON
+        trend = 'not decreasing'
+
+    status = OK
+    if hours <= crit:
+        status = CRITICAL
+    elif hours <= warn:
+        status = WARNING
+
+    name = metric.split('_')[0]
+    note = 'Free %s: %.2f GB, %+.2f GB/h over %sh, %s' % (name, free / 1024 ** 3, fit['slope'] * 3600 / 1024 ** 3,
+                                                          options.window, trend)
+    return status, note, '%s_hours_to_full%s=%.1f;%s;%s;0' % (name, suffix(stat), hours, warn, crit)
+
+
+CHECKS = {
+    'status': check_status,
+    'load': check_load,
+    'storage': check_free,
+    'memory': check_free,
+    'storage_forecast': check_forecast,
+    'memory_forecast': check_forecast,
+    'db_load': check_db_load,
+}
+CHECKS.update(dict((metric, check_gauge) for metric in GAUGES))
+
+
 def main():
     """Main function"""
     global options
@@ -112,77 +626,6 @@ def main():
         UNKNOWN: 'UNK'
     }
 
-    # DB instance classes as listed on
-    # http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.DBInstanceClass.html
-    db_classes = {
-        'db.t1.micro': 0.615,
-        'db.m1.small': 1.7,
-        'db.m1.medium': 3.75,
-        'db.m1.large': 7.5,
-        'db.m1.xlarge': 15,
-        'db.m4.large': 8,
-        'db.m4.xlarge': 16,
-        'db.m4.2xlarge': 32,
-        'db.m4.4xlarge': 64,
-        'db.m4.10xlarge': 160,
-        'db.m4.16xlarge': 256,
-        'db.m5.large': 8,
-        'db.m5.xlarge': 16,
-        'db.m5.2xlarge': 32,
-        'db.m5.4xlarge': 64,
-        'db.m5.12xlarge': 192,
-        'db.m5.24xlarge': 384,
-        'db.r3.large': 15,
-        'db.r3.xlarge': 30.5,
-        'db.r3.2xlarge': 61,
-        'db.r3.4xlarge': 122,
-        'db.r3.8xlarge': 244,
-        'db.r4.large': 15.25,
-        'db.r4.xlarge': 30.5,
-        'db.r4.2xlarge': 61,
-        'db.r4.4xlarge': 122,
-        'db.r4.8xlarge': 244,
-        'db.r4.16xlarge': 488,
-        'db.r5.large': 16,
-        'db.r5.xlarge': 32,
-        'db.r5.2xlarge': 64,
-        'db.r5.4xlarge': 128,
-        'db.r5.12xlarge': 384,
-        'db.r5.24xlarge': 768,
-        'db.t2.micro': 1,
-        'db.t2.small': 2,
-        'db.t2.medium': 4,
-        'db.t2.large': 8,
-        'db.t2.xlarge': 16,
-        'db.t2.2xlarge': 32,
-        'db.m3.medium': 3.75,
-        'db.m3.large': 7.5,
-        'db.m3.xlarge': 15,
-        'db.m3.2xlarge': 30,
-        'db.m2.xlarge': 17.1,
-        'db.m2.2xlarge': 34.2,
-        'db.m2.4xlarge': 68.4,
-        'db.cr1.8xlarge': 244,
-        'db.x1.16xlarge': 976,
-        'db.x1.32xlarge': 1952,
-        'db.x1e.xlarge': 122,
-        'db.x1e.2xlarge': 244,
-        'db.x1e.4xlarge': 488,
-        'db.x1e.8xlarge': 976,
-        'db.x1e.16xlarge': 1952,
-        'db.x1e.32xlarge': 3904,
-    }
-
-    # RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
-    metrics = {
-        'status': 'RDS availability',
-        'load': 'CPUUtilization',
-        'memory': 'FreeableMemory',
-        'storage': 'FreeStorageSpace'
-    }
-
-    units = ('percent', 'GB')
-
     # Parse options
     parser = optparse.OptionParser()
     parser.add_option('-l', '--list', help='list of all DB instances',
@@ -193,20 +636,43 @@ def main():
                       help='AWS region. Default: us-east-1. If set to "all", we try to detect the instance region '
                            'across all of them, note this will be slower than if you specify the region explicitly.')
     parser.add_option('-i', '--ident', help='DB instance identifier')
+    parser.add_option('-C', '--cluster', help='Aurora DB cluster identifier, to check the cluster and all its '
+                      'instances at once instead of a DB instance')
+    parser.add_option('--statusdir', default=pmp_aws_rds.STATUS_DIR,
+                      help='directory to keep state between runs, e.g. the instance to region index. '
+                           'Default: %s' % pmp_aws_rds.STATUS_DIR)
+    parser.add_option('--rate', type='float', default=pmp_aws_rds.CW_RATE,
+                      help='CloudWatch requests per second shared by all the checks using the same status '
+                           'directory, 0 disables the limit. Default: %s' % pmp_aws_rds.CW_RATE)
     parser.add_option('-p', '--print', help='print status and other details for a given DB instance',
                       action='store_true', default=False, dest='printinfo')
-    parser.add_option('-m', '--metric', help='metric to check: [%s]' % ', '.join(metrics.keys()))
+    parser.add_option('-m', '--metric', help='metric to check: [%s], optionally followed by a percentile to check '
+                      'instead of the average, e.g. read_latency:p99. Several comma separated metrics are checked '
+                      'at once, their thresholds are separated by "/" in the same order' % ', '.join(METRICS.keys()))
     parser.add_option('-w', '--warn', help='warning threshold')
     parser.add_option('-c', '--crit', help='critical threshold')
     parser.add_option('-u', '--unit', help='unit of thresholds for "storage" and "memory" metrics: [%s].'
-                      'Default: percent' % ', '.join(units), default='percent')
+                      'Default: percent' % ', '.join(UNITS), default='percent')
     parser.add_option('-t', '--time', help='time period in minutes to query. Default: 5',
                       type='int', default=5)
     parser.add_option('-a', '--avg', help='time average in minutes to request. Default: 1',
                       type='int', default=1)
+    parser.add_option('-e', '--events', help='get the "status" metric from the RDS events of the region, which are '
+                      'polled once a minute for all the checks, instead of describing the instance each time',
+                      action='store_true', default=False)
+    parser.add_option('--window', help='hours of datapoints to fit the trend of "storage_forecast" and '
+                      '"memory_forecast" metrics on. Default: 24', type='int', default=24)
+    parser.add_option('--classes', default=pmp_aws_rds.CLASSES_FILE,
+                      help='file with the memory of DB instance classes not known or inferred correctly, one '
+                           '"class = GB" per line. Default: %s' % pmp_aws_rds.CLASSES_FILE)
+    parser.add_option('--forecast-ttl', help='minutes to reuse a forecast for before querying again. Default: 30',
+                      type='int', default=30, dest='forecast_ttl')
     parser.add_option('-f', '--forceunknown', help='force alerts on unknown status. This prevents issues related to '
                       'AWS Cloudwatch throttling limits Default: False',
                       action='store_true', default=False)
+    parser.add_option('--stats-log', dest='stats_log',
+                      help='file to append the AWS API calls, retries, throttles, datapoints and time of each run '
+                           'to, as a JSON line')
     parser.add_option('-d', '--debug', help='enable debug output',
                       action='store_true', default=False)
     options, _ = parser.parse_args()
@@ -214,7 +680,23 @@ def main():
     if options.debug:
         boto.set_stream_logger('boto')
 
-    rds = RDS(region=options.region, profile=options.profile, identifier=options.ident)
+    # Metrics are optionally followed by the statistic, e.g. read_latency:p99
+    specs = (options.metric or '').split(',')
+    try:
+        metrics = [pmp_aws_rds.split_statistic(spec) for spec in specs]
+    except ValueError:
+        metrics = []
+
+    if options.cluster and not options.ident:
+        rds = Cluster(region=options.region, profile=options.profile, identifier=options.cluster,
+                      status_dir=options.statusdir, rate=options.rate)
+    else:
+        # The event table has the details, and forecasts need none
+        describe = not options.events and bool([spec for spec in metrics if spec[0] not in FORECASTS])
+        rds = RDS(region=options.region, profile=options.profile, identifier=options.ident,
+                  status_dir=options.statusdir, rate=options.rate, describe=describe)
+
+    checked = [spec for spec in metrics if spec[0] != 'status']
 
     # Check args
     if len(sys.argv) == 1:
@@ -225,172 +707,167 @@ def main():
         print 'List of all DB instances in %s region(s):' % (options.region,)
         pprint.pprint(info)
         sys.exit()
-    elif not options.ident:
+    elif not options.ident and not options.cluster:
         parser.print_help()
         parser.error('DB identifier is not set.')
+    elif options.ident and options.cluster:
+        parser.print_help()
+        parser.error('Either a DB instance or a cluster identifier can be set.')
     elif options.printinfo:
         info = rds.get_info()
-        if info:
+        if info and options.cluster:
+            pprint.pprint(info)
+        elif info:
             pprint.pprint(vars(info))
         else:
-            print 'No DB instance "%s" found on your AWS account and %s region(s).' % (options.ident, options.region)
+            print 'No DB %s "%s" found on your AWS account and %s region(s).' % (
+                'cluster' if options.cluster else 'instance', options.ident or options.cluster, options.region)
 
         sys.exit()
-    elif not options.metric or options.metric not in metrics.keys():
+    elif not metrics or [spec for spec in metrics if spec[0] not in METRICS.keys()] or \
+            len(set(metrics)) != len(metrics):
         parser.print_help()
         parser.error('Metric is not set or not valid.')
-    elif not options.warn and options.metric != 'status':
+    elif [spec for spec in metrics if spec[0] == 'db_load' and spec[1] != 'Average']:
+        parser.print_help()
+        parser.error('The db_load metric has no percentiles.')
+    elif not options.cluster and [spec for spec in metrics if spec[0] in CLUSTER_METRICS]:
+        parser.print_help()
+        parser.error('Metrics %s can be checked on a cluster only.' % ', '.join(CLUSTER_METRICS))
+    elif not options.warn and checked:
         parser.print_help()
         parser.error('Warning threshold is not set.')
-    elif not options.crit and options.metric != 'status':
+    elif not options.crit and checked:
         parser.print_help()
         parser.error('Critical threshold is not set.')
-    elif options.avg <= 0 and options.metric != 'status':
+    elif options.avg <= 0 and checked:
         parser.print_help()
         parser.error('Average must be greater than zero.')
-    elif options.time <= 0 and options.metric != 'status':
+    elif options.time <= 0 and checked:
         parser.print_help()
         parser.error('Time must be greater than zero.')
+    elif not 0 < options.window <= 120 and [spec for spec in metrics if spec[0] in FORECASTS]:
+        # GetMetricStatistics returns 1440 datapoints at most
+        parser.print_help()
+        parser.error('Window must be between 1 and 120 hours.')
+
+    # Thresholds of several metrics are given in the same order separated by "/"
+    if checked:
+        warns = options.warn.split('/')
+        crits = options.crit.split('/')
+        if len(warns) != len(metrics) or len(crits) != len(metrics):
+            parser.error('Specify warning and critical thresholds for each of %s metrics separated by "/".'
+                         % len(metrics))
+    else:
+        warns = crits = [None] * len(metrics)
 
-    now = datetime.datetime.utcnow()
-    status = None
-    note = ''
-    perf_data = None
-
-    # RDS Status
-    if options.metric == 'status':
-        info = rds.get_info()
-        if not info:
-            status = UNKNOWN
-            note = 'Unable to get RDS instance'
-        else:
-            status = OK
-            try:
-                version = info.EngineVersion
-            except:
-                version = info.engine_version
-
-            note = '%s %s. Status: %s' % (info.engine, version, info.status)
-
-    # RDS Load Average
-    elif options.metric == 'load':
-        # Check thresholds
-        try:
-            warns = [float(x) for x in options.warn.split(',')]
-            crits = [float(x) for x in options.crit.split(',')]
-            fail = len(warns) + len(crits)
-        except:
-            fail = 0
-
-        if fail != 6:
-            parser.error('Warning and critical thresholds should be 3 comma separated numbers, e.g. 20,15,10')
-
-        loads = []
-        fail = False
-        j = 0
-        perf_data = []
-        for i in [1, 5, 15]:
-            if i == 1:
-                # Some stats are delaying to update on CloudWatch.
-                # Let's pick a few points for 1-min load avg and get the last point.
-                points = 5
-            else:
-                points = i
-
-            load = rds.get_metric(metrics[options.metric], now - datetime.timedelta(seconds=points * 60), now, i * 60)
-            if not load:
-                status = UNKNOWN
-                note = 'Unable to get RDS statistics'
-                perf_data = None
-                break
-
-            loads.append(str(load))
-            perf_data.append('load%s=%s;%s;%s;0;100' % (i, load, warns[j], crits[j]))
-
-            # Compare thresholds
-            if not fail:
-                if warns[j] > crits[j]:
-                    parser.error('Parameter inconsistency: warning threshold is greater than critical.')
-                elif load >= crits[j]:
-                    status = CRITICAL
-                    fail = True
-                elif load >= warns[j]:
-                    status = WARNING
-
-            j = j + 1
-
-        if status != UNKNOWN:
-            if status is None:
-                status = OK
-
-            note = 'Load average: %s%%' % '%, '.join(loads)
-            perf_data = ' '.join(perf_data)
-
-    # RDS Free Storage
-    # RDS Free Memory
-    elif options.metric in ['storage', 'memory']:
-        # Check thresholds
+    thresholds = []
+    for (metric, stat), warn, crit in zip(metrics, warns, crits):
         try:
-            warn = float(options.warn)
-            crit = float(options.crit)
-        except:
-            parser.error('Warning and critical thresholds should be integers.')
-
-        if crit > warn:
-            parser.error('Parameter inconsistency: critical threshold is greater than warning.')
-
-        if options.unit not in units:
-            parser.print_help()
-            parser.error('Unit is not valid.')
-
-        info = rds.get_info()
-        free = rds.get_metric(metrics[options.metric], now - datetime.timedelta(seconds=options.time * 60),
-                              now, options.avg * 60)
-        if not info or not free:
-            status = UNKNOWN
-            note = 'Unable to get RDS details and statistics'
+            thresholds.append(parse_thresholds(metric, warn, crit, options))
+        except ValueError as err:
+            parser.error(err)
+
+    # What each metric is checked on: the instance, or the cluster and its members
+    targets = []
+    for metric, stat in metrics:
+        if not options.cluster or metric in CLUSTER_METRICS:
+            targets.append([rds])
+        elif metric == 'status':
+            targets.append([rds] + rds.members)
         else:
-            if options.metric == 'storage':
-                storage = float(info.allocated_storage)
-            elif options.metric == 'memory':
-                try:
-                    storage = db_classes[info.instance_class]
-                except:
-                    print 'Unknown DB instance class "%s"' % info.instance_class
-                    sys.exit(CRITICAL)
-
-            free = '%.2f' % (free / 1024 ** 3)
-            free_pct = '%.2f' % (float(free) / storage * 100)
-            if options.unit == 'percent':
-                val = float(free_pct)
-                val_max = 100
-            elif options.unit == 'GB':
-                val = float(free)
-                val_max = storage
-
-            # Compare thresholds
-            if val <= crit:
-                status = CRITICAL
-            elif val <= warn:
-                status = WARNING
-
-            if status is None:
-                status = OK
+            targets.append(rds.members)
 
-            note = 'Free %s: %s GB (%.0f%%) of %s GB' % (options.metric, free, float(free_pct), storage)
-            perf_data = 'free_%s=%s;%s;%s;0;%s' % (options.metric, val, warn, crit, val_max)
+    # Datapoints of all the metrics of all the instances are fetched at once
+    now = datetime.datetime.utcnow()
+    requests = []
+    for target in [rds] + getattr(rds, 'members', []):
+        queries = []
+        for (metric, stat), checked_on in zip(metrics, targets):
+            if target in checked_on:
+                queries.extend(metric_queries(metric, stat, target, options))
+
+        if queries:
+            requests.append((target, queries))
+
+    values = dict(zip([req[0] for req in requests], fetch_metrics(rds.cloudwatch, requests, now))) if requests else {}
+
+    # Results of the checks: (metric spec, instance or cluster, (status, note, perfdata))
+    results = []
+    for spec, (metric, stat), (warn, crit), checked_on in zip(specs, metrics, thresholds, targets):
+        for target in checked_on:
+            check = CHECKS[metric]
+            if metric == 'status' and isinstance(target, Cluster):
+                check = check_cluster_status
+
+            results.append((spec, target, check(metric, stat, target, values.get(target, {}), warn, crit, options)))
+
+    # The worst status wins, unknown ones count only when forced to
+    severity = [OK, UNKNOWN, WARNING, CRITICAL]
+    if not options.forceunknown:
+        severity.remove(UNKNOWN)
+        severity.insert(0, UNKNOWN)
+
+    def worst(checks):
+        return max([res[2][0] for res in checks] or [UNKNOWN], key=severity.index)
+
+    details = None
+    if options.cluster and not rds.info:
+        status, note, perf_data = UNKNOWN, 'Unable to get Aurora DB cluster', None
+    elif len(results) == 1 and not options.cluster:
+        status, note, perf_data = results[0][2]
+    elif not options.cluster:
+        status = worst(results)
+        note = ', '.join('%s %s' % (spec, short_status[res[0]]) for (spec, target, res) in results)
+        # Nagios long output, one line per metric
+        details = '\n'.join('%s: %s %s' % (spec, short_status[res[0]], res[1]) for (spec, target, res) in results)
+        perf_data = ' '.join(res[2] for (spec, target, res) in results if res[2])
+    else:
+        status = worst(results)
+        note = 'Aurora DB cluster %s, %s members: %s' % (
+            options.cluster, len(rds.members),
+            ', '.join('%s %s' % (spec, short_status[worst([res for res in results if res[0] == spec])])
+                      for spec in specs))
+        # Nagios long output, one line per metric of the cluster and of each member
+        details = '\n'.join('%s%s %s: %s %s' % (target.identifier,
+                                                 ' (%s)' % rds.roles[target.identifier] if target is not rds else '',
+                                                 spec, short_status[res[0]], res[1])
+                             for (spec, target, res) in results)
+        # Perfdata labels are prefixed with the instance or cluster identifier
+        perf_data = ' '.join('%s_%s' % (target.identifier, item) for (spec, target, res) in results if res[2]
+                             for item in res[2].split())
+
+    if details is not None and status == UNKNOWN:
+        perf_data = None
+
+    # Time spent waiting for the CloudWatch rate limiter and throttling backoff
+    if rds._cloudwatch:
+        debug('Waited for CloudWatch: %.2f sec.' % rds.cloudwatch.waited)
+        if perf_data:
+            perf_data = '%s cloudwatch_wait=%.2fs' % (perf_data, rds.cloudwatch.waited)
+
+    # AWS API usage of the run
+    debug('AWS API calls: %s' % pmp_aws_rds.stats.apis)
+    if perf_data:
+        perf_data = '%s %s' % (perf_data, pmp_aws_rds.stats.perfdata())
+
+    if options.stats_log:
+        pmp_aws_rds.stats.log(options.stats_log, script='pmp-check-aws-rds.py', region=rds.region,
+                              ident=options.ident, metric=options.metric, status=status)
 
     # Final output
     if status != UNKNOWN and perf_data:
         print '%s %s | %s' % (short_status[status], note, perf_data)
     elif status == UNKNOWN and not options.forceunknown:
         print '%s %s | null' % ('OK', note)
-        sys.exit(0)
+        status = OK
     else:
         print '%s %s' % (short_status[status], note)
 
-    sys.exit(status)
+    if details:
+        print details
 
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
@@ -421,18 +898,53 @@ pmp-check-aws-rds.py - Check Amazon RDS metrics.
                           note this will be slower than you specify the region.
     -i IDENT, --ident=IDENT
                           DB instance identifier
+    -C CLUSTER, --cluster=CLUSTER
+                          Aurora DB cluster identifier, to check the cluster
+                          and all its instances at once instead of a DB
+                          instance
+    --statusdir=STATUSDIR
+                          directory to keep state between runs, e.g. the
+                          instance to region index. Default:
+                          /tmp/pmp-aws-rds-UID
+    --rate=RATE           CloudWatch requests per second shared by all the
+                          checks using the same status directory, 0 disables
+                          the limit. Default: 20
     -p, --print           print status and other details for a given DB instance
     -m METRIC, --metric=METRIC
-                          metric to check: [status, load, storage, memory]
+                          metric to check: [status, load, storage, memory,
+                          read_latency, write_latency, disk_queue,
+                          replica_lag, swap, storage_forecast,
+                          memory_forecast, cluster_replica_lag, volume_used,
+                          db_load],
+                          optionally followed by a
+                          percentile to check instead of the average, e.g.
+                          read_latency:p99. Several comma separated metrics
+                          are checked at once, their thresholds are separated
+                          by "/" in the same order
     -w WARN, --warn=WARN  warning threshold
     -c CRIT, --crit=CRIT  critical threshold
     -u UNIT, --unit=UNIT  unit of thresholds for "storage" and "memory" metrics:
                           [percent, GB]. Default: percent
     -t TIME, --time=TIME  time period in minutes to query. Default: 5
     -a AVG, --avg=AVG     time average in minutes to request. Default: 1
+    -e, --events          get the "status" metric from the RDS events of the
+                          region, which are polled once a minute for all the
+                          checks, instead of describing the instance each time
+    --window=WINDOW       hours of datapoints to fit the trend of
+                          "storage_forecast" and "memory_forecast" metrics on.
+                          Default: 24
+    --classes=CLASSES     file with the memory of DB instance classes not known
+                          or inferred correctly, one "class = GB" per line.
+                          Default: /etc/pmp-aws-rds-classes.conf
+    --forecast-ttl=FORECAST_TTL
+                          minutes to reuse a forecast for before querying
+                          again. Default: 30
     -f, --forceunknown    force alerts on unknown status. This prevents issues
                           related to AWS Cloudwatch throttling limits Default:
                           False
+    --stats-log=STATS_LOG
+                          file to append the AWS API calls, retries, throttles,
+                          datapoints and time of each run to, as a JSON line
     -d, --debug           enable debug output
 
 =head1 REQUIREMENTS
@@ -463,12 +975,22 @@ you can secure this file the following way:
 
 =head1 DESCRIPTION
 
-The plugin provides 4 checks and some options to list and print RDS details:
+The plugin provides 14 checks and some options to list and print RDS details:
 
 * RDS Status
 * RDS Load Average
 * RDS Free Storage
 * RDS Free Memory
+* RDS Read Latency
+* RDS Write Latency
+* RDS Disk Queue Depth
+* RDS Replica Lag
+* RDS Swap Usage
+* RDS Storage Time to Full
+* RDS Memory Time to Full
+* Aurora Replica Lag Maximum
+* Aurora Volume Used
+* Performance Insights DB Load
 
 To get the list of all RDS instances under AWS account:
 
@@ -484,6 +1006,18 @@ of the checks dependent from this one:
   # ./pmp-check-aws-rds.py -i blackbox -m status
   OK mysql 5.1.63. Status: available
 
+With C<--events> the status comes from a table of all the instances of the region
+kept in C<events.json> under the C<--statusdir> directory.  The first check
+describes all the instances of the region at once, then the table is updated
+from the RDS events published since the previous poll, which takes one
+DescribeEvents request per region a minute for all the checks instead of a
+DescribeDBInstances request per instance per check.  The table is rebuilt from
+scratch hourly.  A failover, reboot or maintenance in progress is a warning,
+the storage exhausted, a failed or deleted instance is critical:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m status -e
+  WARN mysql 5.1.63. Status: failover since 2015-04-02 10:41:07 UTC, Multi-AZ instance failover started.
+
 Nagios check for CPU utilization, specify thresholds as percentage of
 1-min., 5-min., 15-min. average accordingly:
 
@@ -497,6 +1031,17 @@ Nagios check for the free memory, specify thresholds as percentage:
   # ./pmp-check-aws-rds.py -i blackbox -m memory -u GB -w 4 -c 2
   OK Free memory: 5.90 GB (9%) of 68 GB | free_memory=5.9;4.0;2.0;0;68
 
+The memory of the instance comes from a table of the DB instance classes, a class
+not listed is inferred from the memory of its family and its size, e.g.
+C<db.r6g.4xlarge> from C<db.r6g.large>.  Classes still unknown or with a different
+memory can be set in the C<--classes> file, one per line:
+
+  # cat /etc/pmp-aws-rds-classes.conf
+  db.r6g.4xlarge = 128
+
+With C<--events>, the class and the allocated storage are taken from the event
+table, so the C<memory> and C<storage> checks do not describe the instance.
+
 Nagios check for the free storage space, specify thresholds as percentage or GB:
 
   # ./pmp-check-aws-rds.py -i blackbox -m storage -w 10 -c 5
@@ -504,6 +1049,89 @@ Nagios check for the free storage space, specify thresholds as percentage or GB:
   # ./pmp-check-aws-rds.py -i blackbox -m storage -u GB -w 10 -c 5
   OK Free storage: 162.55 GB (33%) of 500.0 GB | free_storage=162.55;10.0;5.0;0;500.0
 
+Nagios checks for the I/O, replication and swap, the thresholds are upper limits
+in milliseconds for C<read_latency> and C<write_latency>, outstanding I/O requests
+for C<disk_queue>, seconds for C<replica_lag> and MB for C<swap>.  An instance
+which is not a read replica has no lag:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m read_latency -w 20 -c 50
+  OK Read latency: 4.36ms | read_latency=4.36ms;20.0;50.0;0
+  # ./pmp-check-aws-rds.py -i blackbox -m replica_lag -w 60 -c 300
+  OK Replica lag: 0.0s | replica_lag=0.0s;60.0;300.0;0
+
+Averages hide short spikes, any metric can be followed by a percentile to check
+instead, e.g. the 99th percentile of the read latency over 5 minute periods:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m read_latency:p99 -a 5 -w 20 -c 50
+  OK Read latency p99: 12.75ms | read_latency_p99=12.75ms;20.0;50.0;0
+
+Nagios checks for the time left until the storage or memory is full, the
+thresholds are hours.  The C<storage_forecast> and C<memory_forecast> metrics fit
+a linear trend through the 5-minute datapoints of the last C<--window> hours and
+project when the free space reaches zero, at most 8760 hours (a year) are
+reported.  The fitted trend is kept in C<forecasts.json> under the C<--statusdir>
+directory and reused by the checks for C<--forecast-ttl> minutes, so the long
+window is only queried that often:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m storage_forecast -w 72 -c 24
+  WARN Free storage: 162.55 GB, -2.71 GB/h over 24h, full in 60.0 hours | storage_hours_to_full=60.0;72.0;24.0;0
+
+Several metrics can be checked by one run, all the datapoints are then fetched
+from CloudWatch by a single GetMetricData request instead of one request per
+metric, which matters with many instances.  List the metrics separated by comma
+and their thresholds in the same order separated by "/", C<status> takes any
+placeholder.  The result is the worst status of all the checks, the following
+lines have the details of each:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m status,load,storage -w 0/90,85,80/10 -c 0/98,95,90/5
+  OK status OK, load OK, storage OK | load1=18.36;90.0;98.0;0;100 load5=18.51;85.0;95.0;0;100 load15=15.95;80.0;90.0;0;100 free_storage=32.51;10.0;5.0;0;100
+  status: OK mysql 5.1.63. Status: available
+  load: OK Load average: 18.36%, 18.51%, 15.95%
+  storage: OK Free storage: 162.55 GB (33%) of 500.0 GB
+
+The AWS credentials need the C<cloudwatch:GetMetricData> permission for it,
+as well as for the C<load> check which also needs several datapoints and for
+the percentiles.  Credentials allowed C<cloudwatch:GetMetricStatistics> only
+get the same results from one GetMetricStatistics request per datapoint series
+instead, except the percentiles, which are reported unknown.
+
+An Aurora DB cluster set by C<--cluster> is checked as a whole instead of a
+single instance.  Its members are resolved by one DescribeDBClusters request and
+the metrics of all of them are fetched by one GetMetricData request along with
+the cluster metrics: C<cluster_replica_lag>, the maximum lag of the Aurora
+Replicas in milliseconds, and C<volume_used>, the cluster volume size in GB,
+which are only available this way.  The C<status> metric covers the cluster and
+every member, any other metric is checked on every member.  The status is the
+worst one of all, the following lines have the details of each instance and the
+perfdata labels are prefixed with its identifier:
+
+  # ./pmp-check-aws-rds.py -C blackbox-cluster -m status,load,cluster_replica_lag -w 0/90,85,80/100 -c 0/98,95,90/500
+  OK Aurora DB cluster blackbox-cluster, 2 members: status OK, load OK, cluster_replica_lag OK | blackbox-1_load1=18.36;90.0;98.0;0;100 blackbox-1_load5=18.51;85.0;95.0;0;100 blackbox-1_load15=15.95;80.0;90.0;0;100 blackbox-2_load1=6.12;90.0;98.0;0;100 blackbox-2_load5=6.85;85.0;95.0;0;100 blackbox-2_load15=7.01;80.0;90.0;0;100 blackbox-cluster_cluster_replica_lag=18.2ms;100.0;500.0;0
+  blackbox-cluster status: OK aurora-mysql 5.7.12. Status: available, 2 members, 1 readers
+  blackbox-1 (writer) status: OK aurora-mysql 5.7.12. Status: available
+  blackbox-2 (reader) status: OK aurora-mysql 5.7.12. Status: available
+  blackbox-1 (writer) load: OK Load average: 18.36%, 18.51%, 15.95%
+  blackbox-2 (reader) load: OK Load average: 6.12%, 6.85%, 7.01%
+  blackbox-cluster cluster_replica_lag: OK Replica lag maximum: 18.2ms
+
+CloudWatch publishes C<volume_used> less often than every minute, query a
+longer time period for it with C<-t>, e.g. C<-t 15>.
+
+The C<db_load> check takes the DB load from Performance Insights, which has to
+be enabled on the instance: the average number of active sessions over the last
+C<-t> minutes, with upper limit thresholds.  The load of the top wait events is
+reported as perfdata and the SQL statement with the highest load is shown along:
+
+  # ./pmp-check-aws-rds.py -i blackbox -m db_load -w 8 -c 16
+  OK DB load: 5.54 sessions, waits: io/table/sql/handler 1.95, CPU 1.01, synch/mutex/innodb/buf_pool_mutex 0.83, top SQL: 2.21 SELECT * FROM orders WHERE customer_id = ? | db_load=5.54;8.0;16.0;0 wait_io_table_sql_handler=1.95 wait_CPU=1.01 wait_synch_mutex_innodb_buf_pool_mutex=0.83
+
+It takes one GetResourceMetrics request per run.  The resource id of the
+instance and the SQL text of the statements are looked up once and cached in
+C<resources.json> and C<pi.json> under the C<--statusdir> directory, the SQL
+text for a week.  The AWS
+credentials need the C<pi:GetResourceMetrics> and C<pi:DescribeDimensionKeys>
+permissions for it.
+
 By default, the region is set to ``us-east-1``. You can re-define it globally in boto config or
 specify with -r option. The following command will list all instances across all regions under your AWS account:
 
@@ -514,6 +1142,29 @@ The following command will show the status for the first instance identified as
   # ./pmp-check-aws-rds.py -r all -i blackbox -p
 
 Remember, scanning regions are slower operation than specifying it explicitly.
+The regions are scanned in parallel and the region found is remembered in
+C<regions.json> under the C<--statusdir> directory, so the following runs go
+straight to it and rescan only if the instance is not there anymore.  The
+directory is created readable by its owner only, and one owned by another user
+is refused, so the checks and Cacti polls sharing it should run as one user.
+
+All the checks and Cacti polls sharing the same C<--statusdir> directory also
+share the CloudWatch request budget set by C<--rate>, so hundreds of concurrent
+checks stay below the account API limits instead of being throttled.  A request
+throttled anyway is retried after a random, exponentially growing delay.  The
+time spent waiting is reported as C<cloudwatch_wait> perfdata.
+
+The AWS API usage of the run is reported as perfdata too: C<api_calls> made,
+C<api_retries> of throttled requests, C<api_throttles> received,
+C<api_datapoints> returned by CloudWatch and C<api_time> spent in the calls.
+With C<--stats-log> the same counts, broken down by API, are appended to a file
+as one JSON line per run along with the instance and metrics checked, e.g. to
+find the most expensive checks:
+
+  {"apis": {"DescribeDBInstances": {"calls": 1, "datapoints": 0, "retries": 0, "seconds": 0.121, "throttles": 0},
+   "GetMetricData": {"calls": 2, "datapoints": 36, "retries": 1, "seconds": 0.183, "throttles": 1}},
+   "calls": 3, "datapoints": 36, "ident": "blackbox", "metric": "load,storage", "region": "us-east-1",
+   "retries": 1, "script": "pmp-check-aws-rds.py", "seconds": 0.304, "status": 0, "throttles": 1, "time": 1428045667}
 
 =head1 CONFIGURATION
 
@@ -529,7 +1180,7 @@ Here is the excerpt of potential Nagios config:
   define servicedependency{
         host_name                       blackbox
         service_description             RDS Status
-        dependent_service_description   RDS Load Average, RDS Free Storage, RDS Free Memory
+        dependent_service_description   RDS Load Average, RDS Free Storage, RDS Free Memory, RDS I/O
         execution_failure_criteria      w,c,u,p
         notification_failure_criteria   w,c,u,p
         }
@@ -562,6 +1213,13 @@ Here is the excerpt of potential Nagios config:
         check_command                   check_rds!memory!5!2
         }
 
+  define service{
+        use                             active-service
+        host_name                       blackbox
+        service_description             RDS I/O
+        check_command                   check_rds!read_latency,write_latency,disk_queue!20/20/5!50/50/10
+        }
+
   define command{
         command_name    check_rds
         command_line    $USER1$/pmp-check-aws-rds.py -i $HOSTALIAS$ -m $ARG1$ -w $ARG2$ -c $ARG3$
@@ -0,0 +1 @@
+../../cacti/scripts/pmp_aws_rds.py
\ No newline at end of file
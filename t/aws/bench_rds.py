@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Load benchmark of the RDS Nagios plugin and Cacti script against fake_aws.py.
+
+Every scenario polls each of the synthetic DB instances once, a few polls at a
+time, and reports the AWS API calls per poll, the run time percentiles and the
+peak memory of a poll.  The cacti-server scenario sends all the polls to one
+Cacti script running with --server, its run time is the average per poll:
+
+  python t/aws/bench_rds.py -N 1000 -j 16
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_aws
+
+NAGIOS = os.path.join(HERE, '..', '..', 'nagios', 'bin', 'pmp-check-aws-rds.py')
+CACTI = os.path.join(HERE, '..', '..', 'cacti', 'scripts', 'ss_get_rds_stats.py')
+
+# The metric sets of the Cacti data input methods in cacti/definitions/rds.def
+CACTI_INPUTS = ('BinLogDiskUsage', 'CPUUtilization', 'DatabaseConnections', 'DiskQueueDepth', 'ReplicaLag',
+                'SwapUsage', 'FreeableMemory', 'FreeStorageSpace', 'ReadIOPS,WriteIOPS', 'ReadLatency,WriteLatency',
+                'ReadLatency:p90,ReadLatency:p99,WriteLatency:p90,WriteLatency:p99', 'ReadThroughput,WriteThroughput')
+
+SCENARIOS = {
+    'nagios-status': lambda ident, region: [NAGIOS, '-r', region, '-i', ident, '-m', 'status'],
+    'nagios-events': lambda ident, region: [NAGIOS, '-r', region, '-i', ident, '-m', 'status', '-e'],
+    'nagios-load': lambda ident, region: [NAGIOS, '-r', region, '-i', ident, '-m', 'load',
+                                          '-w', '90,85,80', '-c', '98,95,90'],
+    'nagios-multi': lambda ident, region: [NAGIOS, '-r', region, '-i', ident,
+                                           '-m', 'status,load,storage,memory,read_latency,write_latency',
+                                           '-w', '0/90,85,80/10/10/20/20', '-c', '0/98,95,90/5/5/50/50'],
+    'nagios-forecast': lambda ident, region: [NAGIOS, '-r', region, '-i', ident, '-m', 'storage_forecast',
+                                              '-w', '72', '-c', '24'],
+    'cacti': lambda ident, region: [CACTI, '--region=_' + region, '--profile=_', '--ident=' + ident,
+                                    '--metric=' + CACTI_INPUTS[int(ident[3:]) % len(CACTI_INPUTS)]],
+}
+
+
+def percentile(values, pct):
+    """Nearest rank percentile"""
+    values = sorted(values)
+    return values[max(0, int(round(pct / 100.0 * len(values))) - 1)]
+
+
+def run(argv, env, stdin=None):
+    """Run a script, return (seconds, peak RSS in KB, exit code)"""
+    # From a file, so a long input does not block on the output pipe
+    infile = tempfile.TemporaryFile()
+    infile.write(stdin or b'')
+    infile.seek(0)
+    start = time.time()
+    proc = subprocess.Popen([sys.executable] + argv, env=env, stdin=infile, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    proc.stdout.read()
+    # wait4() tells the resource usage of this very process
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    infile.close()
+    return time.time() - start, usage.ru_maxrss, os.WEXITSTATUS(status)
+
+
+def bench(name, instances, options, aws, env):
+    """Poll every instance once, return the report line"""
+    aws.reset()
+    start = time.time()
+    if name == 'cacti-server':
+        # All the polls through one long running process
+        lines = ''.join('%s\n' % ' '.join(SCENARIOS['cacti'](ident, region)[1:] + options.args)
+                        for (ident, region) in instances)
+        elapsed, rss, _ = run([CACTI, '--server'], env, lines.encode('utf-8'))
+        times = [elapsed / len(instances)]
+        rss = [rss]
+        failed = 0
+    else:
+        pool = ThreadPool(options.jobs)
+        results = pool.map(lambda inst: run(SCENARIOS[name](*inst) + options.args, env), instances)
+        pool.close()
+        times = [r[0] for r in results]
+        rss = [r[1] for r in results]
+        failed = len([r for r in results if r[2] not in (0, 1, 2)])
+
+    wall = time.time() - start
+    calls = dict(aws.calls)
+    total = sum(calls.values())
+    return ('%-16s %6d %8.2f %8.3f %8.3f %8.1f %8.1f %6d %7d  %s'
+            % (name, len(instances), float(total) / len(instances), percentile(times, 50), percentile(times, 99),
+               max(rss) / 1024.0, wall, aws.throttled, failed,
+               ', '.join('%s=%s' % (k, v) for (k, v) in sorted(calls.items()))))
+
+
+def main():
+    """Run the benchmark"""
+    parser = optparse.OptionParser()
+    parser.add_option('-N', '--instances', type='int', default=1000, help='number of DB instances. Default: 1000')
+    parser.add_option('-j', '--jobs', type='int', default=8, help='polls running at once. Default: 8')
+    parser.add_option('-L', '--latency', type='float', default=0.02,
+                      help='seconds the fake takes to answer. Default: 0.02')
+    parser.add_option('-T', '--throttle', type='float', default=0.0, help='fraction of requests to throttle')
+    parser.add_option('-s', '--scenario', action='append',
+                      help='scenario to run, may be repeated: [%s]. Default: all'
+                           % ', '.join(sorted(SCENARIOS.keys()) + ['cacti-server']))
+    parser.add_option('-a', '--arg', action='append', dest='args', default=[],
+                      help='extra argument to pass to the scripts, may be repeated')
+    options, _ = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    fleet = fake_aws.Fleet(options.instances)
+    aws = fake_aws.FakeAWS(fleet, options.latency, options.throttle)
+    server = fake_aws.Server(aws).start()
+    env = dict(os.environ, BOTO_CONFIG=fake_aws.boto_config(os.path.join(tmp, 'boto.cfg'), server.port))
+    options.args = ['--statusdir', os.path.join(tmp, 'status')] + options.args
+    instances = sorted((inst['id'], inst['region']) for inst in fleet.instances.values())
+    try:
+        print('%-16s %6s %8s %8s %8s %8s %8s %6s %7s  %s' % ('scenario', 'polls', 'api/poll', 'p50 s', 'p99 s',
+                                                             'rss MB', 'wall s', 'thrtl', 'failed', 'API calls'))
+        for name in options.scenario or sorted(SCENARIOS.keys()) + ['cacti-server']:
+            print(bench(name, instances, options, aws, env))
+            sys.stdout.flush()
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+"""Offline stand-in for the AWS APIs used by the RDS scripts.
+
+It serves DescribeDBInstances, DescribeDBClusters, DescribeEvents (RDS),
+GetMetricStatistics, GetMetricData (CloudWatch), GetResourceMetrics,
+DescribeDimensionKeys (Performance Insights) and GetLogEvents (CloudWatch Logs,
+Enhanced Monitoring) for a synthetic fleet of DB instances, with configurable
+latency and throttling.  boto talks to it as a
+plain HTTP proxy, see boto_config().
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import datetime
+import hashlib
+import json
+import math
+import optparse
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+
+# datetime.strptime() imports _strptime on its first call, which fails now and
+# then when the first calls are made by concurrent request handler threads
+datetime.datetime.strptime('2000-01-01', '%Y-%m-%d')
+
+REGIONS = ('us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-1',
+           'ap-southeast-2', 'ap-northeast-1', 'sa-east-1')
+CLASSES = ('db.t2.medium', 'db.m4.large', 'db.m5.xlarge', 'db.r4.2xlarge', 'db.r5.large', 'db.r3.8xlarge')
+ISO = '%Y-%m-%dT%H:%M:%SZ'
+GB = 1024 ** 3
+WAIT_EVENTS = ('CPU', 'io/table/sql/handler', 'io/file/innodb/innodb_data_file', 'synch/mutex/innodb/buf_pool_mutex',
+               'lock/table/sql/handler', 'io/socket/sql/client_connection')
+STATEMENTS = ('SELECT * FROM `orders` WHERE `customer_id` = ?', 'UPDATE `stock` SET `qty` = `qty` - ? WHERE `id` = ?',
+              'INSERT INTO `events` ( `type` , `payload` ) VALUES (...)', 'SELECT COUNT ( * ) FROM `sessions`',
+              'DELETE FROM `carts` WHERE `updated` < ?', 'COMMIT', 'SELECT `name` FROM `users` WHERE `id` = ?')
+# Log events of a GetLogEvents response, about 1 MB of Enhanced Monitoring ones
+LOG_PAGE = 500
+# Seconds of every OS_STALL_EVERY an I/O stall lasts in the Enhanced Monitoring samples
+OS_STALL = 3
+OS_STALL_EVERY = 180
+
+
+def _seed(*args):
+    return int(hashlib.md5('/'.join(str(a) for a in args).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def _parse_time(val):
+    return datetime.datetime.strptime(re.sub(r'(\.\d+)?(Z|\+00:00)?$', 'Z', val), ISO)
+
+
+class Fleet(object):
+
+    """Synthetic DB instances, clusters, events and metric values"""
+
+    def __init__(self, instances=10, regions=REGIONS, clusters=0, started=None):
+        self.started = started or datetime.datetime.utcnow()
+        self.instances = {}
+        self.clusters = {}
+        self.events = []
+        for i in range(instances):
+            ident = 'db-%04d' % i
+            self.instances[ident] = {
+                'id': ident,
+                'region': regions[i % len(regions)],
+                'class': CLASSES[i % len(CLASSES)],
+                'storage': 100 * (1 + i % 5),
+                'resource_id': 'db-%s' % hashlib.md5(ident.encode('utf-8')).hexdigest()[:26].upper(),
+                'status': 'available',
+                'cluster': None,
+            }
+        for i in range(clusters):
+            ident = 'cluster-%02d' % i
+            members = ['%s-instance-%d' % (ident, n) for n in range(3)]
+            self.clusters[ident] = {'id': ident, 'region': regions[0], 'members': members}
+            for n, member in enumerate(members):
+                self.instances[member] = {
+                    'id': member, 'region': regions[0], 'class': 'db.r5.large', 'storage': 1,
+                    'resource_id': 'db-%s' % hashlib.md5(member.encode('utf-8')).hexdigest()[:26].upper(),
+                    'status': 'available', 'cluster': ident, 'writer': n == 0,
+                }
+
+    def sample_events(self):
+        """Record a failover, a reboot, a maintenance and a storage full event"""
+        now = datetime.datetime.utcnow()
+        samples = (
+            ('db-0001', 'Multi-AZ instance failover started.', 'failover', 600),
+            ('db-0001', 'Multi-AZ instance failover completed.', 'failover', 540),
+            ('db-0002', 'DB instance shutdown', 'availability', 120),
+            ('db-0003', 'Offline maintenance of the DB instance is taking place.', 'maintenance', 60),
+            ('db-0004', 'Allocated storage has been exhausted.', 'low storage', 30),
+        )
+        for ident, message, category, age in samples:
+            if ident in self.instances:
+                self.add_event(ident, message, [category], now - datetime.timedelta(seconds=age))
+
+    def add_event(self, ident, message, categories=(), date=None):
+        """Record an RDS event for an instance"""
+        self.events.append({'id': ident, 'message': message, 'categories': list(categories),
+                            'date': date or datetime.datetime.utcnow()})
+
+    def value(self, dims, metric, ts, stat='Average'):
+        """Deterministic value of a metric at a point in time"""
+        ident = list(dims.values())[0] if dims else ''
+        base = _seed(ident, metric) % 1000 / 1000.0
+        age = (ts - self.started).total_seconds()
+        wave = math.sin(age / 600.0 + base * 6)
+        inst = self.instances.get(ident, {})
+        if metric == 'CPUUtilization':
+            val = 20 + 40 * base + 10 * wave
+        elif metric == 'FreeStorageSpace':
+            # Fills up at a steady pace so forecasts have a trend to find
+            val = inst.get('storage', 100) * GB * (0.6 + 0.3 * base) - age * 1024 * 50
+        elif metric == 'FreeableMemory':
+            val = GB * (1 + base) + 64 * 1024 ** 2 * wave
+        elif metric in ('ReadLatency', 'WriteLatency'):
+            val = 0.002 + 0.003 * base + 0.001 * wave
+        elif metric == 'VolumeBytesUsed':
+            val = 50 * GB + age * 1024
+        else:
+            val = 100 * base + 10 * wave
+        val = max(val, 0)
+        if stat.startswith('p'):
+            val *= 1 + float(stat[1:]) / 50
+        elif stat == 'Maximum':
+            val *= 1.5
+        elif stat == 'Minimum':
+            val *= 0.5
+        return val
+
+    def pi_load(self, ident, key, ts):
+        """Deterministic Performance Insights DB load of a wait event or statement"""
+        base = _seed(ident, key) % 1000 / 1000.0
+        age = (ts - self.started).total_seconds()
+        return round(max(0.0, 2 * base * base + 0.2 * math.sin(age / 300.0 + base * 6)), 3)
+
+    def os_sample(self, ident, ts):
+        """Deterministic Enhanced Monitoring sample of an instance at a second, the disk stalls
+        for a few seconds every few minutes
+        """
+        base = _seed(ident, 'os') % 1000 / 1000.0
+        second = int((ts - datetime.datetime(1970, 1, 1)).total_seconds())
+        wave = math.sin(second / 60.0 + base * 6)
+        stall = (second + int(base * OS_STALL_EVERY)) % OS_STALL_EVERY < OS_STALL
+        user = round(20 + 30 * base + 5 * wave, 2)
+        wait = round(40.0 if stall else 1 + base, 2)
+        disk = {'device': 'rdsdev', 'await': round(250.0 if stall else 2 + 3 * base + wave, 2),
+                'avgQueueLen': round(60.0 if stall else 1 + base, 2),
+                'util': 100.0 if stall else round(20 + 20 * base, 2),
+                'readIOsPS': round(100 + 200 * base + 50 * wave, 2), 'writeIOsPS': round(50 + 100 * base, 2),
+                'readKbPS': 1600.0, 'writeKbPS': 800.0, 'tps': 200.0, 'avgReqSz': 16.0}
+        return {'engine': 'MYSQL', 'instanceID': ident, 'instanceResourceID': self.instances[ident]['resource_id'],
+                'timestamp': ts.strftime(ISO), 'version': 1.0, 'uptime': '10 days, 01:00:00', 'numVCPUs': 2,
+                'cpuUtilization': {'user': user, 'system': 5.0, 'wait': wait, 'irq': 0.0, 'nice': 0.0,
+                                   'steal': 0.0, 'guest': 0.0, 'idle': round(100 - user - 5 - wait, 2),
+                                   'total': round(user + 5 + wait, 2)},
+                'loadAverageMinute': {'one': 1.5, 'five': 1.2, 'fifteen': 1.0},
+                'memory': {'total': 8000000, 'free': 1000000, 'cached': 4000000, 'buffers': 200000},
+                'diskIO': [disk],
+                'processList': [{'name': 'mysqld', 'id': 1234, 'parentID': 1, 'cpuUsedPc': user,
+                                 'memoryUsedPc': 60.0, 'rss': 4800000, 'vss': 6000000}]}
+
+    def series(self, dims, metric, start, end, period, stat):
+        """Datapoints between start and end aligned to period"""
+        epoch = datetime.datetime(1970, 1, 1)
+        # Like CloudWatch, the period which start falls into is included
+        first = int((start - epoch).total_seconds()) // period * period
+        points = []
+        ts = epoch + datetime.timedelta(seconds=first)
+        # CloudWatch publishes with a delay, the current period is incomplete
+        last = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+        while ts < end and ts <= last:
+            points.append((ts, self.value(dims, metric, ts, stat)))
+            ts += datetime.timedelta(seconds=period)
+        return points
+
+
+class FakeAWS(object):
+
+    """Request dispatcher with call accounting"""
+
+    def __init__(self, fleet, latency=0.0, throttle=0.0):
+        self.fleet = fleet
+        self.latency = latency
+        # Fraction of the requests throttled at random, and number of the next
+        # CloudWatch requests throttled for sure
+        self.throttle = throttle
+        self.throttle_next = 0
+        # Actions the credentials are not allowed to call
+        self.denied = set()
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.requests = []
+        self.throttled = 0
+
+    def reset(self):
+        """Zero the counters"""
+        with self.lock:
+            self.calls = {}
+            self.requests = []
+            self.throttled = 0
+
+    def count(self, action, request):
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            self.requests.append((action, request))
+
+    def throttled_now(self, service):
+        """Whether to throttle a request to the service"""
+        with self.lock:
+            if service == 'monitoring' and self.throttle_next > 0:
+                self.throttle_next -= 1
+            elif not self.throttle or random.random() >= self.throttle:
+                return False
+            self.throttled += 1
+        return True
+
+    def handle(self, host, params, headers, body):
+        """Return (status, content type, body) for a request"""
+        # The SigV4 credential scope names the region and service, hostnames
+        # are not consistent, e.g. rds.amazonaws.com is us-east-1.
+        scope = re.search(r'Credential=[^/]+/[^/]+/([^/]+)/([^/]+)/', headers.get('Authorization', ''))
+        if scope:
+            region, service = scope.groups()
+        else:
+            service, region = (host.split('.') + ['us-east-1'])[:2]
+        target = headers.get('X-Amz-Target')
+        if target:
+            action = target.split('.')[-1]
+            request = json.loads(body or '{}')
+        else:
+            action = params.get('Action')
+            request = params
+        self.count(action, request)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttled_now(service):
+            if target:
+                return 400, 'application/x-amz-json-1.1', json.dumps({'__type': 'ThrottlingException',
+                                                                      'message': 'Rate exceeded'})
+            return self.error(400, 'Throttling', 'Rate exceeded')
+        if action in self.denied:
+            return self.error(403, 'AccessDenied', 'User is not authorized to perform: %s:%s'
+                              % ('cloudwatch' if service == 'monitoring' else service, action))
+        handler = getattr(self, '%s_%s' % (service, action), None)
+        if not handler:
+            return self.error(400, 'InvalidAction', 'Unknown action %s for %s' % (action, service))
+        return handler(region, request)
+
+    @staticmethod
+    def json_error(status, code, message):
+        return status, 'application/x-amz-json-1.1', json.dumps({'__type': code, 'message': message})
+
+    @staticmethod
+    def error(status, code, message):
+        body = ('<ErrorResponse><Error><Type>Sender</Type><Code>%s</Code><Message>%s</Message></Error>'
+                '<RequestId>fake</RequestId></ErrorResponse>' % (code, message))
+        return status, 'text/xml', body
+
+    @staticmethod
+    def response(action, ns, result):
+        body = ('<%sResponse xmlns="%s"><%sResult>%s</%sResult><ResponseMetadata><RequestId>fake</RequestId>'
+                '</ResponseMetadata></%sResponse>' % (action, ns, action, result, action, action))
+        return 200, 'text/xml', body
+
+    @staticmethod
+    def members(params, prefix):
+        """Collect prefix.member.N... parameters into a list of dicts"""
+        result = {}
+        for key, val in params.items():
+            if key.startswith(prefix + '.member.'):
+                rest = key[len(prefix) + 8:]
+                num, _, field = rest.partition('.')
+                result.setdefault(int(num), {})[field] = val
+        return [result[k] for k in sorted(result)]
+
+    # RDS
+
+    def rds_DescribeDBInstances(self, region, params):
+        ident = params.get('DBInstanceIdentifier')
+        # The only filter supported
+        cluster = None
+        if params.get('Filters.Filter.1.Name') == 'db-cluster-id':
+            cluster = params.get('Filters.Filter.1.Values.Value.1')
+        found = [i for i in sorted(self.fleet.instances.values(), key=lambda k: k['id'])
+                 if i['region'] == region and (not ident or i['id'] == ident)
+                 and (not cluster or i['cluster'] == cluster)]
+        if ident and not found:
+            return self.error(404, 'DBInstanceNotFound', 'DBInstance %s not found.' % ident)
+        start = int(params.get('Marker') or 0)
+        size = int(params.get('MaxRecords') or 100)
+        page = found[start:start + size]
+        marker = '<Marker>%d</Marker>' % (start + size) if start + size < len(found) else ''
+        items = []
+        for inst in page:
+            cluster = '<DBClusterIdentifier>%s</DBClusterIdentifier>' % inst['cluster'] if inst['cluster'] else ''
+            items.append('<DBInstance><DBInstanceIdentifier>%s</DBInstanceIdentifier>'
+                         '<DBInstanceStatus>%s</DBInstanceStatus><Engine>mysql</Engine>'
+                         '<EngineVersion>5.7.22</EngineVersion><DBInstanceClass>%s</DBInstanceClass>'
+                         '<AllocatedStorage>%d</AllocatedStorage><DbiResourceId>%s</DbiResourceId>%s'
+                         '<Endpoint><Address>%s.fake.%s.rds.amazonaws.com</Address><Port>3306</Port></Endpoint>'
+                         '</DBInstance>' % (inst['id'], inst['status'], inst['class'], inst['storage'],
+                                            inst['resource_id'], cluster, inst['id'], region))
+        return self.response('DescribeDBInstances', 'http://rds.amazonaws.com/doc/2013-05-15/',
+                             '<DBInstances>%s</DBInstances>%s' % (''.join(items), marker))
+
+    def rds_DescribeDBClusters(self, region, params):
+        ident = params.get('DBClusterIdentifier')
+        found = [c for c in self.fleet.clusters.values()
+                 if c['region'] == region and (not ident or c['id'] == ident)]
+        if ident and not found:
+            return self.error(404, 'DBClusterNotFoundFault', 'DBCluster %s not found.' % ident)
+        items = []
+        for cluster in found:
+            members = ''.join('<DBClusterMember><DBInstanceIdentifier>%s</DBInstanceIdentifier>'
+                              '<IsClusterWriter>%s</IsClusterWriter></DBClusterMember>'
+                              % (m, str(self.fleet.instances[m]['writer']).lower()) for m in cluster['members'])
+            items.append('<DBCluster><DBClusterIdentifier>%s</DBClusterIdentifier><Status>available</Status>'
+                         '<Engine>aurora-mysql</Engine><EngineVersion>5.7.12</EngineVersion>'
+                         '<DBClusterMembers>%s</DBClusterMembers></DBCluster>'
+                         % (cluster['id'], members))
+        return self.response('DescribeDBClusters', 'http://rds.amazonaws.com/doc/2014-10-31/',
+                             '<DBClusters>%s</DBClusters>' % ''.join(items))
+
+    def rds_DescribeEvents(self, region, params):
+        start = _parse_time(params['StartTime']) if params.get('StartTime') else datetime.datetime(1970, 1, 1)
+        end = _parse_time(params['EndTime']) if params.get('EndTime') else datetime.datetime(2100, 1, 1)
+        found = [e for e in self.fleet.events
+                 if self.fleet.instances.get(e['id'], {}).get('region') == region and start <= e['date'] < end]
+        offset = int(params.get('Marker') or 0)
+        size = int(params.get('MaxRecords') or 100)
+        page = found[offset:offset + size]
+        marker = '<Marker>%d</Marker>' % (offset + size) if offset + size < len(found) else ''
+        items = ''.join('<Event><SourceIdentifier>%s</SourceIdentifier><SourceType>db-instance</SourceType>'
+                        '<Message>%s</Message><EventCategories>%s</EventCategories><Date>%s</Date></Event>'
+                        % (e['id'], e['message'],
+                           ''.join('<EventCategory>%s</EventCategory>' % c for c in e['categories']),
+                           e['date'].strftime(ISO)) for e in page)
+        return self.response('DescribeEvents', 'http://rds.amazonaws.com/doc/2013-05-15/',
+                             '<Events>%s</Events>%s' % (items, marker))
+
+    # CloudWatch
+
+    def monitoring_GetMetricStatistics(self, region, params):
+        dims = dict((d['Name'], d['Value']) for d in self.members(params, 'Dimensions'))
+        stats = [params[k] for k in sorted(params) if k.startswith('Statistics.member.')]
+        extended = [params[k] for k in sorted(params) if k.startswith('ExtendedStatistics.member.')]
+        start = _parse_time(params['StartTime'])
+        end = _parse_time(params['EndTime'])
+        period = int(params['Period'])
+        points = []
+        for ts, _ in self.fleet.series(dims, params['MetricName'], start, end, period, 'Average'):
+            fields = ''.join('<%s>%r</%s>' % (s, self.fleet.value(dims, params['MetricName'], ts, s), s)
+                             for s in stats)
+            if extended:
+                fields += '<ExtendedStatistics>%s</ExtendedStatistics>' % ''.join(
+                    '<entry><key>%s</key><value>%r</value></entry>'
+                    % (s, self.fleet.value(dims, params['MetricName'], ts, s)) for s in extended)
+            points.append('<member><Timestamp>%s</Timestamp>%s<Unit>None</Unit></member>'
+                          % (ts.strftime(ISO), fields))
+        return self.response('GetMetricStatistics', 'http://monitoring.amazonaws.com/doc/2010-08-01/',
+                             '<Datapoints>%s</Datapoints><Label>%s</Label>'
+                             % (''.join(points), params['MetricName']))
+
+    def monitoring_GetMetricData(self, region, params):
+        start = _parse_time(params['StartTime'])
+        end = _parse_time(params['EndTime'])
+        queries = {}
+        for key, val in params.items():
+            if key.startswith('MetricDataQueries.member.'):
+                num, _, field = key[len('MetricDataQueries.member.'):].partition('.')
+                queries.setdefault(int(num), {})[field] = val
+        results = []
+        for num in sorted(queries):
+            query = queries[num]
+            dims = {}
+            for key, val in query.items():
+                if key.startswith('MetricStat.Metric.Dimensions.member.') and key.endswith('.Name'):
+                    dims[val] = query[key[:-5] + '.Value']
+            points = self.fleet.series(dims, query['MetricStat.Metric.MetricName'], start, end,
+                                       int(query['MetricStat.Period']), query['MetricStat.Stat'])
+            points.reverse()
+            results.append('<member><Id>%s</Id><Label>%s</Label><StatusCode>Complete</StatusCode>'
+                           '<Timestamps>%s</Timestamps><Values>%s</Values></member>'
+                           % (query['Id'], query['MetricStat.Metric.MetricName'],
+                              ''.join('<member>%s</member>' % ts.strftime(ISO) for ts, _ in points),
+                              ''.join('<member>%r</member>' % val for _, val in points)))
+        return self.response('GetMetricData', 'http://monitoring.amazonaws.com/doc/2010-08-01/',
+                             '<MetricDataResults>%s</MetricDataResults>' % ''.join(results))
+
+
+    # Performance Insights
+
+    def pi_instance(self, params):
+        for inst in self.fleet.instances.values():
+            if inst['resource_id'] == params.get('Identifier'):
+                return inst
+        return None
+
+    @staticmethod
+    def pi_keys(group):
+        """Dimensions of every key of a dimension group"""
+        if group == 'db.wait_event':
+            return [{'db.wait_event.name': name, 'db.wait_event.type': name.split('/')[0]} for name in WAIT_EVENTS]
+        return [{'db.sql_tokenized.id': hashlib.md5(text.encode('utf-8')).hexdigest()[:16].upper(),
+                 'db.sql_tokenized.statement': text} for text in STATEMENTS]
+
+    def pi_series(self, inst, group_by, start, end, period):
+        """MetricList entries of a query, the total if there is no grouping"""
+        epoch = datetime.datetime(1970, 1, 1)
+        stamps = [epoch + datetime.timedelta(seconds=t) for t in range(int(start) // period * period, int(end), period)]
+        keys = self.pi_keys(group_by['Group']) if group_by else []
+        names = [key.get('db.wait_event.name') or key.get('db.sql_tokenized.statement') for key in keys]
+        loads = [[self.fleet.pi_load(inst['id'], name, ts) for ts in stamps] for name in names]
+        order = sorted(range(len(keys)), key=lambda k: -sum(loads[k]))[:int(group_by.get('Limit', 10))] if keys else []
+        series = []
+        for num in order:
+            wanted = group_by.get('Dimensions')
+            dims = dict((k, v) for (k, v) in keys[num].items() if not wanted or k in wanted)
+            series.append(({'Metric': 'db.load.avg', 'Dimensions': dims}, loads[num]))
+        if not group_by:
+            totals = [sum(self.fleet.pi_load(inst['id'], name, ts) for name in WAIT_EVENTS) for ts in stamps]
+            series.append(({'Metric': 'db.load.avg'}, totals))
+        return [{'Key': key, 'DataPoints': [{'Timestamp': (ts - epoch).total_seconds(), 'Value': val}
+                                            for ts, val in zip(stamps, values)]} for (key, values) in series]
+
+    def pi_GetResourceMetrics(self, region, params):
+        inst = self.pi_instance(params)
+        if not inst:
+            return self.json_error(400, 'InvalidArgumentException', 'No Performance Insights for the identifier')
+        result = []
+        for query in params['MetricQueries']:
+            result.extend(self.pi_series(inst, query.get('GroupBy'), params['StartTime'], params['EndTime'],
+                                         int(params.get('PeriodInSeconds', 60))))
+        return 200, 'application/x-amz-json-1.1', json.dumps({
+            'AlignedStartTime': params['StartTime'], 'AlignedEndTime': params['EndTime'],
+            'Identifier': params['Identifier'], 'MetricList': result})
+
+    def pi_DescribeDimensionKeys(self, region, params):
+        inst = self.pi_instance(params)
+        if not inst:
+            return self.json_error(400, 'InvalidArgumentException', 'No Performance Insights for the identifier')
+        series = self.pi_series(inst, params['GroupBy'], params['StartTime'], params['EndTime'], 60)
+        return 200, 'application/x-amz-json-1.1', json.dumps({
+            'AlignedStartTime': params['StartTime'], 'AlignedEndTime': params['EndTime'],
+            'Keys': [{'Dimensions': item['Key']['Dimensions'], 'Total': sum(p['Value'] for p in item['DataPoints'])}
+                     for item in series]})
+
+
+    # CloudWatch Logs
+
+    def logs_GetLogEvents(self, region, params):
+        """Enhanced Monitoring samples a second apart up to a second ago, paged by a
+        forward token holding the time of the next one
+        """
+        inst = self.pi_instance({'Identifier': params.get('logStreamName')})
+        if params.get('logGroupName') != 'RDSOSMetrics' or not inst:
+            return self.json_error(400, 'ResourceNotFoundException', 'The specified log stream does not exist.')
+        token = params.get('nextToken')
+        if token:
+            if not token.startswith('f/'):
+                return self.json_error(400, 'InvalidParameterException', 'The specified nextToken is invalid.')
+            start = int(token[2:])
+        else:
+            start = int(params.get('startTime') or 0)
+        start = (start + 999) // 1000
+        end = min(int(time.time()) - 1, int(params['endTime']) // 1000 if params.get('endTime') else 2 ** 40)
+        end = min(end, start + min(int(params.get('limit') or LOG_PAGE), LOG_PAGE) - 1)
+        epoch = datetime.datetime(1970, 1, 1)
+        events = []
+        for second in range(start, end + 1):
+            sample = self.fleet.os_sample(inst['id'], epoch + datetime.timedelta(seconds=second))
+            events.append({'timestamp': second * 1000, 'ingestionTime': second * 1000 + 500,
+                           'message': json.dumps(sample)})
+        forward = 'f/%d' % ((end + 1) * 1000 if events else start * 1000)
+        return 200, 'application/x-amz-json-1.1', json.dumps({
+            'events': events, 'nextForwardToken': forward, 'nextBackwardToken': 'b/%d' % (start * 1000)})
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _serve(self):
+        url = urlparse(self.path)
+        host = url.netloc or self.headers.get('Host', '')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        params = dict(parse_qsl(url.query))
+        if not self.headers.get('X-Amz-Target'):
+            params.update(parse_qsl(body))
+        status, ctype, data = self.server.aws.handle(host, params, self.headers, body)
+        data = data.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = _serve
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    """Threaded HTTP proxy answering for AWS endpoints"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, aws, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.aws = aws
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def boto_config(path, port):
+    """Write a boto config that routes every request through the stand-in, with an "other" profile too"""
+    fh = open(path, 'w')
+    fh.write('[Credentials]\naws_access_key_id = THISISATESTKEY\n'
+             'aws_secret_access_key = thisisatestawssecretaccesskey\n\n'
+             '[profile other]\naws_access_key_id = THISISANOTHERKEY\n'
+             'aws_secret_access_key = thisisanotherawssecretaccesskey\n\n'
+             '[Boto]\nis_secure = False\nproxy = 127.0.0.1\nproxy_port = %d\nnum_retries = 0\n' % port)
+    fh.close()
+    return path
+
+
+def main():
+    """Run the stand-in in the foreground"""
+    parser = optparse.OptionParser()
+    parser.add_option('-P', '--port', type='int', default=8080, help='port to listen on. Default: 8080')
+    parser.add_option('-N', '--instances', type='int', default=10, help='number of DB instances. Default: 10')
+    parser.add_option('-C', '--clusters', type='int', default=0, help='number of Aurora clusters. Default: 0')
+    parser.add_option('-L', '--latency', type='float', default=0.0, help='seconds to delay every response')
+    parser.add_option('-T', '--throttle', type='float', default=0.0, help='fraction of requests to throttle')
+    parser.add_option('-E', '--events', action='store_true', default=False,
+                      help='record some sample events, see Fleet.sample_events()')
+    parser.add_option('-c', '--config', help='write a boto config for this server to the file')
+    options, _ = parser.parse_args()
+    fleet = Fleet(options.instances, clusters=options.clusters)
+    if options.events:
+        fleet.sample_events()
+    server = Server(FakeAWS(fleet, options.latency, options.throttle), options.port)
+    if options.config:
+        boto_config(options.config, server.port)
+    print('Listening on 127.0.0.1:%d' % server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
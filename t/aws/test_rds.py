@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""Smoke tests of the RDS Nagios plugin and Cacti script against fake_aws.py.
+
+Run with the Python the scripts are installed for:
+
+  python t/aws/test_rds.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import calendar
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fake_aws
+
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'cacti', 'scripts'))
+import pmp_aws_rds
+
+NAGIOS = os.path.join(HERE, '..', '..', 'nagios', 'bin', 'pmp-check-aws-rds.py')
+CACTI = os.path.join(HERE, '..', '..', 'cacti', 'scripts', 'ss_get_rds_stats.py')
+
+
+class RDSScriptsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.fleet = fake_aws.Fleet(20, clusters=1)
+        cls.aws = fake_aws.FakeAWS(cls.fleet)
+        cls.server = fake_aws.Server(cls.aws).start()
+        cls.env = dict(os.environ, BOTO_CONFIG=fake_aws.boto_config(os.path.join(cls.tmp, 'boto.cfg'),
+                                                                    cls.server.port))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.statusdir = tempfile.mkdtemp(dir=self.tmp)
+        self.aws.reset()
+
+    def run_script(self, script, args, stdin=None, stderr=subprocess.STDOUT):
+        proc = subprocess.Popen([sys.executable, script, '--statusdir', self.statusdir] + args, env=self.env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+        out = proc.communicate(stdin)[0].decode('utf-8')
+        return proc.returncode, out
+
+    def region(self, ident):
+        return self.fleet.instances[ident]['region']
+
+    def test_nagios_load(self):
+        code, out = self.run_script(NAGIOS, ['-r', self.region('db-0001'), '-i', 'db-0001', '-m', 'load',
+                                             '-w', '90,85,80', '-c', '98,95,90'])
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'OK Load average: [\d.]+%, [\d.]+%, [\d.]+% \| load1=[\d.]+;90.0;98.0;0;100 ', out),
+                        out)
+        # The three averages come from one request
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 1)
+        self.assertEqual(self.aws.calls.get('GetMetricStatistics'), None)
+
+    def test_nagios_load_without_metric_data(self):
+        # Credentials granted before GetMetricData existed
+        self.aws.denied.add('GetMetricData')
+        try:
+            args = ['-r', self.region('db-0001'), '-i', 'db-0001', '-m', 'load', '-w', '90,85,80', '-c', '98,95,90']
+            code, out = self.run_script(NAGIOS, args)
+        finally:
+            self.aws.denied.clear()
+
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'OK Load average: [\d.]+%, [\d.]+%, [\d.]+% \| load1=[\d.]+;90.0;98.0;0;100 ', out),
+                        out)
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 1)
+        self.assertEqual(self.aws.calls.get('GetMetricStatistics'), 3)
+
+    def test_nagios_multi_metric(self):
+        code, out = self.run_script(NAGIOS, ['-r', self.region('db-0002'), '-i', 'db-0002',
+                                             '-m', 'status,load,storage,memory,read_latency:p99',
+                                             '-w', '0/90,85,80/1/1/1000', '-c', '0/98,95,90/0/0/2000'])
+        self.assertEqual(code, 0, out)
+        lines = out.splitlines()
+        self.assertEqual(len(lines), 6, out)
+        self.assertTrue(lines[0].startswith('OK status OK, load OK, storage OK, memory OK, read_latency:p99 OK |'))
+        self.assertTrue('read_latency_p99=' in lines[0])
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 1)
+        self.assertEqual(self.aws.calls.get('DescribeDBInstances'), 1)
+
+    def test_nagios_region_index(self):
+        args = ['-r', 'all', '-i', 'db-0005', '-m', 'status']
+        code, out = self.run_script(NAGIOS, args)
+        self.assertEqual(code, 0, out)
+        self.assertTrue(out.startswith('OK mysql 5.7.22. Status: available'), out)
+        self.aws.reset()
+        self.run_script(NAGIOS, args)
+        self.assertEqual(self.aws.calls, {'DescribeDBInstances': 1})
+
+    def test_nagios_forecast_cached(self):
+        args = ['-r', self.region('db-0003'), '-i', 'db-0003', '-m', 'storage_forecast', '-w', '72', '-c', '24']
+        code, out = self.run_script(NAGIOS, args)
+        self.assertTrue(re.match(r'OK Free storage: [\d.]+ GB, -[\d.]+ GB/h over 24h, full in [\d.]+ hours', out), out)
+        # The instance details are not needed
+        self.assertEqual(self.aws.calls, {'GetMetricStatistics': 1})
+        self.aws.reset()
+        code, out = self.run_script(NAGIOS, args)
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.aws.calls, {})
+        # Not for another AWS profile
+        code, out = self.run_script(NAGIOS, args + ['-n', 'other'])
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.aws.calls, {'GetMetricStatistics': 1})
+
+    def test_nagios_events(self):
+        region = self.region('db-0004')
+        args = ['-r', region, '-i', 'db-0004', '-m', 'status', '-e']
+        code, out = self.run_script(NAGIOS, args)
+        self.assertEqual(code, 0, out)
+        self.fleet.add_event('db-0004', 'Allocated storage has been exhausted.', ['low storage'])
+        # Skip the wait for the next poll of the region
+        path = os.path.join(self.statusdir, 'events.json')
+        data = json.load(open(path))
+        data['/%s' % region]['polled'] = 0
+        json.dump(data, open(path, 'w'))
+        self.aws.reset()
+        code, out = self.run_script(NAGIOS, args)
+        self.assertEqual(code, 2, out)
+        self.assertTrue('Status: storage-full' in out, out)
+        self.assertEqual(self.aws.calls, {'DescribeEvents': 1})
+        self.fleet.events = []
+
+    def test_nagios_cluster(self):
+        code, out = self.run_script(NAGIOS, ['-r', 'us-east-1', '-C', 'cluster-00', '-m', 'status,load,volume_used',
+                                             '-w', '0/90,85,80/1000', '-c', '0/98,95,90/2000'])
+        self.assertEqual(code, 0, out)
+        lines = out.splitlines()
+        self.assertTrue(lines[0].startswith('OK Aurora DB cluster cluster-00, 3 members: status OK, load OK, '
+                                            'volume_used OK |'), out)
+        self.assertTrue('cluster-00-instance-2_load15=' in lines[0] and 'cluster-00_volume_used=' in lines[0], out)
+        # The cluster and its members, the load of the members and the cluster volume
+        self.assertEqual(len(lines), 1 + 4 + 3 + 1, out)
+        self.assertTrue(lines[2].startswith('cluster-00-instance-0 (writer) status: OK'), out)
+        self.assertEqual(self.aws.calls, {'DescribeDBClusters': 1, 'DescribeDBInstances': 1, 'GetMetricData': 1})
+
+    def test_nagios_memory_events(self):
+        args = ['-r', self.region('db-0009'), '-i', 'db-0009', '-m', 'memory', '-w', '5', '-c', '2', '-e']
+        code, out = self.run_script(NAGIOS, args)
+        self.assertTrue(re.match(r'\w+ Free memory: [\d.]+ GB \([\d.]+%\) of 61 GB', out), out)
+        # The instance class comes from the event table
+        self.aws.reset()
+        self.run_script(NAGIOS, args)
+        self.assertEqual(self.aws.calls, {'GetMetricStatistics': 1})
+
+    def test_nagios_db_load(self):
+        args = ['-r', self.region('db-0010'), '-i', 'db-0010', '-m', 'db_load', '-w', '50', '-c', '100', '-e']
+        code, out = self.run_script(NAGIOS, args)
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'OK DB load: [\d.]+ sessions, waits: .+, top SQL: [\d.]+ .+ \| '
+                                 r'db_load=[\d.]+;50.0;100.0;0 wait_', out), out)
+        # The wait event names are made valid perfdata labels
+        self.assertTrue(re.match(r'^( [\w.]+=[^ ]+)+$', out.strip().split('|')[1]), out)
+        self.assertEqual(self.aws.calls.get('DescribeDimensionKeys'), 1)
+        # The resource id and the SQL text are cached
+        self.aws.reset()
+        self.run_script(NAGIOS, args)
+        self.assertEqual(self.aws.calls, {'GetResourceMetrics': 1})
+
+    def test_instance_classes(self):
+        path = os.path.join(self.statusdir, 'classes.conf')
+        open(path, 'w').write('# Local classes\ndb.custom.large = 12\ninvalid\ndb.r5.large=17\n')
+        catalog = pmp_aws_rds.InstanceClasses(path)
+        self.assertEqual(catalog.get('db.custom.large'), 12)
+        self.assertEqual(catalog.get('db.r5.large'), 17)
+        self.assertEqual(catalog.get('db.m4.large'), 8)
+        self.assertEqual(catalog.get('db.r6g.4xlarge'), 128)
+        self.assertEqual(catalog.get('db.t4g.micro'), 1)
+        self.assertEqual(catalog.get('db.r5.2xlarge.tpc2.mem4x'), 256)
+        self.assertEqual(catalog.get('db.serverless'), None)
+
+    def test_state_file(self):
+        status_dir = os.path.join(self.statusdir, 'private')
+        state = pmp_aws_rds.StateFile(status_dir, 'test.json')
+        state.update(lambda data: data.update(a=1))
+        self.assertEqual(state.read(), {'a': 1})
+        self.assertEqual(os.stat(status_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(state.path).st_mode & 0o777, 0o600)
+        # A symlink planted in place of the file is not followed
+        os.rename(state.path, state.path + '.old')
+        os.symlink(state.path + '.old', state.path)
+        self.assertRaises(OSError, state.read)
+        # Nor one in place of the directory
+        os.symlink(status_dir, status_dir + '.link')
+        self.assertRaises(OSError, pmp_aws_rds.StateFile, status_dir + '.link', 'test.json')
+
+    def test_cacti_poll(self):
+        code, out = self.run_script(CACTI, ['--region=_' + self.region('db-0006'), '--profile=_', '--ident=db-0006',
+                                            '--metric=ReadLatency,WriteLatency,ReadLatency:p90,ReadLatency:p99'])
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'^gs:[\d.]+ gt:[\d.]+ gw:[\d.]+ gx:[\d.]+$', out.strip()), out)
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 1)
+
+    def test_cacti_watermark(self):
+        args = ['--region=_' + self.region('db-0008'), '--profile=_', '--ident=db-0008', '--metric=CPUUtilization']
+        code, out = self.run_script(CACTI, args)
+        self.assertEqual(code, 0, out)
+        # The next poll asks only for the datapoints from a little before the last one consumed
+        path = os.path.join(self.statusdir, 'watermarks.json')
+        watermarks = json.load(open(path))
+        last_time = int(time.time()) - 120
+        json.dump(dict((key, [last_time, value]) for key, (_, value) in watermarks.items()), open(path, 'w'))
+        self.aws.reset()
+        code, out = self.run_script(CACTI, args)
+        self.assertEqual(code, 0, out)
+        action, request = self.aws.requests[-1]
+        self.assertEqual(action, 'GetMetricStatistics')
+        start = calendar.timegm(fake_aws._parse_time(request['StartTime']).timetuple())
+        self.assertEqual(start, last_time - 60)
+        # Each AWS profile has its own watermarks
+        code, out = self.run_script(CACTI, args[:1] + ['--profile=other'] + args[2:])
+        self.assertEqual(code, 0, out)
+        self.assertEqual(sorted(json.load(open(path))), ['/%s/db-0008/CPUUtilization' % self.region('db-0008'),
+                                                         'other/%s/db-0008/CPUUtilization' % self.region('db-0008')])
+
+    def test_cacti_server_without_metric_data(self):
+        self.aws.denied.add('GetMetricData')
+        try:
+            ident = '--ident=db-0013 --region=%s' % self.region('db-0013')
+            lines = '\n'.join(['%s --metric=ReadLatency,WriteLatency' % ident,
+                               '%s --metric=ReadIOPS,WriteIOPS' % ident,
+                               '%s --metric=ReadLatency:p99' % ident, 'quit', ''])
+            code, out = self.run_script(CACTI, ['--server'], lines.encode('utf-8'))
+        finally:
+            self.aws.denied.clear()
+
+        out = out.splitlines()
+        self.assertEqual(code, 0, out)
+        self.assertEqual(len(out), 3, out)
+        self.assertTrue(re.match(r'^gs:[\d.]+ gt:[\d.]+$', out[0]), out)
+        self.assertTrue(re.match(r'^gq:[\d.]+ gr:[\d.]+$', out[1]), out)
+        # Percentiles need GetMetricData
+        self.assertEqual(out[2], 'Unable to get RDS statistics')
+        # GetMetricData is not tried again
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 1)
+        self.assertEqual(self.aws.calls.get('GetMetricStatistics'), 4)
+
+    def test_cacti_cluster(self):
+        code, out = self.run_script(CACTI, ['--region=_us-east-1', '--profile=_', '--cluster=cluster-00',
+                                            '--metric=CPUUtilization,VolumeBytesUsed'])
+        self.assertEqual(code, 0, out)
+        lines = out.splitlines()
+        self.assertTrue(re.match(r'^cluster-00 hh:[\d.]+$', lines[0]), out)
+        self.assertEqual([line.split()[0] for line in lines[1:]],
+                         ['cluster-00-instance-0', 'cluster-00-instance-1', 'cluster-00-instance-2'])
+        self.assertEqual(self.aws.calls, {'DescribeDBClusters': 1, 'DescribeDBInstances': 1, 'GetMetricData': 1})
+
+    def test_cacti_performance_insights(self):
+        code, out = self.run_script(CACTI, ['--region=_' + self.region('db-0011'), '--profile=_', '--ident=db-0011',
+                                            '--metric=PerformanceInsights'])
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'^hi:[\d.]+ hj:[\d.]+ hk:[\d.]+ hl:[\d.]+$', out.strip()), out)
+        self.assertEqual(self.aws.calls, {'DescribeDBInstances': 1, 'GetResourceMetrics': 1})
+
+    def test_cacti_enhanced_monitoring(self):
+        args = ['--region=_' + self.region('db-0012'), '--profile=_', '--ident=db-0012', '--metric=EnhancedMonitoring']
+        code, out = self.run_script(CACTI, args)
+        self.assertEqual(code, 0, out)
+        self.assertTrue(re.match(r'^hm:[\d.]+ hn:[\d.]+ ho:[\d.]+ hp:[\d.]+ hq:[\d.]+ hr:[\d.]+ hs:[\d.]+ ht:[\d.]+ '
+                                 r'hu:[\d.]+ hv:[\d.]+ hw:[\d.]+ hx:[\d.]+ hy:[\d.]+ hz:[\d.]+$', out.strip()), out)
+        # The disk stalls for a few seconds every 3 minutes, only the maximum catches it
+        values = dict(item.split(':') for item in out.split())
+        self.assertEqual(values['hq'], '250.00')
+        self.assertTrue(float(values['hr']) < 10, out)
+        # The next poll reads on from where this one stopped
+        self.aws.reset()
+        code, out = self.run_script(CACTI, args)
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.aws.calls, {'DescribeDBInstances': 1, 'GetLogEvents': 1})
+
+    def test_cacti_server(self):
+        ident = '--ident=db-0007 --region=%s' % self.region('db-0007')
+        lines = '\n'.join(['%s --metric=CPUUtilization' % ident,
+                           '%s --metric=FreeStorageSpace' % ident,
+                           '%s --metric=Nothing' % ident,
+                           '%s --metric=CPUUtilization' % ident, 'quit', ''])
+        code, out = self.run_script(CACTI, ['--server'], lines.encode('utf-8'))
+        out = out.splitlines()
+        self.assertEqual(code, 0, out)
+        self.assertEqual(len(out), 4, out)
+        self.assertTrue(re.match(r'^gh:[\d.]+$', out[0]), out)
+        self.assertTrue(re.match(r'^go:\d+ gp:\d+$', out[1]), out)
+        self.assertEqual(out[2], 'Invalid metric.')
+        # Answered from memory
+        self.assertEqual(out[3], out[0])
+        self.assertEqual(self.aws.calls.get('DescribeDBInstances'), 1)
+        self.assertEqual(self.aws.calls.get('GetMetricStatistics'), 2)
+
+    def test_cacti_server_errors(self):
+        region = '--region=%s' % self.region('db-0007')
+        lines = '\n'.join(["--ident='db-0007 %s --metric=CPUUtilization" % region,
+                           '--ident=db-none %s --metric=CPUUtilization' % region,
+                           '--ident=db-none %s --metric=CPUUtilization' % region,
+                           '--ident=db-0007 %s --metric=CPUUtilization --debug' % region, 'quit', ''])
+        # The debugging output goes to stderr
+        code, out = self.run_script(CACTI, ['--server'], lines.encode('utf-8'), stderr=subprocess.PIPE)
+        out = out.splitlines()
+        self.assertEqual(code, 0, out)
+        self.assertEqual(len(out), 4, out)
+        self.assertEqual(out[0], 'ERROR: No closing quotation')
+        self.assertTrue(all(re.match(r'^gh:[\d.]+$', line) for line in out[1:]), out)
+        # An instance not described is not cached
+        self.assertEqual(self.aws.calls.get('DescribeDBInstances'), 3)
+
+    def test_throttling_retried(self):
+        self.aws.throttle_next = 2
+        try:
+            code, out = self.run_script(NAGIOS, ['-r', self.region('db-0008'), '-i', 'db-0008', '-m', 'load',
+                                                 '-w', '90,85,80', '-c', '98,95,90', '-f'])
+        finally:
+            self.aws.throttle_next = 0
+
+        self.assertEqual(code, 0, out)
+        self.assertTrue(out.startswith('OK Load average'), out)
+        # Answered by the third attempt, after backing off twice
+        self.assertEqual(self.aws.throttled, 2)
+        self.assertEqual(self.aws.calls.get('GetMetricData'), 3)
+        self.assertTrue(' api_retries=2 api_throttles=2 ' in out, out)
+        wait = re.search(r' cloudwatch_wait=([\d.]+)s ', out)
+        self.assertTrue(wait and float(wait.group(1)) > 0, out)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Scaling benchmark of zabbix_template.py from the definition file to the XML.
+
+A synthetic Cacti definition file with the given number of items, 10 per
+graph, is parsed, built into a Template and serialized.  Every size runs in
+its own process, which reports the seconds of each phase and the peak memory
+each phase added on top of the previous ones:
+
+  python t/zabbix/bench_template.py -n 1000,10000,100000
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import hashlib
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'zabbix', 'bin'))
+
+import perlhash
+import zabbix_template
+
+ITEMS_PER_GRAPH = 10
+PHASES = ('parse', 'build', 'write')
+
+
+class Digest(object):
+    """Output stream keeping only the md5 and the size of what is written"""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+
+
+def write_definition(path, items):
+    """Synthetic Cacti definition file with the given number of items"""
+    fh = open(path, 'w')
+    fh.write("# Autobuild: ss_get_bench.php\n{\n   name => 'Bench Server',\n   graphs => [\n")
+    for start in range(0, items, ITEMS_PER_GRAPH):
+        names = ['BENCH_item_%d' % num for num in range(start, min(start + ITEMS_PER_GRAPH, items))]
+        fh.write("      {  name => 'Bench Graph %d',\n         base_value => '%d',\n"
+                 "         dt => {\n            input => 'Get Bench Stats',\n"
+                 % (start // ITEMS_PER_GRAPH, 1024 if start % 3 else 1000))
+        for num, name in enumerate(names):
+            fh.write("            %s => {\n               data_source_type_id => '%d',\n"
+                     "               hash => 'hash_08_VER_%032x'\n            },\n" % (name, 2 if num % 2 else 1, num))
+        fh.write("         },\n         items => [\n")
+        for num, name in enumerate(names):
+            fh.write("            {  item => '%s',\n               color => '%06X',\n               type => '%s',\n"
+                     "            },\n" % (name, num * 4099, 'STACK' if num else 'AREA'))
+        fh.write("         ],\n      },\n")
+    fh.write("   ],\n}\n")
+    fh.close()
+
+
+def run(items):
+    """Parse, build and serialize, print the seconds and peak KB added of each phase, output size and md5"""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'bench.def')
+        write_definition(path, items)
+        results = []
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        out = Digest()
+        for phase in PHASES:
+            start = time.time()
+            if phase == 'parse':
+                data = perlhash.load(path)
+            elif phase == 'build':
+                tmpl = zabbix_template.Template(data)
+                tmpl.tmpl['date'] = '2013-01-01 00:00:00'
+            else:
+                tmpl.write_xml(out)
+            seconds = time.time() - start
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            results.append('%.3f %d' % (seconds, maxrss - peak))
+            peak = maxrss
+        print '%s %d %s' % (' '.join(results), out.size, out.md5.hexdigest())
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--items', default='1000,10000,25000,50000,100000',
+                      help='Comma-separated definition sizes in items [default: %default]')
+    parser.add_option('--run', type='int', metavar='ITEMS', help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    if options.run:
+        run(options.run)
+        return
+
+    print '%8s %s %9s %8s %10s' % ('items', ' '.join('%9s %8s' % (phase + ' s', 'peak KB') for phase in PHASES),
+                                   'total s', 'us/item', 'output KB')
+    for items in [int(num) for num in options.items.split(',')]:
+        fields = subprocess.check_output([sys.executable, __file__, '--run', str(items)]).split()
+        seconds = [float(value) for value in fields[0:6:2]]
+        print '%8d %s %9.3f %8.1f %10d' % (items, ' '.join('%9s %8s' % (fields[num], fields[num + 1])
+                                                           for num in range(0, 6, 2)),
+                                           sum(seconds), sum(seconds) * 1e6 / items, int(fields[6]) // 1024)
+
+
+if __name__ == '__main__':
+    main()
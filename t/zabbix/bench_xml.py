@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Benchmark of the XML serialization of zabbix_template.py.
+
+A synthetic definition with the given number of items, 10 per graph, is
+turned into a Zabbix template by build_template(), then serialized by the
+dict2xml Node tree and by the streaming Converter.write().  Every size runs
+in its own process, which reports the serialization time and the peak memory
+it added on top of the template itself:
+
+  python t/zabbix/bench_xml.py -n 12500,25000,50000,100000
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import hashlib
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIN = os.path.join(HERE, '..', '..', 'zabbix', 'bin')
+sys.path.insert(0, BIN)
+
+import dict2xml
+import zabbix_template as template
+
+ITEMS_PER_GRAPH = 10
+
+
+class Digest(object):
+    """Output stream keeping only the md5 and the size of what is written"""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        data = data.encode('utf-8')
+        self.md5.update(data)
+        self.size += len(data)
+
+
+def definition(items):
+    """Synthetic Cacti definition with the given number of items"""
+    graphs = []
+    for start in range(0, items, ITEMS_PER_GRAPH):
+        names = ['BENCH_item_%d' % num for num in range(start, min(start + ITEMS_PER_GRAPH, items))]
+        dt = dict((name, {'data_source_type_id': 2 if num % 2 else 1}) for (num, name) in enumerate(names))
+        graphs.append({'name': 'Bench Graph <%d> & Co' % (start // ITEMS_PER_GRAPH),
+                       'base_value': 1024 if start % 3 else 1000,
+                       'dt': dt,
+                       'items': [{'item': name, 'type': 'STACK' if num else 'AREA', 'color': '%06X' % (num * 4099)}
+                                 for (num, name) in enumerate(names)]})
+    return {'name': 'Bench Server', 'graphs': graphs}
+
+
+def run(impl, items):
+    """Serialize the template of the synthetic definition, print seconds, peak KB added, output size and md5"""
+    tmpl = template.build_template(definition(items), [], [])[0]
+    tmpl['date'] = '2013-01-01 00:00:00'
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    out = Digest()
+    start = time.time()
+    if impl == 'node':
+        converter = dict2xml.Converter(wrap='zabbix_export', indent='  ')
+        out.write(dict2xml.Node(wrap=converter.wrap, data=tmpl).serialize(converter._make_indenter()))
+    else:
+        dict2xml.Converter(wrap='zabbix_export', indent='  ').write(tmpl, out)
+    seconds = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    print '%.3f %d %d %s' % (seconds, peak, out.size, out.md5.hexdigest())
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--items', default='12500,25000,50000,100000',
+                      help='Comma-separated template sizes in items [default: %default]')
+    parser.add_option('-i', '--impl', default='node,stream', help='Serializations to run [default: %default]')
+    parser.add_option('--run', nargs=2, metavar='IMPL ITEMS', help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    if options.run:
+        run(options.run[0], int(options.run[1]))
+        return
+
+    print '%-8s %8s %9s %12s %11s %10s' % ('impl', 'items', 'seconds', 'us/item', 'peak KB', 'output KB')
+    digests = {}
+    for items in [int(num) for num in options.items.split(',')]:
+        for impl in options.impl.split(','):
+            output = subprocess.check_output([sys.executable, __file__, '--run', impl, str(items)])
+            seconds, peak, size, digest = output.split()
+            digests.setdefault(items, set()).add(digest)
+            print '%-8s %8d %9s %12.1f %11s %10d' % (impl, items, seconds, float(seconds) * 1e6 / items, peak,
+                                                     int(size) // 1024)
+    for items, found in sorted(digests.items()):
+        if len(found) > 1:
+            print 'ERROR: the outputs differ for %d items' % items
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
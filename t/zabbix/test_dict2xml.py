@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Tests of the streaming XML writer of pmp-zabbix-template.py against the dict2xml Node tree.
+
+  python t/zabbix/test_dict2xml.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BIN = os.path.join(HERE, '..', '..', 'zabbix', 'bin')
+sys.path.insert(0, BIN)
+
+import dict2xml
+import zabbix_template as template
+
+DATA = [
+    {'a': 1, 'b': 'x & <y>', 'c': None, 'd': True, 'e': 0.5, 'f': u'\xe9t\xe9'},
+    {'empty': {}, 'none': [], 'blank': '', 'one': [{}], 'flat': ['x', 2]},
+    {'lines': 'first\nsecond\n\nlast', 'deep': {'more': {'text': 'a\nb', 'list': ['c\nd', {'e': 'f\ng'}]}}},
+    {'items': {'item': [{'name': 'x', 'apps': {'app': {'name': 'y'}}}, 'z', {'name': 'w'}]}},
+    {'nested': [[1, 2], [{'a': 1}], [], ({'b': 2},)], 'tuple': (1, 'two')},
+    {},
+    [{'a': 1}, 'b'],
+    'just text',
+]
+
+
+class WriterTest(unittest.TestCase):
+
+    def check(self, data, **kwargs):
+        converter = dict2xml.Converter(**kwargs)
+        expected = dict2xml.Node(wrap=converter.wrap, data=data).serialize(converter._make_indenter())
+        out = StringIO()
+        converter.write(data, out, buffer_size=16)
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(converter.build(data), expected)
+
+    def test_same_as_node(self):
+        for data in DATA:
+            for kwargs in [{'wrap': 'root'}, {'wrap': 'root', 'indent': '\t'}, {'wrap': 'root', 'indent': None},
+                           {'wrap': 'root', 'newlines': False}, {}]:
+                self.check(data, **kwargs)
+
+    def test_templates(self):
+        for name in ('mysql', 'redis', 'rds'):
+            path = os.path.join(HERE, '..', '..', 'cacti', 'definitions', '%s.def' % name)
+            triggers = template.load_triggers(os.path.join(BIN, '..', 'triggers', '%s.yml' % name))
+            tmpl = template.build_template(template.load_definition(path), triggers,
+                                           template.EXTRA_ITEMS.get(name, []))[0]
+            self.check(tmpl, wrap='zabbix_export', indent='  ')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Tests of the discover_objects.py low-level discovery.
+
+  python t/zabbix/test_discover_objects.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import imp
+import os
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+discover_objects = imp.load_source('discover_objects', os.path.join(HERE, '..', '..', 'zabbix', 'scripts',
+                                                                    'discover_objects.py'))
+
+DISKSTATS = """\
+   7       0 loop0 12 0 24 0 0 0 0 0 0 4 0 0 0 0 0
+   8       0 sda 51623 1452 3391462 26960 96105 78361 4387720 157860 0 69380 184780 0 0 0 0
+   8       1 sda1 51546 1452 3387326 26920 96105 78361 4387720 157860 0 69340 184740 0 0 0 0
+   8      16 sdb 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0
+"""
+
+NETDEV = """\
+Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: 107201278   59769    0    0    0     0          0         0 107201278   59769    0    0    0     0       0          0
+  eth0:1150046  1325    0    0    0     0          0         0   191024    1411    0    0    0     0       0          0
+"""
+
+DF = """\
+Filesystem     1024-blocks     Used Available Capacity Mounted on
+/dev/sda1         20511356  9183072  10263380      48% /
+tmpfs              1015432        0   1015432       0% /dev/shm
+/dev/sda1         20511356  9183072  10263380      48% /var/lib/docker
+/dev/mapper/data 103081248 61480612  36341372      63% /data
+"""
+
+
+class DiscoverTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(discover_objects.parse_diskstats(DISKSTATS), ['sda', 'sda1'])
+        self.assertEqual(discover_objects.parse_netdev(NETDEV), ['eth0'])
+        self.assertEqual(discover_objects.parse_df(DF), ['/dev/sda1', '/dev/mapper/data'])
+
+
+if __name__ == '__main__':
+    unittest.main()
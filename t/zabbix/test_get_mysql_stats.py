@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Tests of the get_mysql_stats.py agent lookup with a fake Cacti script.
+
+  python t/zabbix/test_get_mysql_stats.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import json
+import marshal
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOOKUP = os.path.join(HERE, '..', '..', 'zabbix', 'scripts', 'get_mysql_stats.py')
+
+# Writes the cache file like ss_get_mysql_stats.php, slowly, and counts its runs
+FAKE_PHP = """#!/bin/sh
+echo run >> %(dir)s/runs
+sleep 0.5
+printf 'gg:10 g:1 gh:-1 hgg:20' > %(dir)s/localhost-mysql_cacti_stats.txt
+"""
+
+
+class LookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.php = os.path.join(self.tmp, 'php')
+        open(self.php, 'w').write(FAKE_PHP % {'dir': self.tmp})
+        os.chmod(self.php, 0755)
+        self.cache = os.path.join(self.tmp, 'localhost-mysql_cacti_stats.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def lookup(self, item):
+        return subprocess.Popen([sys.executable, LOOKUP, '--php', self.php, '--cache-dir', self.tmp, item],
+                                stdout=subprocess.PIPE)
+
+    def get(self, item):
+        proc = self.lookup(item)
+        return proc.communicate()[0], proc.returncode
+
+    def runs(self):
+        try:
+            return len(open(os.path.join(self.tmp, 'runs')).readlines())
+        except IOError:
+            return 0
+
+    def test_lookup(self):
+        # Exact keys, -1 as 0
+        self.assertEqual(self.get('gg'), ('10\n', 0))
+        self.assertEqual(self.get('g'), ('1\n', 0))
+        self.assertEqual(self.get('gh'), ('0\n', 0))
+        self.assertEqual(self.get('zz'), ('ERROR: unknown item zz\n', 1))
+        self.assertEqual(json.loads(self.get('json')[0]), {'gg': '10', 'g': '1', 'gh': '0', 'hgg': '20'})
+        self.assertEqual(self.runs(), 1)
+
+        # Answered from the index while it has the mtime of the cache
+        index = os.path.join(self.tmp, 'localhost-mysql_cacti_stats.txt.index')
+        fmt, mtime, values = marshal.load(open(index, 'rb'))
+        self.assertEqual((mtime, values['hgg']), (os.stat(self.cache).st_mtime, '20'))
+        marshal.dump((fmt, mtime, dict(values, gg='11')), open(index, 'wb'))
+        self.assertEqual(self.get('gg'), ('11\n', 0))
+        os.utime(self.cache, (time.time() - 10, time.time() - 10))
+        self.assertEqual(self.get('gg'), ('10\n', 0))
+        self.assertEqual(self.runs(), 1)
+
+    def test_single_flight(self):
+        stale = time.time() - 600
+        for _ in range(2):
+            procs = [self.lookup(item) for item in ('gg', 'g', 'gh', 'hgg') * 3]
+            self.assertEqual([proc.communicate()[0] for proc in procs], ['10\n', '1\n', '0\n', '20\n'] * 3)
+            os.utime(self.cache, (stale, stale))
+        self.assertEqual(self.runs(), 2)
+
+    def test_no_stats(self):
+        open(self.php, 'w').write('#!/bin/sh\nexit 1\n')
+        out, code = self.get('gg')
+        self.assertEqual(code, 1)
+        self.assertTrue(out.startswith('ERROR: run the command manually to investigate the problem: %s -q'
+                                       % self.php))
+
+
+if __name__ == '__main__':
+    unittest.main()
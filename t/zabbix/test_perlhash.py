@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Tests of the definition parser of pmp-zabbix-template.py.
+
+  python t/zabbix/test_perlhash.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'zabbix', 'bin'))
+
+import perlhash
+
+DEFINITIONS = os.path.join(HERE, '..', '..', 'cacti', 'definitions')
+SCRIPTS = os.path.join(HERE, '..', '..', 'cacti', 'scripts')
+
+
+class PerlHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_values(self):
+        data = perlhash.parse("""# comment
+{
+   name => 'It\\'s => here',
+   input_string => '<path_php_binary> -q '
+      . "--items <items>",
+   escaped => "a\\tb",
+   list => [ 'x', 2, { type => 6, }, ],
+   'quoted key' => -1.5,
+};""")
+        self.assertEqual(data, {'name': "It's => here", 'input_string': '<path_php_binary> -q --items <items>',
+                                'escaped': 'a\tb', 'list': ['x', 2, {'type': 6}], 'quoted key': -1.5})
+
+    def test_errors(self):
+        for text, message in [("{\n  a => 'b'\n  c => 1 }", 'x.def:3: expected "," or \'}\' but found \'c\''),
+                              ("{\n  a => 'b,\n}", 'x.def:2: unterminated string'),
+                              ("{\n  a => \n", 'x.def:3: expected a value but found end of input'),
+                              ("{ a => 'b' } x", 'x.def:1: expected end of input or \';\' but found \'x\'')]:
+            try:
+                perlhash.parse(text, 'x.def')
+                self.fail('no error for %r' % text)
+            except perlhash.ParseError as err:
+                self.assertEqual(str(err), message)
+
+    def test_magic_vars(self):
+        keys = perlhash.load_array(os.path.join(SCRIPTS, 'ss_get_mysql_stats.php'))
+        self.assertEqual(keys['Key_read_requests'], 'gg')
+        keys = perlhash.load_array(os.path.join(SCRIPTS, 'ss_get_rds_stats.py'))
+        self.assertEqual(keys['binlog_disk_usage'], 'gg')
+
+    def test_cache(self):
+        cache = perlhash.Cache(os.path.join(self.tmp, 'cache'))
+        for path in glob.glob(os.path.join(DEFINITIONS, '*.def')):
+            data = perlhash.load(path)
+            self.assertEqual(list(perlhash.load(path, cache)), list(data))
+            # From the cache, with the same dict order
+            cached = perlhash.load(path, cache)
+            self.assertEqual([list(graph['dt']) for graph in cached['graphs']],
+                             [list(graph['dt']) for graph in data['graphs']])
+
+        path = os.path.join(self.tmp, 'x.def')
+        open(path, 'w').write("{ a => 1 }")
+        self.assertEqual(perlhash.load(path, cache), {'a': 1})
+        open(path, 'w').write("{ a => 2 }")
+        os.utime(path, (0, 0))
+        self.assertEqual(perlhash.load(path, cache), {'a': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
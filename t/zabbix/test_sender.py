@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Tests of push_mysql_stats.py against a stand-in Zabbix trapper.
+
+  python t/zabbix/test_sender.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import json
+import os
+import shutil
+import SocketServer
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..', '..')
+BIN = os.path.join(ROOT, 'zabbix', 'bin')
+PUSHER = os.path.join(ROOT, 'zabbix', 'scripts', 'push_mysql_stats.py')
+SCRIPT = os.path.join(ROOT, 'cacti', 'scripts', 'ss_get_mysql_stats.php')
+sys.path.insert(0, BIN)
+
+import perlhash
+import zabbix_template as template
+
+# Prints every item of --items, with its position as value and -1 for the second one
+FAKE_PHP = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    [ "$1" = "--items" ] && ITEMS=$2
+    shift
+done
+echo $ITEMS | tr ',' '\\n' | awk '{ printf "%s%s:%d", (NR > 1 ? " " : ""), $1, NR == 2 ? -1 : NR }'
+"""
+
+
+class Trapper(SocketServer.TCPServer):
+
+    """Stand-in Zabbix trapper, keeps the requests and answers with the response set"""
+
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), TrapperHandler)
+        self.requests = []
+        self.response = 'success'
+
+
+class TrapperHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        header = self.rfile.read(5)
+        length = struct.unpack('<Q', self.rfile.read(8))[0]
+        request = json.loads(self.rfile.read(length))
+        self.server.requests.append((header, request))
+        total = len(request['data'])
+        body = json.dumps({'response': self.server.response,
+                           'info': 'processed: %d; failed: 0; total: %d; seconds spent: 0.001' % (total, total)})
+        self.wfile.write('ZBXD\x01' + struct.pack('<Q', len(body)) + body)
+
+
+class SenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.php = os.path.join(self.tmp, 'php')
+        open(self.php, 'w').write(FAKE_PHP)
+        os.chmod(self.php, 0755)
+        self.trapper = Trapper()
+        self.thread = threading.Thread(target=self.trapper.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.trapper.shutdown()
+        self.trapper.server_close()
+        shutil.rmtree(self.tmp)
+
+    def push(self, *args):
+        proc = subprocess.Popen([sys.executable, PUSHER, '--php', self.php, '--script', SCRIPT,
+                                 '-c', os.path.join(self.tmp, 'none.conf'), '-s', 'db1',
+                                 '-z', '127.0.0.1:%d' % self.trapper.server_address[1]] + list(args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return proc.returncode, out, err
+
+    def test_push(self):
+        code, out, err = self.push()
+        self.assertEqual((code, err), (0, ''))
+        keys = perlhash.load_array(SCRIPT)
+        self.assertEqual(out, 'processed: %d; failed: 0; total: %d; seconds spent: 0.001\n' % (len(keys), len(keys)))
+
+        # All the stats in one request
+        self.assertEqual(len(self.trapper.requests), 1)
+        header, request = self.trapper.requests[0]
+        self.assertEqual((header, request['request']), ('ZBXD\x01', 'sender data'))
+        values = dict((item['key'], item['value']) for item in request['data'])
+        self.assertEqual(len(values), len(keys))
+        self.assertEqual(set(item['host'] for item in request['data']), set(['db1']))
+        shorts = sorted(set(keys.values()))
+        self.assertEqual(values['MySQL.Key-read-requests'], str(shorts.index('gg') + 1))
+        # Missing value, like the agent wrapper
+        second = [item for item, short in keys.items() if short == shorts[1]][0]
+        self.assertEqual(values['MySQL.%s' % second.replace('_', '-')], '0')
+
+        # The items of the trapper template
+        tmpl, app_name, all_item_keys = template.build_template(
+            template.load_definition(os.path.join(ROOT, template.DEFINITION)), [], [])
+        template.trapper_template(tmpl, app_name, all_item_keys)
+        trapper_keys = set(item['key'] for item in tmpl['templates']['template']['items']['item']
+                           if item['type'] == template.item_types['Zabbix Trapper'])
+        self.assertEqual(trapper_keys - set(values), set())
+
+    def test_key_index(self):
+        tmpl = template.Template.from_definition(os.path.join(ROOT, template.DEFINITION), root=ROOT)
+        index = tmpl.key_index()
+        index['items']['Key_read_requests']['key'] = 'MySQL.key-reads'
+        path = os.path.join(self.tmp, 'keys.json')
+        template.write_key_index(index, open(path, 'w'))
+        code, out, err = self.push('--key-index', path)
+        self.assertEqual((code, err), (0, ''))
+        values = dict((item['key'], item['value']) for item in self.trapper.requests[0][1]['data'])
+        self.assertEqual(len(values), len(index['items']))
+        self.assertTrue('MySQL.key-reads' in values and 'MySQL.Key-read-requests' not in values)
+
+        index['format'] = 0
+        template.write_key_index(index, open(path, 'w'))
+        code, out, err = self.push('--key-index', path)
+        self.assertEqual(code, 1)
+        self.assertTrue(err.startswith('ERROR: key index %s has format 0' % path))
+
+    def test_errors(self):
+        self.trapper.response = 'failed'
+        code, out, err = self.push()
+        self.assertEqual((code, out), (1, ''))
+        self.assertTrue(err.startswith('ERROR: Zabbix server response: processed'))
+
+        open(self.php, 'w').write('#!/bin/sh\necho "Access denied"\nexit 1\n')
+        code, out, err = self.push()
+        self.assertEqual(code, 1)
+        self.assertTrue(err.startswith('ERROR: no stats, run the command manually'))
+        self.assertEqual(len(self.trapper.requests), 1)
+
+    def test_dry_run(self):
+        code, out, err = self.push('-n')
+        self.assertEqual(code, 0)
+        self.assertTrue(out.startswith('"db1" MySQL.'))
+        self.assertEqual(self.trapper.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Tests of the templates and agent configs of zabbix_template.py.
+
+  python t/zabbix/test_template.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..', '..')
+BIN = os.path.join(ROOT, 'zabbix', 'bin')
+SAMPLES = os.path.join(HERE, 'samples')
+sys.path.insert(0, BIN)
+
+import zabbix_template as template
+
+
+def mysql():
+    """Template, app name, item keys and magic vars of the MySQL definition"""
+    tmpl, app_name, all_item_keys = template.build_template(
+        template.load_definition(os.path.join(ROOT, template.DEFINITION)),
+        template.load_triggers(os.path.join(ROOT, template.TRIGGERS, 'mysql.yml')),
+        template.EXTRA_ITEMS['mysql'])
+    keys = template.load_magic_vars(os.path.join(ROOT, template.SCRIPTS, 'ss_get_mysql_stats.php'))
+    return tmpl, app_name, all_item_keys, keys
+
+
+def find(items, key):
+    return [item for item in items if item['key'] == key][0]
+
+
+def gnu_linux():
+    """Template, app name, item keys, skipped graphs and definition of the GNU/Linux definition"""
+    data = template.load_definition(os.path.join(ROOT, 'cacti', 'definitions', 'gnu_linux.def'))
+    skipped = []
+    tmpl, app_name, all_item_keys = template.build_template(
+        data, template.load_triggers(os.path.join(ROOT, template.TRIGGERS, 'gnu_linux.yml')), [], skipped)
+    return tmpl, app_name, all_item_keys, skipped, data
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_dependent(self):
+        tmpl, app_name, all_item_keys, keys = mysql()
+        agent_items = [dict(item) for item in tmpl['templates']['template']['items']['item']]
+        template.dependent_template(tmpl, app_name, all_item_keys, keys)
+        self.assertEqual(tmpl['version'], template.DEPENDENT_ZABBIX_VERSION)
+
+        items = tmpl['templates']['template']['items']['item']
+        master = items[0]
+        self.assertEqual((master['key'], master['type'], master['value_type']), ('MySQL.json', 0, 4))
+        self.assertEqual(len(items), len(agent_items) + 1)
+        dependent = set(item['key'] for item in items if item['type'] == 18)
+        self.assertEqual(len(dependent), len(all_item_keys))
+        for item in items:
+            for field in ('delta', 'multiplier', 'formula', 'data_type'):
+                self.assertFalse(field in item)
+
+        item = find(items, 'MySQL.Key-read-requests')
+        self.assertEqual(item['master_item'], {'key': 'MySQL.json'})
+        self.assertEqual(item['preprocessing']['step'], [{'type': 12, 'params': '$.gg'}, {'type': 9, 'params': ''}])
+        self.assertEqual(item['history'], '90d')
+        negated = [agent_item for agent_item in agent_items if agent_item.get('multiplier')][0]
+        item = find(items, negated['key'])
+        self.assertEqual(item['preprocessing']['step'][1], {'type': 1, 'params': negated['formula']})
+        # Still polled by the agent
+        item = find(items, 'MySQL.running-slave')
+        self.assertEqual((item['type'], item['preprocessing']), (0, ''))
+
+    def test_config(self):
+        tmpl, app_name, all_item_keys, keys = mysql()
+        extra_items = template.EXTRA_ITEMS['mysql']
+        lookup = 'UserParameter=MySQL.stats[*],%s/wrapper.py $1\n' % template.ZABBIX_SCRIPT_PATH
+        config = template.render_config(app_name, all_item_keys, keys, 'wrapper.py', extra_items)
+        lines = config.splitlines(True)
+        self.assertEqual((lines[0], len(lines)), (lookup, len(all_item_keys) + 2))
+        self.assertTrue('Alias=MySQL.Key-read-requests:MySQL.stats[gg]\n' in lines)
+        self.assertEqual(lines[-1], 'Alias=MySQL.running-slave:MySQL.stats[running-slave]\n')
+        config = template.render_config(app_name, all_item_keys, keys, 'wrapper.py', extra_items, 'dependent')
+        self.assertEqual(config, lookup + 'Alias=MySQL.json:MySQL.stats[json]\n'
+                                          'Alias=MySQL.running-slave:MySQL.stats[running-slave]\n')
+        # The trapper items are pushed, the agent only polls the trigger ones
+        config = template.render_config(app_name, all_item_keys, keys, 'wrapper.py', extra_items, 'trapper')
+        self.assertEqual(config, lookup + 'Alias=MySQL.running-slave:MySQL.stats[running-slave]\n')
+
+    def test_discovery(self):
+        tmpl, app_name, all_item_keys, skipped, data = gnu_linux()
+        rules = tmpl['templates']['template']['discovery_rules']['discovery_rule']
+        self.assertEqual([rule['key'] for rule in rules],
+                         ['GNULinux.discovery[df]', 'GNULinux.discovery[diskstats]', 'GNULinux.discovery[netdev]'])
+        df, diskstats, netdev = rules
+        self.assertTrue({'name': 'Diskfree Used on {#VOLUME}', 'key': 'GNULinux.DISKFREE-used[{#VOLUME}]'} in
+                        [dict((field, item[field]) for field in ('name', 'key'))
+                         for item in df['item_prototypes']['item_prototype']])
+        graph = netdev['graph_prototypes']['graph_prototype'][0]
+        self.assertTrue(graph['name'].endswith(' on {#DEVICE}'))
+        self.assertTrue(all(item['item']['key'].endswith('[{#DEVICE}]') for item in graph['graph_items']['graph_item']))
+        self.assertEqual(len(df['trigger_prototypes']['trigger_prototype']), 1)
+        self.assertEqual(diskstats['trigger_prototypes'], '')
+        # Discovered items are not static items
+        self.assertFalse([item for item in all_item_keys if item.startswith(('DISK_', 'NETDEV_', 'DISKFREE_'))])
+        self.assertEqual([name for name, _ in skipped], ['Disk Read/Write Time per IO Request (ms)'])
+
+        keys = template.load_magic_vars(os.path.join(ROOT, template.SCRIPTS, 'ss_get_by_ssh.php'))
+        config = template.render_discovery_config(data, app_name, keys, [name for name, _ in skipped])
+        lines = config.splitlines()
+        self.assertEqual(lines[0], 'UserParameter=GNULinux.discovery[*],%s/%s $1' % (template.ZABBIX_SCRIPT_PATH,
+                                                                                      template.DISCOVERY_COLLECTOR))
+        self.assertTrue('UserParameter=GNULinux.DISKFREE-used[*],/usr/bin/php -q %s/ss_get_by_ssh.php --host '
+                        'localhost --type df --items nj --volume $1 --use-ssh 0 | cut -d: -f2'
+                        % template.ZABBIX_SCRIPT_PATH in lines)
+        prototypes = set(item['key'].split('[')[0] for rule in rules
+                         for item in rule['item_prototypes']['item_prototype'])
+        self.assertEqual(set(line.split('[')[0][len('UserParameter='):] for line in lines[1:]), prototypes)
+
+    def test_golden(self):
+        # The mysql.def outputs of pmp-zabbix-template.py before it became a library
+        for target in template.TARGETS:
+            tmpl = template.Template.from_definition(os.path.join(ROOT, template.DEFINITION), root=ROOT)
+            tmpl.retarget(target)
+            suffix = '' if target == 'agent' else '_%s' % target
+            self.assertEqual(tmpl.config(), open(os.path.join(SAMPLES, 'userparameter_percona_mysql%s.conf'
+                                                              % suffix)).read())
+            if target == 'agent':
+                tmpl.tmpl['date'] = '2013-01-01 00:00:00'
+                self.assertEqual(tmpl.xml(), open(os.path.join(SAMPLES, 'zabbix_agent_template_percona_mysql.xml'),
+                                                  'rb').read())
+        self.assertRaises(template.TemplateError, tmpl.retarget, 'dependent')
+
+    def test_diff(self):
+        tmpl = template.Template.from_definition(os.path.join(ROOT, template.DEFINITION), root=ROOT)
+        export = os.path.join(SAMPLES, 'zabbix_agent_template_percona_mysql.xml')
+        self.assertEqual(template.diff_export(export, tmpl, True), [])
+
+        trigger = tmpl.tmpl['triggers']['trigger'][0]
+        trigger['priority'] = 1
+        items = tmpl.tmpl['templates']['template']['items']['item']
+        removed = items.pop(0)
+        items.append(dict(removed, key='MySQL.new'))
+        del tmpl.tmpl['graphs']['graph'][1:]
+        diff = template.diff_export(export, tmpl, True)
+        self.assertEqual([change for change in diff if change[1] != 'graph'],
+                         [('-', 'item', removed['key'], []), ('+', 'item', 'MySQL.new', []),
+                          ('~', 'trigger', trigger['expression'], [('priority', '5', '1')])])
+        self.assertEqual(len([change for change in diff if change[:2] == ('-', 'graph')]), 42)
+
+        # Only the added and changed objects to import
+        tmpl.only(set((kind, ident) for change, kind, ident, _ in diff if change != '-'))
+        self.assertEqual(tmpl.tmpl['templates']['template']['items']['item'], [items[-1]])
+        self.assertEqual(tmpl.tmpl['triggers']['trigger'], [trigger])
+        self.assertEqual(tmpl.tmpl['graphs'], '')
+
+    def test_triggers(self):
+        tmpl = template.Template.from_definition(os.path.join(ROOT, template.DEFINITION), root=ROOT)
+        self.assertEqual(tmpl.trigger_costs()[:2],
+                         [('MySQL is down on {HOST.NAME}', 60.0, 1),
+                          ('MySQL connections utilization more than 80% on {HOST.NAME}', 24.0, 2)])
+
+        delays = {'A.x': 300, 'A.y': 60}
+        for expression, cost in [('{T:A.x.last(0)}>1', (12.0, 1)),
+                                 ('{T:A.x.avg(3600)}>1|{T:A.y.min(#5)}<0', (72.0, 17)),
+                                 ('{T:A.x.max(1h)}>{T:A.x.prev(0)}', (12.0, 14)),
+                                 ('{T:A.y.nodata(600)}=1', (180.0, 0)),
+                                 ('{T:A.x.timeleft(1h,,0)}<3600&{T:A.y.band(#3,32)}=0', (72.0, 15))]:
+            self.assertEqual(template.trigger_cost(expression, delays), cost)
+        for expression, optimized in [('{T:A.x.last(#1)}>1', '{T:A.x.last(0)}>1'),
+                                      ('{T:A.x.avg(300)}>1&{T:A.y.max(#1)}>{T:A.y.min(120)}',
+                                       '{T:A.x.avg(300)}>1&{T:A.y.last(0)}>{T:A.y.min(120)}'),
+                                      ('{T:A.x.last(#2)}>1', '{T:A.x.last(#2)}>1'),
+                                      ('{T:A[{#V}].min(#1)}<1', '{T:A[{#V}].last(0)}<1'),
+                                      ('{T:A[{#V}].min(5m)}<1', '{T:A[{#V}].min(5m)}<1')]:
+            self.assertEqual(template.optimize_expression(expression), optimized)
+
+        # Unknown items and functions
+        data = template.load_definition(os.path.join(ROOT, template.DEFINITION))
+        for expression, error in [('{TEMPLATE:MySQL.Threads-connectd.last(0)}>1',
+                                   "Item MySQL.Threads-connectd is not defined for trigger 't'."),
+                                  ('{TEMPLATE:MySQL.Threads-connected.lst(0)}>1',
+                                   "Function lst is not supported for trigger 't'."),
+                                  ('1>0', "Trigger 't' has no item function."),
+                                  ('{TEMPLATE:MySQL.Threads-connected.forecast(1h,,30m)}>1000&'
+                                   '{TEMPLATE:MySQL.Threads-connected.percentile(1h,,95)}>900', None)]:
+            try:
+                template.build_template(data, [{'name': 't', 'expression': expression}], [])
+                self.assertEqual(error, None, expression)
+            except template.TemplateError as err:
+                self.assertEqual(str(err), error)
+
+    def test_key_index(self):
+        tmpl, app_name, all_item_keys, keys = mysql()
+        index = template.key_index(app_name, all_item_keys, keys, 'ss_get_mysql_stats.php')
+        self.assertEqual(index['items']['Key_read_requests'], {'short': 'gg', 'key': 'MySQL.Key-read-requests'})
+        self.assertEqual(index['keys']['MySQL.Key-read-requests'], 'Key_read_requests')
+        self.assertEqual(index['template_items'], sorted(all_item_keys))
+        self.assertEqual(sorted(item for items in index['shorts'].values() for item in items), sorted(keys))
+
+        del keys['Key_read_requests'], keys['Threads_connected']
+        try:
+            template.key_index(app_name, all_item_keys, keys, 'ss_get_mysql_stats.php')
+            self.fail()
+        except template.TemplateError as err:
+            self.assertEqual(str(err), 'No short key in ss_get_mysql_stats.php for the items Key_read_requests, '
+                                       'Threads_connected.')
+        self.assertRaises(template.TemplateError, template.key_index, app_name, [], {'a_b': 'x', 'a-b': 'y'})
+
+        # Nothing is rendered from incomplete magic vars
+        tmpl = template.Template.from_definition(os.path.join(ROOT, template.DEFINITION), root=ROOT)
+        del tmpl.keys['Key_read_requests']
+        self.assertRaises(template.TemplateError, tmpl.config)
+        self.assertRaises(template.TemplateError, tmpl.retarget, 'dependent')
+
+
+if __name__ == '__main__':
+    unittest.main()
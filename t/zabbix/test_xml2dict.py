@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Tests of the streaming XML reader of pmp-zabbix-template.py against the dict2xml writer.
+
+  python t/zabbix/test_xml2dict.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'zabbix', 'bin'))
+
+import dict2xml
+import xml2dict
+
+DATA = {'a': 1, 'b': 'x & <y>', 'c': None, 'e': 0.5, 'f': u'\xe9t\xe9', 'blank': '', 'empty': {},
+        'items': {'item': [{'name': 'x', 'apps': {'app': {'name': 'y'}}}, {'name': 'z', 'list': ['a', 2]}]},
+        'single': {'item': [{'name': 'w'}]}, 'deep': {'more': {'text': 'a'}}}
+
+# DATA as read back
+READ = {'a': '1', 'b': 'x & <y>', 'c': 'None', 'e': '0.5', 'f': u'\xe9t\xe9', 'blank': '', 'empty': '',
+        'items': {'item': [{'name': 'x', 'apps': {'app': {'name': 'y'}}}, {'name': 'z', 'list': ['a', '2']}]},
+        'single': {'item': {'name': 'w'}}, 'deep': {'more': {'text': 'a'}}}
+
+
+def xml(data, **kwargs):
+    return StringIO(('<?xml version="1.0" encoding="UTF-8"?>\n%s' % dict2xml.Converter(**kwargs).build(data))
+                    .encode('utf-8'))
+
+
+class ReaderTest(unittest.TestCase):
+
+    def test_parse(self):
+        for kwargs in [{'indent': '  '}, {'indent': None}, {'newlines': False}]:
+            self.assertEqual(xml2dict.parse(xml(DATA, wrap='root', **kwargs)), {'root': READ})
+        self.assertEqual(xml2dict.parse(StringIO('<root/>')), {'root': ''})
+
+    def test_iterparse(self):
+        self.assertEqual(list(xml2dict.iterparse(xml(DATA, wrap='root'), ['root/items/item', 'root/deep/more'])),
+                         [('root/deep/more', {'text': 'a'}),
+                          ('root/items/item', {'name': 'x', 'apps': {'app': {'name': 'y'}}}),
+                          ('root/items/item', {'name': 'z', 'list': ['a', '2']})])
+        # Not in the root element
+        self.assertEqual(list(xml2dict.iterparse(xml(DATA, wrap='root'), ['root/items'])),
+                         [('root/items', READ['items'])])
+
+    def test_many(self):
+        lines = [{'item': 'MySQL.%d' % num, 'value': num} for num in range(20000)]
+        path, value = list(xml2dict.iterparse(xml({'lines': {'line': lines}}, wrap='root'), ['root']))[0]
+        self.assertEqual(len(value['lines']['line']), 20000)
+        self.assertEqual(value['lines']['line'][-1], {'item': 'MySQL.19999', 'value': '19999'})
+
+
+if __name__ == '__main__':
+    unittest.main()
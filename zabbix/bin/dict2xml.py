@@ -1,4 +1,5 @@
 import collections
+from StringIO import StringIO
 
 # Grabbed from https://github.com/delfick/python-dict2xml/blob/master/dict2xml/logic.py
 
@@ -84,15 +85,7 @@ class Node(object):
             * Mapping : Supports "for key in data: value = data[key]"
             * flat : A string or something that isn't iterable or a mapping
         """
-        data = self.data
-        if type(data) in (str, unicode):
-            return 'flat'
-        elif isinstance(data, collections.Mapping):
-            return 'mapping'
-        elif isinstance(data, collections.Iterable):
-            return 'iterable'
-        else:
-            return 'flat'
+        return determine_type(self.data)
 
     def convert(self):
         """
@@ -123,6 +116,27 @@ class Node(object):
 
         return val, children
 
+
+# Types checked before the slower abstract base classes
+FLAT_TYPES = frozenset((str, unicode, int, long, float, bool, type(None)))
+
+
+def determine_type(data):
+    """Type of the data as an identifying string, see Node.determine_type"""
+    typ = type(data)
+    if typ in FLAT_TYPES:
+        return 'flat'
+    elif typ is dict:
+        return 'mapping'
+    elif typ is list:
+        return 'iterable'
+    elif isinstance(data, collections.Mapping):
+        return 'mapping'
+    elif isinstance(data, collections.Iterable):
+        return 'iterable'
+    else:
+        return 'flat'
+
 ########################
 # ##   CONVERTER
 ########################
@@ -178,6 +192,137 @@ class Converter(object):
         return ret
 
     def build(self, data):
-        """Create a Node tree from the data and return it as a serialized xml string"""
-        indenter = self._make_indenter()
-        return Node(wrap=self.wrap, data=data).serialize(indenter)
+        """Return the data serialized as an xml string"""
+        out = StringIO()
+        self.write(data, out)
+        return out.getvalue()
+
+    def write(self, data, stream, buffer_size=65536):
+        """Write the data serialized as xml to the stream, in a single pass over the data.
+
+        The output is the same as the one of the Node tree: every line of a
+        node is indented by its wrapped ancestors, so the indentation of the
+        current line is kept and written after each newline instead of
+        indenting the serialized children again at every level.
+        """
+        newline = '\n' if self.newlines else ''
+        indent = (self.indent or '') if self.newlines else ''
+        chunks = []
+        size = [0]
+        prefix = ['']
+
+        def emit(text):
+            if newline and '\n' in text:
+                text = text.replace('\n', '\n' + prefix[-1])
+            chunks.append(text)
+            size[0] += len(text)
+            if size[0] >= buffer_size:
+                flush()
+
+        def flush():
+            stream.write(''.join(chunks))
+            del chunks[:]
+            size[0] = 0
+
+        # Stack of iterators of the operations left at each level: text to
+        # emit, a node to serialize, or a change of the indentation
+        stack = [iter([(_NODE, (self.wrap, '', data))])]
+        while stack:
+            try:
+                op, arg = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            if op == _TEXT:
+                emit(arg)
+            elif op == _INDENT:
+                prefix.append(prefix[-1] + indent)
+            elif op == _DEDENT:
+                prefix.pop()
+            else:
+                stack.append(_operations(arg[0], arg[1], arg[2], newline))
+        flush()
+
+
+# Operations of Converter.write
+_TEXT, _NODE, _INDENT, _DEDENT = range(4)
+
+
+def _escape(data):
+    for entity, replacement in Node.entities:
+        data = data.replace(entity, replacement)
+    return data
+
+
+def _flat(wrap, tag, data):
+    """Serialized flat node, as Node.serialize does it"""
+    if type(data) in (str, unicode):
+        val = _escape(data)
+    else:
+        val = unicode(data)
+    if tag:
+        val = "<%s>%s</%s>" % (tag, val, tag)
+    if wrap:
+        val = "<%s>%s</%s>" % (wrap, val, wrap)
+    return val
+
+
+def _operations(wrap, tag, data, newline):
+    """Yield the operations serializing one node, its children are yielded as nodes"""
+    typ = determine_type(data)
+    if typ == 'flat':
+        yield _TEXT, _flat(wrap, tag, data)
+        return
+
+    start = end = ''
+    if wrap:
+        start = "<%s>" % wrap
+        end = "</%s>" % wrap
+
+    if typ == 'mapping':
+        if not data:
+            yield _TEXT, start + end
+            return
+        yield _TEXT, start
+        if wrap:
+            # Each child on its own line, indented
+            yield _INDENT, None
+            for key in sorted(data):
+                value = data[key]
+                if determine_type(value) == 'flat':
+                    yield _TEXT, newline + _flat(key, "", value)
+                else:
+                    yield _TEXT, newline
+                    yield _NODE, (key, "", value)
+            yield _DEDENT, None
+            yield _TEXT, newline + end
+        else:
+            for num, key in enumerate(sorted(data)):
+                separator = newline if num else ''
+                value = data[key]
+                if determine_type(value) == 'flat':
+                    yield _TEXT, separator + _flat(key, "", value)
+                else:
+                    if separator:
+                        yield _TEXT, separator
+                    yield _NODE, (key, "", value)
+            yield _TEXT, end
+        return
+
+    # Iterables repeat the wrap for each child
+    first = True
+    for item in data:
+        separator = '' if first else newline
+        first = False
+        if determine_type(item) == 'flat':
+            yield _TEXT, separator + _flat("", wrap, item)
+        else:
+            if separator:
+                yield _TEXT, separator
+            yield _INDENT, None
+            yield _TEXT, start + newline
+            yield _NODE, ("", wrap, item)
+            yield _DEDENT, None
+            yield _TEXT, newline + end
+    if first:
+        yield _TEXT, start + end
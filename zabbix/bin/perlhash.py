@@ -0,0 +1,282 @@
+"""
+Parser of the Perl data structure subset of the Cacti template definitions
+and of the MAGIC_VARS_DEFINITIONS arrays of the Cacti scripts, with a cache of
+the parsed results.
+
+Supported: hash refs { key => value, ... }, array refs [ value, ... ], PHP
+array( key => value, ... ), single and double quoted strings joined with ".",
+bareword keys, integers and "#" comments.  Trailing commas are allowed.
+
+License: GPL License (see COPYING)
+Copyright: 2013 Percona
+"""
+import errno
+import hashlib
+import marshal
+import os
+import re
+
+# Bump when the parser output changes, so the cached results are dropped
+CACHE_FORMAT = 1
+
+TOKENS = re.compile(r"""
+    (?P<space>[ \t\r\f\v]+)
+  | (?P<newline>\n)
+  | (?P<comment>\#[^\n]*)
+  | (?P<squote>'(?:[^'\\]|\\.)*')
+  | (?P<dquote>"(?:[^"\\]|\\.)*")
+  | (?P<arrow>=>)
+  | (?P<number>-?\d+(?:\.\d+)?(?![\w.]))
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<punct>[{}\[\](),.;])
+""", re.VERBOSE | re.DOTALL)
+
+DQUOTE_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '0': '\0', '\\': '\\', '"': '"', '$': '$', '@': '@'}
+
+
+def mapping(pairs):
+    """Dict of the (key, value) pairs.
+
+    Built the way the YAML loader used before did, filled in and copied, so
+    the dict order and thus the generated templates stay the same.
+    """
+    result = {}
+    for key, value in pairs:
+        result[key] = value
+    data = {}
+    data.update(result)
+    return data
+
+
+def load_tree(data):
+    """Value of the parse tree, where hashes are tuples of (key, value) pairs in the order
+    of the source, the compact form kept in the cache
+    """
+    if isinstance(data, tuple):
+        return mapping((key, load_tree(value)) for (key, value) in data)
+    elif isinstance(data, list):
+        return [load_tree(value) for value in data]
+    return data
+
+
+class ParseError(Exception):
+
+    def __init__(self, path, line, message):
+        Exception.__init__(self, '%s:%d: %s' % (path, line, message))
+        self.path = path
+        self.line = line
+
+
+def tokenize(text, path='<string>', line=1):
+    """Yield (kind, value, line) tokens, strings unquoted"""
+    pos = 0
+    end = len(text)
+    while pos < end:
+        match = TOKENS.match(text, pos)
+        if not match:
+            if text[pos] in '\'"':
+                raise ParseError(path, line, 'unterminated string')
+            raise ParseError(path, line, 'unexpected character %r' % text[pos])
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'newline':
+            line += 1
+        elif kind == 'squote':
+            yield 'string', re.sub(r"\\([\\'])", r'\1', value[1:-1]), line
+            line += value.count('\n')
+        elif kind == 'dquote':
+            yield 'string', re.sub(r'\\(.)', lambda m: DQUOTE_ESCAPES.get(m.group(1), '\\' + m.group(1)),
+                                   value[1:-1]), line
+            line += value.count('\n')
+        elif kind == 'number':
+            yield 'number', float(value) if '.' in value else int(value), line
+        elif kind not in ('space', 'comment'):
+            yield kind if kind != 'punct' else value, value, line
+        pos = match.end()
+    yield 'end', None, line
+
+
+class Parser(object):
+
+    """Recursive descent parser over the tokens of one value, returns its parse tree"""
+
+    def __init__(self, text, path='<string>', line=1):
+        self.path = path
+        self.tokens = tokenize(text, path, line)
+        self.next()
+
+    def next(self):
+        self.kind, self.value, self.line = next(self.tokens)
+
+    def error(self, expected):
+        found = 'end of input' if self.kind == 'end' else repr(self.value)
+        raise ParseError(self.path, self.line, 'expected %s but found %s' % (expected, found))
+
+    def expect(self, kind):
+        if self.kind != kind:
+            self.error(repr(kind))
+        self.next()
+
+    def parse(self, terminators=('end', ';')):
+        """Parse one value followed by one of the terminators"""
+        value = self.value_()
+        if self.kind not in terminators:
+            self.error(' or '.join('end of input' if t == 'end' else repr(t) for t in terminators))
+        return value
+
+    def value_(self):
+        kind = self.kind
+        if kind == '{':
+            self.next()
+            return self.pairs('}')
+        elif kind == '[':
+            self.next()
+            return self.items(']')
+        elif kind == 'word' and self.value == 'array':
+            self.next()
+            self.expect('(')
+            return self.pairs(')')
+        elif kind == 'string':
+            value = self.value
+            self.next()
+            # Concatenation of strings
+            while self.kind == '.':
+                self.next()
+                if self.kind != 'string':
+                    self.error('a string after "."')
+                value += self.value
+                self.next()
+            return value
+        elif kind == 'number':
+            value = self.value
+            self.next()
+            return value
+        self.error('a value')
+
+    def key(self):
+        if self.kind in ('string', 'word', 'number'):
+            key = self.value
+            self.next()
+            return key
+        self.error('a key')
+
+    def pairs(self, close):
+        result = []
+        while self.kind != close:
+            key = self.key()
+            self.expect('arrow')
+            result.append((key, self.value_()))
+            if self.kind == ',':
+                self.next()
+            elif self.kind != close:
+                self.error('"," or %r' % close)
+        self.next()
+        return tuple(result)
+
+    def items(self, close):
+        result = []
+        while self.kind != close:
+            result.append(self.value_())
+            if self.kind == ',':
+                self.next()
+            elif self.kind != close:
+                self.error('"," or %r' % close)
+        self.next()
+        return result
+
+
+def parse_tree(text, path='<string>'):
+    """Parse tree of a definition, a single hash ref with an optional ";" after it"""
+    return Parser(text, path).parse()
+
+
+def parse_array_tree(text, path='<string>', start='$keys = array('):
+    """Parse tree of the PHP array() starting at start, e.g. the magic vars of a script"""
+    pos = text.find(start)
+    if pos < 0:
+        raise ParseError(path, 1, '%r not found' % start)
+    pos += start.rindex('array(')
+    return Parser(text[pos:], path, text.count('\n', 0, pos) + 1).parse()
+
+
+def parse(text, path='<string>'):
+    """Parse a definition"""
+    return load_tree(parse_tree(text, path))
+
+
+def parse_array(text, path='<string>', start='$keys = array('):
+    """Parse the PHP array() starting at start"""
+    return load_tree(parse_array_tree(text, path, start))
+
+
+class Cache(object):
+
+    """Parsed files stored with marshal, keyed by file path, checked by mtime and content hash.
+
+    An entry whose mtime matches is used as is, else the file is hashed and
+    the entry is still used if the content did not change.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _entry(self, path, kind):
+        name = hashlib.md5(('%s\0%s' % (os.path.abspath(path), kind)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '%s.bin' % name)
+
+    def load(self, path, kind, parser):
+        """Return the value of the parser(text, path) tree of the file, from the cache if it is up to date"""
+        entry = self._entry(path, kind)
+        mtime = os.stat(path).st_mtime
+        cached = None
+        try:
+            fh = open(entry, 'rb')
+            try:
+                cached = marshal.load(fh)
+            finally:
+                fh.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        if cached and cached[0] == CACHE_FORMAT and cached[1] == mtime:
+            return load_tree(cached[3])
+
+        fh = open(path, 'rb')
+        raw = fh.read()
+        fh.close()
+        digest = hashlib.md5(raw).hexdigest()
+        if cached and cached[0] == CACHE_FORMAT and cached[2] == digest:
+            tree = cached[3]
+        else:
+            tree = parser(raw.decode('utf-8'), path)
+        self._store(entry, (CACHE_FORMAT, mtime, digest, tree))
+        return load_tree(tree)
+
+    def _store(self, entry, value):
+        try:
+            os.makedirs(self.directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                return
+        # Written aside and renamed, so concurrent builds never read half an entry
+        tmp = '%s.%d' % (entry, os.getpid())
+        try:
+            fh = open(tmp, 'wb')
+            marshal.dump(value, fh)
+            fh.close()
+            os.rename(tmp, entry)
+        except (IOError, OSError):
+            pass
+
+
+def load(path, cache=None):
+    """Parse a definition file"""
+    if cache:
+        return cache.load(path, 'definition', parse_tree)
+    return parse(open(path, 'rb').read().decode('utf-8'), path)
+
+
+def load_array(path, cache=None):
+    """Parse the magic vars of a Cacti script"""
+    if cache:
+        return cache.load(path, 'array', parse_array_tree)
+    return parse_array(open(path, 'rb').read().decode('utf-8'), path)
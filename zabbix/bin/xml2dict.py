@@ -0,0 +1,80 @@
+"""Read XML into the dicts dict2xml.Converter writes it from, in a single streaming pass.
+
+An element with children is a dict of them by tag, a tag repeated in it is a
+list of the children with that tag, and an element without children is its
+text, '' if it has none.  The numbers written by the converter read back as
+strings, and a list of one child reads back as the child itself.
+
+  data = xml2dict.parse(open('template.xml'))['zabbix_export']
+
+iterparse() yields the elements at the given paths one at a time instead, and
+only keeps the one being read in memory, e.g. the items of a Zabbix export:
+
+  for path, item in xml2dict.iterparse(stream, ['zabbix_export/templates/template/items/item']):
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+"""
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+def _add(children, tag, value):
+    """Add the value of a child to the dict of its parent"""
+    if tag not in children:
+        children[tag] = value
+    elif type(children[tag]) is _Repeated:
+        children[tag].append(value)
+    else:
+        children[tag] = _Repeated([children[tag], value])
+
+
+class _Repeated(list):
+    """List of the children with the same tag, unlike a list read from a text"""
+    pass
+
+
+def iterparse(stream, paths=None):
+    """Yield (path, value) of the elements at the paths, or of the root element if paths is None.
+
+    A path is the tags from the root down to the element, separated by '/'.
+    The elements yielded are not added to their parent, and every element is
+    dropped from the element tree once read, so the memory used is bounded
+    by the biggest element yielded.
+    """
+    if paths is not None:
+        paths = set(paths)
+    # Path, element and children dict of the elements being read
+    stack = []
+    for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            path = '%s/%s' % (stack[-1][0], elem.tag) if stack else elem.tag
+            stack.append((path, elem, None))
+            continue
+        path, elem, children = stack.pop()
+        if children is None:
+            value = elem.text or ''
+        else:
+            value = dict((tag, list(child) if type(child) is _Repeated else child)
+                         for tag, child in children.iteritems())
+        elem.clear()
+        if stack:
+            # The element is the last child of its parent while it ends
+            parent_path, parent, siblings = stack[-1]
+            del parent[-1]
+        if paths is None and not stack or paths is not None and path in paths:
+            yield path, value
+        elif stack:
+            if siblings is None:
+                siblings = dict()
+                stack[-1] = (parent_path, parent, siblings)
+            _add(siblings, elem.tag, value)
+
+
+def parse(stream):
+    """The XML of the stream as a dict of its root element"""
+    for path, value in iterparse(stream):
+        return {path: value}
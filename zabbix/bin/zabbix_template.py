@@ -0,0 +1,1008 @@
+"""Zabbix templates and agent configs built from the Perl definitions for Cacti.
+
+The library behind pmp-zabbix-template.py:
+
+  tmpl = Template.from_definition('cacti/definitions/mysql.def')
+  tmpl.retarget('dependent')
+  tmpl.write_xml(open('template.xml', 'w'))
+  open('userparameter.conf', 'w').write(tmpl.config())
+
+build_template() and the other functions work on the dicts of the parsed
+definition and of the template, the Template object keeps them together.
+
+License: GPL License (see COPYING)
+Copyright: 2013 Percona
+Authors: Roman Vynar
+"""
+import codecs
+import dict2xml
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import perlhash
+import re
+import StringIO
+import time
+import xml2dict
+import yaml
+
+# Constants
+ZABBIX_VERSION = '2.0'
+ZABBIX_SCRIPT_PATH = '/var/lib/zabbix/percona/scripts'
+DEFINITIONS = 'cacti/definitions'
+DEFINITION = 'cacti/definitions/mysql.def'
+SCRIPTS = 'cacti/scripts'
+TRIGGERS = 'zabbix/triggers'
+CACHE_DIR = os.path.expanduser('~/.cache/pmp-zabbix-template')
+
+# Agent wrappers of the Cacti scripts, the agent config is only written for
+# the definitions polled by a script having one.  The agent runs them with a
+# single flexible user parameter, LOOKUP_ITEM[*], every item key is an alias of
+# LOOKUP_ITEM[<magic var>] (Alias requires Zabbix agent 2.2+).
+WRAPPERS = {'ss_get_mysql_stats.php': 'get_mysql_stats.py'}
+LOOKUP_ITEM = 'stats'
+# Scripts sending the stats of a Cacti script to the trapper items
+PUSHERS = {'ss_get_mysql_stats.php': 'push_mysql_stats.py'}
+
+# Key index of the definitions polled by a wrapper or pusher, read by them
+KEY_INDEX = 'percona_%s_keys.json'
+# Bump when the content of the key index changes
+KEY_INDEX_FORMAT = 1
+
+# Objects compared by diff_export(), by path in an export: kind and field identifying them
+EXPORT_OBJECTS = [('zabbix_export/templates/template/items/item', 'item', 'key'),
+                  ('zabbix_export/templates/template/discovery_rules/discovery_rule', 'discovery rule', 'key'),
+                  ('zabbix_export/graphs/graph', 'graph', 'name'),
+                  ('zabbix_export/triggers/trigger', 'trigger', 'expression')]
+
+# Function references of a trigger expression: {host:key.function(parameters)}
+TRIGGER_FUNCTION = re.compile(r'\{([^{}:]+):(.+?)\.(\w+)\(([^()]*)\)\}')
+# Trigger functions by the values they read from the history: the last ones
+# by count, the ones of the time or count window of their first parameter, or
+# none for the ones of the clock
+LAST_FUNCTIONS = {'last': 1, 'prev': 2, 'change': 2, 'diff': 2, 'abschange': 2, 'strlen': 1, 'fuzzytime': 1,
+                  'logeventid': 1, 'logseverity': 1, 'logsource': 1}
+WINDOW_FUNCTIONS = set(['avg', 'band', 'count', 'delta', 'forecast', 'iregexp', 'max', 'min', 'percentile', 'regexp',
+                        'str', 'sum', 'timeleft'])
+CLOCK_FUNCTIONS = set(['date', 'dayofmonth', 'dayofweek', 'now', 'time', 'nodata'])
+# Seconds between the evaluations of the triggers with clock functions by the timer
+TIMER_INTERVAL = 30
+# Seconds between the values of the items without update interval, pushed by cron
+PUSH_INTERVAL = 300
+
+# Items required by the triggers of a definition, "key" is an agent key as is,
+# "item" is passed to the wrapper
+EXTRA_ITEMS = {'mysql': [{'name': 'Total number of mysqld processes',
+                          'key': 'proc.num[mysqld]'},
+                         {'name': 'MySQL running slave',
+                          'item': 'running-slave'}]}
+
+# Low-level discovery of the objects of the Cacti inputs taking one, by the
+# --type of the input: name of the discovery rule and input field of the object.
+# discover_objects.py lists them, the item prototypes run the Cacti script on
+# the agent host with LOCAL_OPTIONS.
+DISCOVERY = {'diskstats': {'name': 'Disk discovery', 'field': 'device'},
+             'netdev': {'name': 'Network interface discovery', 'field': 'device'},
+             'df': {'name': 'Volume discovery', 'field': 'volume'}}
+DISCOVERY_COLLECTOR = 'discover_objects.py'
+LOCAL_OPTIONS = '--use-ssh 0'
+PHP_BINARY = '/usr/bin/php'
+
+# Targets: "agent" polls every item with the agent, "dependent" polls one master
+# item returning all the stats as JSON, whose dependent items extract the values
+# (Zabbix 3.4+, export format of DEPENDENT_ZABBIX_VERSION), "trapper" makes
+# trapper items receiving all the stats at once from the PUSHERS
+TARGETS = ('agent', 'dependent', 'trapper')
+DEPENDENT_ZABBIX_VERSION = '3.4'
+# Master item, passed to the wrapper, which prints the stats as JSON
+MASTER_ITEM = 'json'
+
+item_types = {'Zabbix agent': 0,
+              'Zabbix agent (active)': 7,
+              'Simple check': 3,
+              'SNMPv1': 1,
+              'SNMPv2': 4,
+              'SNMPv3': 6,
+              'SNMP Trap': 17,
+              'Zabbix Internal': 5,
+              'Zabbix Trapper': 2,
+              'Zabbix Aggregate': 8,
+              'External check ': 10,
+              'Database monitor': 11,
+              'IPMI agent': 12,
+              'SSH agent': 13,
+              'TELNET agent': 14,
+              'JMX agent': 16,
+              'Calculated': 15,
+              'Dependent item': 18}
+
+item_value_types = {'Numeric (unsigned)': 3,
+                    'Numeric (float)': 0,
+                    'Character': 1,
+                    'Log': 2,
+                    'Text': 4}
+
+# Cacti to Zabbix relation
+item_store_values = {1: 0,  # GAUGE == As is
+                     2: 1,  # COUNTER == Delta (speed per second)
+                     3: 1}  # DERIVE == Delta (speed per second)
+# Others: Delta (simple change) 2
+
+# Zabbix 3.4+, they replace the multiplier and delta of the items
+preprocessing_types = {'Custom multiplier': 1,
+                       'Change per second': 9,
+                       'Simple change': 10,
+                       'JSONPath': 12}
+
+graph_types = {'Normal': 0,
+               'Stacked': 1,
+               'Pie': 2,
+               'Exploded': 3}
+
+graph_item_functions = {'all': 7,
+                        'min': 1,
+                        'avg': 2,
+                        'max': 4}
+
+# Cacti to Zabbix relation
+graph_item_draw_styles = {'LINE1': 0,  # Line
+                          'LINE2': 2,  # Bold line
+                          'AREA':  1,  # Filled region
+                          'STACK': 0}  # Line
+# Others: Dot 3, Dashed line 4, Gradient line 5
+
+graph_y_axis_sides = {'Left': 0,
+                      'Right': 1}
+
+trigger_severities = {'Not_classified': 0,
+                      'Information': 1,
+                      'Warning': 2,
+                      'Average': 3,
+                      'High': 4,
+                      'Disaster': 5}
+
+
+class TemplateError(Exception):
+    pass
+
+
+# Cache of the parsed definitions and magic vars, None to parse every time
+cache = perlhash.Cache(CACHE_DIR)
+
+
+def load_definition(path):
+    """Read Cacti template definition file"""
+    try:
+        return perlhash.load(path, cache)
+    except perlhash.ParseError as err:
+        raise TemplateError(err)
+
+
+def load_magic_vars(path):
+    """Read Perl hash aka MAGIC_VARS_DEFINITIONS from Cacti script"""
+    try:
+        return perlhash.load_array(path, cache)
+    except perlhash.ParseError as err:
+        raise TemplateError(err)
+
+
+def load_triggers(path):
+    """Read triggers from YAML file, none if there is no file"""
+    if not os.path.exists(path):
+        return []
+    return yaml.safe_load(open(path, 'r')) or []
+
+
+def definition_script(path):
+    """Name of the Cacti script polling for a definition, from its Autobuild comment"""
+    for line in open(path, 'r'):
+        match = re.match(r'#\s*Autobuild:\s*(\S+)', line)
+        if match:
+            return match.group(1)
+        elif line.strip() and not line.startswith('#'):
+            break
+    return None
+
+
+def load_shared(paths):
+    """Parse the triggers and the magic vars of the scripts of all the definitions once"""
+    shared = {'triggers': {}, 'keys': {}, 'scripts': {}}
+    for path in paths:
+        base = os.path.splitext(os.path.basename(path))[0]
+        shared['triggers'][base] = load_triggers(os.path.join(TRIGGERS, '%s.yml' % base))
+        script = definition_script(path)
+        shared['scripts'][base] = script
+        if script and script not in shared['keys'] and os.path.splitext(script)[1] == '.php':
+            shared['keys'][script] = load_magic_vars(os.path.join(SCRIPTS, script))
+    return shared
+
+
+def add_screen_item(tmpl, graph_name, tmpl_name, x, y):
+    """Add a graph to the screen"""
+    z_screen_item = {'resourcetype': 0,  # Graph
+                     'width': 500,
+                     'height': 120,
+                     'valign': 1,  # Middle
+                     'halign': 0,  # Center
+                     'colspan': 1,
+                     'rowspan': 1,
+                     'x': x,
+                     'y': y,
+                     'dynamic': 1,
+                     'resource': {'name': graph_name,
+                                  'host': tmpl_name}}
+    tmpl['screens']['screen']['screen_items']['screen_item'].append(z_screen_item)
+    tmpl['templates']['template']['screens'] = tmpl['screens']
+
+
+def graph_discovery(data, graph):
+    """(kind, LLD macro) of a graph of discovered objects, (None, None) for a static graph"""
+    cacti_input = data.get('inputs', {}).get(graph['dt'].get('input'), {})
+    match = re.search(r'--type (\S+)', cacti_input.get('input_string', ''))
+    kind = match and match.group(1)
+    fields = [field['name'] for field in cacti_input.get('inputs', []) if field.get('override')]
+    if kind in DISCOVERY and DISCOVERY[kind]['field'] in fields:
+        return kind, '{#%s}' % DISCOVERY[kind]['field'].upper()
+    return None, None
+
+
+def discovery_rule(app_name, kind):
+    """Empty discovery rule of a kind of objects"""
+    return {'name': DISCOVERY[kind]['name'],
+            'type': item_types['Zabbix agent'],
+            'key': '%s[%s]' % (format_item(app_name, 'discovery'), kind),
+            'delay': 3600,  # Update interval (in sec)
+            'status': 0,
+            'lifetime': 30,  # Days to keep the items of the lost objects
+            'filter': ':',
+            'description': '',
+            'item_prototypes': {'item_prototype': []},
+            'trigger_prototypes': {'trigger_prototype': []},
+            'graph_prototypes': {'graph_prototype': []}}
+
+
+def build_template(data, triggers, extra_items, skipped=None):
+    """Return the Zabbix template and the item keys of a definition.
+
+    The graphs of discovered objects and their items go to discovery rules as
+    prototypes, their keys having the object as parameter.  The graphs with
+    unsupported graph items raise a TemplateError, or are appended to skipped
+    as (graph name, error) if it is a list.
+    """
+    # Define the base of Zabbix template
+    tmpl = dict()
+    app_name = re.sub(r' Server$', '', data['name'])
+    tmpl_name = 'Percona %s Template' % data['name']
+    tmpl['version'] = ZABBIX_VERSION
+    tmpl['date'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    tmpl['groups'] = {'group': {'name': 'Percona Templates'}}
+    tmpl['screens'] = {'screen': {'name': '%s Graphs' % app_name,
+                                  'hsize': 2,
+                                  'vsize': 0,
+                                  'screen_items': {'screen_item': []}}}
+    tmpl['templates'] = {'template': {'template': tmpl_name,
+                                      'name': tmpl_name,
+                                      'groups': tmpl['groups'],
+                                      'applications': {'application': {'name': app_name }},
+                                      'items': {'item': []},
+                                      'macros': ''}}
+    tmpl['graphs'] = {'graph': []}
+    tmpl['triggers'] = ''
+
+    # Parse definition
+    all_item_keys = set()
+    rules = dict()
+    x = y = 0
+    for graph in data['graphs']:
+        kind, macro = graph_discovery(data, graph)
+        key_param = '[%s]' % macro if kind else ''
+        name_suffix = ' on %s' % macro if kind else ''
+
+        # Populate graph
+        z_graph = {'name': graph['name'] + name_suffix,
+                   'width': 900,
+                   'height': 200,
+                   'graphtype': graph_types['Normal'],
+                   'show_legend': 1,
+                   'show_work_period': 1,
+                   'show_triggers': 1,
+                   'ymin_type': 0,  # Calculated
+                   'ymax_type': 0,  # Calculated
+                   'ymin_item_1': 0,
+                   'ymax_item_1': 0,
+                   'show_3d': 0,
+                   'percent_left': '0.00',
+                   'percent_right': '0.00',
+                   'graph_items': {'graph_item': []}}
+
+        # Populate graph items
+        multipliers = dict()
+        i = 0
+        try:
+            for item in graph['items']:
+                draw_type = item['type']
+                if draw_type not in graph_item_draw_styles.keys():
+                    raise TemplateError("Cacti graph item type %s is not supported for item %s." % (draw_type, item['item']))
+                cdef = item.get('cdef')
+                if cdef and cdef not in ('Negate', 'Turn Into Bits'):
+                    raise TemplateError("CDEF %s is not supported for item %s." % (cdef, item['item']))
+        except TemplateError as err:
+            if skipped is None:
+                raise
+            skipped.append((graph['name'], str(err)))
+            continue
+        for item in graph['items']:
+            if item not in ['hash', 'task']:
+                draw_type = item['type']
+                cdef = item.get('cdef')
+                if cdef == 'Negate':
+                    multipliers[item['item']] = (1, -1)
+                elif cdef == 'Turn Into Bits':
+                    multipliers[item['item']] = (1, 8)
+                else:
+                    multipliers[item['item']] = (0, 1)
+                z_graph_item = {'item': {'key': format_item(app_name, item['item']) + key_param,
+                                         'host': tmpl_name},
+                                'calc_fnc': graph_item_functions['avg'],
+                                'drawtype': graph_item_draw_styles[draw_type],
+                                'yaxisside': graph_y_axis_sides['Left'],
+                                'color': item['color'],
+                                'sortorder': i,
+                                'type': 0}
+                z_graph['graph_items']['graph_item'].append(z_graph_item)
+                i = i + 1
+
+        if kind:
+            if kind not in rules:
+                rules[kind] = discovery_rule(app_name, kind)
+            rules[kind]['graph_prototypes']['graph_prototype'].append(z_graph)
+            items = rules[kind]['item_prototypes']['item_prototype']
+        else:
+            tmpl['graphs']['graph'].append(z_graph)
+            items = tmpl['templates']['template']['items']['item']
+            add_screen_item(tmpl, graph['name'], tmpl_name, x, y)
+            if x == 0:
+                x = 1
+            else:
+                x = 0
+                y = y + 1
+
+        # Populate items
+        for item in graph['dt'].keys():
+            if item not in ['hash', 'input']:
+                ds_type = int(graph['dt'][item]['data_source_type_id'])
+                if ds_type == 4:
+                    raise TemplateError("Cacti DS type ABSOLUTE is not supported for item %s." % item)
+                name = item.replace('_', ' ').title()
+                name = re.sub(r'^[A-Z]{4,} ', '', name) + name_suffix
+                base_value = int(graph['base_value'])
+                if base_value == 1000:
+                    unit = ''
+                elif base_value == 1024:
+                    unit = 'B'
+                else:
+                    raise TemplateError("base_value %s is not supported for item %s." % (base_value, item))
+                z_item = {'name': name,
+                          'type': item_types['Zabbix agent'],
+                          'key': format_item(app_name, item) + key_param,
+                          'value_type': item_value_types['Numeric (float)'],
+                          'data_type': 0,  # Decimal the above is Numeric (unsigned)
+                          'units': unit,
+                          'delay': 300,  # Update interval (in sec)
+                          'history': 90,
+                          'trends': 365,
+                          'delta': item_store_values[ds_type],
+                          'applications': {'application': {'name': app_name }},
+                          'description': '%s %s' % (app_name, name),
+                          'multiplier': multipliers.get(item, (0, 1))[0],
+                          'formula': multipliers.get(item, (0, 1))[1],
+                          'status': 0}
+                items.append(z_item)
+                if not kind:
+                    all_item_keys.add(item)
+
+    screen = tmpl['screens']['screen']
+    screen['vsize'] = int(round(len(screen['screen_items']['screen_item']) / 2.0))
+    if rules:
+        tmpl['templates']['template']['discovery_rules'] = {'discovery_rule': [rules[rule]
+                                                                               for rule in sorted(rules)]}
+    # Add extra items required by triggers
+    for item in extra_items:
+        z_item = {'name': item['name'],
+                  'key': item.get('key') or format_item(app_name, item['item']),
+                  'type': item_types['Zabbix agent'],
+                  'value_type': item_value_types['Numeric (unsigned)'],
+                  'data_type': 0,
+                  'delay': 60,  # Update interval (in sec)
+                  'history': 90,
+                  'trends': 365,
+                  'delta': 0,  # As is
+                  'applications': {'application': {'name': app_name }},
+                  'description': item['name'],
+                  'status': 0}
+        tmpl['templates']['template']['items']['item'].append(z_item)
+
+    # Populate trigger prototypes, the triggers of a discovery rule
+    for trigger in [t for t in triggers if t.get('discovery')]:
+        if trigger['discovery'] not in rules:
+            raise TemplateError("Discovery rule %s is not defined for trigger '%s'." % (trigger['discovery'],
+                                                                                        trigger['name']))
+        rules[trigger['discovery']]['trigger_prototypes']['trigger_prototype'].append(
+            {'name': trigger['name'],
+             'expression': trigger['expression'].replace('TEMPLATE', tmpl_name),
+             'priority': trigger_severities[trigger.get('severity', 'Not_classified')],
+             'status': 0})  # Enabled
+    for rule in rules.values():
+        if not rule['trigger_prototypes']['trigger_prototype']:
+            rule['trigger_prototypes'] = ''
+    triggers = [t for t in triggers if not t.get('discovery')]
+
+    # Populate triggers
+    trigger_refs = dict((t['name'], t['expression'].replace('TEMPLATE', tmpl_name)) for t in triggers)
+    if trigger_refs:
+        tmpl['triggers'] = {'trigger': []}
+    for trigger in triggers:
+        z_trigger = {'name': trigger['name'],
+                     'expression': trigger['expression'].replace('TEMPLATE', tmpl_name),
+                     'priority': trigger_severities[trigger.get('severity', 'Not_classified')],
+                     'status': 0,  # Enabled
+                     'dependencies': ''}
+        # Populate trigger dependencies
+        if trigger.get('dependencies'):
+            z_trigger['dependencies'] = {'dependency': []}
+            for dep in trigger['dependencies']:
+                exp = trigger_refs.get(dep)
+                if not exp:
+                    raise TemplateError("Dependency trigger '%s' is not defined for trigger '%s'." % (dep, trigger['name']))
+                z_trigger_dep = {'name': dep,
+                                 'expression': exp}
+                z_trigger['dependencies']['dependency'].append(z_trigger_dep)
+        tmpl['triggers']['trigger'].append(z_trigger)
+
+    # Reject the triggers of items the template does not have
+    keys = set(item['key'] for item in tmpl['templates']['template']['items']['item'])
+    for trigger in tmpl['triggers'] and tmpl['triggers']['trigger']:
+        check_trigger(trigger, tmpl_name, keys)
+    for rule in rules.values():
+        prototype_keys = keys | set(item['key'] for item in rule['item_prototypes']['item_prototype'])
+        for trigger in rule['trigger_prototypes'] and rule['trigger_prototypes']['trigger_prototype']:
+            check_trigger(trigger, tmpl_name, prototype_keys)
+
+    return tmpl, app_name, all_item_keys
+
+
+def trigger_functions(expression):
+    """(host, key, function, parameters) of the function references of a trigger expression"""
+    return [(host, key, function, [param.strip() for param in params.split(',')] if params.strip() else [])
+            for host, key, function, params in TRIGGER_FUNCTION.findall(expression)]
+
+
+def check_trigger(trigger, tmpl_name, keys):
+    """Raise a TemplateError if a trigger refers to an item of the template it does not have"""
+    functions = trigger_functions(trigger['expression'])
+    if not functions:
+        raise TemplateError("Trigger '%s' has no item function." % trigger['name'])
+    for host, key, function, params in functions:
+        if host == tmpl_name and key not in keys:
+            raise TemplateError("Item %s is not defined for trigger '%s'." % (key, trigger['name']))
+        if function not in LAST_FUNCTIONS and function not in WINDOW_FUNCTIONS and function not in CLOCK_FUNCTIONS:
+            raise TemplateError("Function %s is not supported for trigger '%s'." % (function, trigger['name']))
+
+
+def seconds(value):
+    """Seconds of a time parameter, with an optional s, m, h, d or w suffix"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value or 0)
+
+
+def function_reads(function, params, delay):
+    """History values a trigger function reads per evaluation, for an item updated every delay seconds"""
+    if function in CLOCK_FUNCTIONS:
+        return 0
+    window = params[0] if params else ''
+    if function in LAST_FUNCTIONS:
+        if window.startswith('#'):
+            return max(int(window[1:]), LAST_FUNCTIONS[function])
+        return LAST_FUNCTIONS[function]
+    if window.startswith('#'):
+        return int(window[1:])
+    return max(1, seconds(window) // max(delay, 1))
+
+
+def item_delays(tmpl):
+    """Seconds between the values of the items and item prototypes of a template, by key"""
+    template = tmpl['templates']['template']
+    items = list(template['items']['item'])
+    if template.get('discovery_rules'):
+        for rule in template['discovery_rules']['discovery_rule']:
+            items.extend(rule['item_prototypes']['item_prototype'])
+    delays = dict((item['key'], item['delay']) for item in items)
+    for item in items:
+        if item.get('master_item'):
+            # Dependent items get their values with the ones of their master item
+            delays[item['key']] = delays[item['master_item']['key']]
+    return dict((key, int(delay) or PUSH_INTERVAL) for key, delay in delays.items())
+
+
+def trigger_cost(expression, delays):
+    """(evaluations per hour, history values read per evaluation) of a trigger expression.
+
+    A trigger is evaluated on every new value of its items, and by the timer
+    if it has a clock function.
+    """
+    functions = trigger_functions(expression)
+    evaluations = sum(3600.0 / delays.get(key, PUSH_INTERVAL) for key in set(key for _, key, _, _ in functions))
+    if [function for _, _, function, _ in functions if function in CLOCK_FUNCTIONS]:
+        evaluations += 3600.0 / TIMER_INTERVAL
+    reads = sum(function_reads(function, params, delays.get(key, PUSH_INTERVAL))
+                for _, key, function, params in functions)
+    return evaluations, reads
+
+
+def optimize_expression(expression):
+    """The expression with its function references rewritten to cheaper equivalent ones.
+
+    last(#1) and last() are last(0), and so are min(#1), max(#1) and avg(#1).
+    Time windows are left alone: how many values one holds depends on when the
+    values arrive, not only on the update interval.
+    """
+    def rewrite(match):
+        host, key, function, params = match.groups()
+        params = [param.strip() for param in params.split(',')] if params.strip() else []
+        if function == 'last' and params in ([], ['#1']) or function in ('min', 'max', 'avg') and params == ['#1']:
+            function, params = 'last', ['0']
+        else:
+            return match.group(0)
+        return '{%s:%s.%s(%s)}' % (host, key, function, ','.join(params))
+    return TRIGGER_FUNCTION.sub(rewrite, expression)
+
+
+def dependent_template(tmpl, app_name, all_item_keys, keys):
+    """Turn the items of a template polled by the agent into dependent items of one master item.
+
+    The master item gets all the stats of the wrapper as JSON, keyed by the
+    magic vars, the graph items extract their value with JSONPath.  The
+    template is converted to the DEPENDENT_ZABBIX_VERSION export format, where
+    multiplier and delta are preprocessing steps.
+    """
+    master_key = format_item(app_name, MASTER_ITEM)
+    dependent_keys = dict((format_item(app_name, item), item) for item in all_item_keys)
+    items = tmpl['templates']['template']['items']['item']
+    for z_item in items:
+        steps = []
+        item = dependent_keys.get(z_item['key'])
+        if item:
+            z_item['type'] = item_types['Dependent item']
+            z_item['delay'] = 0
+            z_item['master_item'] = {'key': master_key}
+            steps.append({'type': preprocessing_types['JSONPath'], 'params': '$.%s' % keys[item]})
+        if z_item.pop('multiplier', 0):
+            steps.append({'type': preprocessing_types['Custom multiplier'], 'params': z_item['formula']})
+        if z_item.pop('delta', 0) == 1:  # Delta (speed per second)
+            steps.append({'type': preprocessing_types['Change per second'], 'params': ''})
+        z_item.pop('formula', None)
+        z_item.pop('data_type', None)
+        z_item['history'] = '%dd' % z_item['history']
+        z_item['trends'] = '%dd' % z_item['trends']
+        z_item['preprocessing'] = {'step': steps} if steps else ''
+
+    items.insert(0, {'name': '%s stats' % app_name,
+                     'type': item_types['Zabbix agent'],
+                     'key': master_key,
+                     'value_type': item_value_types['Text'],
+                     'delay': 300,  # Update interval (in sec)
+                     'history': '1h',
+                     'trends': '0',
+                     'applications': {'application': {'name': app_name}},
+                     'description': 'All the %s stats as JSON, the master item of the other ones' % app_name,
+                     'preprocessing': '',
+                     'status': 0})
+    tmpl['version'] = DEPENDENT_ZABBIX_VERSION
+    return tmpl
+
+
+def trapper_template(tmpl, app_name, all_item_keys):
+    """Turn the items of a template polled by the agent into trapper items, pushed all at once"""
+    trapper_keys = set(format_item(app_name, item) for item in all_item_keys)
+    for z_item in tmpl['templates']['template']['items']['item']:
+        if z_item['key'] in trapper_keys:
+            z_item['type'] = item_types['Zabbix Trapper']
+            z_item['delay'] = 0
+            z_item['allowed_hosts'] = ''
+    return tmpl
+
+
+def format_item(app_name, f_item):
+    """Underscore makes an agent to throw away the support for item
+    """
+    return '%s.%s' % (re.sub(r'[^0-9A-Za-z.-]', '', app_name), f_item.replace('_', '-'))
+
+
+def write_xml(tmpl, stream):
+    """Write the template as XML to the stream, UTF-8 encoded"""
+    out = codecs.getwriter('utf-8')(stream)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    dict2xml.Converter(wrap='zabbix_export', indent='  ').write(tmpl, out)
+    out.write('\n')
+
+
+def render_config(app_name, all_item_keys, keys, wrapper, extra_items, target='agent'):
+    """Write Zabbix agent config"""
+    lookup_key = format_item(app_name, LOOKUP_ITEM)
+    aliases = []
+    if target == 'dependent':
+        aliases.append((MASTER_ITEM, MASTER_ITEM))
+    elif target == 'agent':
+        aliases.extend((item, keys[item]) for item in sorted(all_item_keys))
+
+    # Write extra items
+    for item in extra_items:
+        if item.get('item'):
+            aliases.append((item['item'], item['item']))
+
+    lines = ["UserParameter=%s[*],%s/%s $1" % (lookup_key, ZABBIX_SCRIPT_PATH, wrapper)]
+    for item, param in aliases:
+        lines.append("Alias=%s:%s[%s]" % (format_item(app_name, item), lookup_key, param))
+    return ''.join('%s\n' % line for line in lines)
+
+
+def key_index(app_name, items, keys, script=None):
+    """Index of the magic vars of a script, by item name, short key and Zabbix key.
+
+    items are the names of the items of the template, a TemplateError lists
+    the ones the script has no short key for, and the items having the same
+    Zabbix key.  "items" maps an item to its short and Zabbix keys, "shorts"
+    a short key to its items and "keys" a Zabbix key to its item.
+    """
+    missing = sorted(set(items) - set(keys))
+    if missing:
+        raise TemplateError("No short key in %s for the items %s." % (script or 'the magic vars', ', '.join(missing)))
+    index = {'format': KEY_INDEX_FORMAT,
+             'app_name': app_name,
+             'script': script,
+             'template_items': sorted(items),
+             'items': {},
+             'shorts': {},
+             'keys': {}}
+    for item, short in sorted(keys.items()):
+        key = format_item(app_name, item)
+        if key in index['keys']:
+            raise TemplateError("Items %s and %s have the same key %s." % (index['keys'][key], item, key))
+        index['items'][item] = {'short': short, 'key': key}
+        index['shorts'].setdefault(short, []).append(item)
+        index['keys'][key] = item
+    return index
+
+
+def write_key_index(index, stream):
+    json.dump(index, stream, indent=1, sort_keys=True, separators=(',', ': '))
+    stream.write('\n')
+
+
+def discovery_command(cacti_input, kind, short):
+    """Agent command running a Cacti input for one item of the object given as first key parameter"""
+    cmd = cacti_input['input_string']
+    for var, value in (('<path_php_binary>', PHP_BINARY), ('<path_cacti>/scripts', ZABBIX_SCRIPT_PATH),
+                       ('<hostname>', 'localhost'), ('<items>', short), ('<%s>' % DISCOVERY[kind]['field'], '$1')):
+        cmd = cmd.replace(var, value)
+    # The script prints <item>:<value>
+    return '%s %s | cut -d: -f2' % (cmd.strip(), LOCAL_OPTIONS)
+
+
+def render_discovery_config(data, app_name, keys, skipped_graphs=()):
+    """Agent config of the discovery rules and item prototypes of a definition, empty if it has none"""
+    lines = []
+    seen = set()
+    for graph in data['graphs']:
+        kind, macro = graph_discovery(data, graph)
+        if not kind or graph['name'] in skipped_graphs:
+            continue
+        if not lines:
+            lines.append("UserParameter=%s[*],%s/%s $1" % (format_item(app_name, 'discovery'), ZABBIX_SCRIPT_PATH,
+                                                           DISCOVERY_COLLECTOR))
+        cacti_input = data['inputs'][graph['dt']['input']]
+        for item in sorted(graph['dt']):
+            if item not in ['hash', 'input'] and item not in seen:
+                seen.add(item)
+                lines.append("UserParameter=%s[*],%s" % (format_item(app_name, item),
+                                                         discovery_command(cacti_input, kind, keys[item])))
+    return ''.join('%s\n' % line for line in lines)
+
+
+class Template(object):
+
+    """Zabbix template of a Cacti definition, with its item keys and agent config.
+
+    The template is built for the agent target, retarget() turns it into the
+    dependent or trapper one.  keys are the magic vars of the script polling
+    the definition, wrapper the agent lookup script of it, if any.  skipped is
+    a list to skip the graphs not supported by Zabbix into, None to fail.
+    """
+
+    def __init__(self, data, triggers=(), extra_items=(), keys=None, wrapper=None, skipped=None, script=None):
+        self.data = data
+        self.script = script
+        self.extra_items = list(extra_items)
+        self.keys = keys
+        self.wrapper = wrapper
+        self.skipped = skipped
+        self.target = 'agent'
+        self.tmpl, self.app_name, self.item_keys = build_template(data, list(triggers), self.extra_items, skipped)
+
+    @classmethod
+    def from_definition(cls, path, skipped=None, root=''):
+        """Template of a definition file, with its triggers, extra items and magic vars.
+
+        The scripts and triggers are looked up in root, the top of the source tree.
+        """
+        base = os.path.splitext(os.path.basename(path))[0]
+        script = definition_script(path)
+        keys = load_magic_vars(os.path.join(root, SCRIPTS, script)) if script else None
+        return cls(load_definition(path), load_triggers(os.path.join(root, TRIGGERS, '%s.yml' % base)),
+                   EXTRA_ITEMS.get(base, []), keys, WRAPPERS.get(script), skipped, script)
+
+    @property
+    def name(self):
+        return self.tmpl['templates']['template']['name']
+
+    @property
+    def discovery_rules(self):
+        rules = self.tmpl['templates']['template'].get('discovery_rules')
+        return rules['discovery_rule'] if rules else []
+
+    def retarget(self, target):
+        """Poll the items the way of the target, once"""
+        if target not in TARGETS:
+            raise TemplateError('Unknown target %s.' % target)
+        if self.target != 'agent' and target != self.target:
+            raise TemplateError('The template is already built for the %s target.' % self.target)
+        if target == self.target:
+            return
+        if target == 'dependent':
+            if not self.wrapper:
+                raise TemplateError('%s has no agent wrapper for the master item.' % self.name)
+            self.key_index()
+            dependent_template(self.tmpl, self.app_name, self.item_keys, self.keys)
+        elif target == 'trapper':
+            self.key_index()
+            trapper_template(self.tmpl, self.app_name, self.item_keys)
+        self.target = target
+
+    def write_xml(self, stream):
+        write_xml(self.tmpl, stream)
+
+    def xml(self):
+        """The template as UTF-8 encoded XML"""
+        out = StringIO.StringIO()
+        self.write_xml(out)
+        return out.getvalue()
+
+    def only(self, objects):
+        """Keep the items, discovery rules, graphs and triggers given as (kind, identity) only"""
+        template = self.tmpl['templates']['template']
+        for container, tag, kind, field in ((template, 'items', 'item', 'key'),
+                                            (template, 'discovery_rules', 'discovery rule', 'key'),
+                                            (self.tmpl, 'graphs', 'graph', 'name'),
+                                            (self.tmpl, 'triggers', 'trigger', 'expression')):
+            if not container.get(tag):
+                continue
+            child_tag = tag[:-1]
+            kept = [obj for obj in container[tag][child_tag] if (kind, obj[field]) in objects]
+            container[tag] = {child_tag: kept} if kept else ''
+
+    def triggers(self):
+        """Triggers and trigger prototypes of the template"""
+        triggers = list(self.tmpl['triggers'] and self.tmpl['triggers']['trigger'])
+        for rule in self.discovery_rules:
+            triggers.extend(rule['trigger_prototypes'] and rule['trigger_prototypes']['trigger_prototype'])
+        return triggers
+
+    def trigger_costs(self):
+        """(trigger name, evaluations per hour, history values read per evaluation) of every trigger, per host"""
+        delays = item_delays(self.tmpl)
+        return [(trigger['name'],) + trigger_cost(trigger['expression'], delays) for trigger in self.triggers()]
+
+    def optimize_triggers(self):
+        """Rewrite the trigger expressions to cheaper equivalent ones, return the ones rewritten"""
+        rewritten = dict()
+        for trigger in self.triggers():
+            expression = optimize_expression(trigger['expression'])
+            if expression != trigger['expression']:
+                rewritten[trigger['expression']] = expression
+                trigger['expression'] = expression
+        # The dependencies refer to the triggers by expression
+        for trigger in self.triggers():
+            for dependency in trigger.get('dependencies') and trigger['dependencies']['dependency'] or []:
+                dependency['expression'] = rewritten.get(dependency['expression'], dependency['expression'])
+        return sorted(rewritten.items())
+
+    def polled_items(self):
+        """Names of the items and item prototypes polled with the magic vars of the script"""
+        items = set(self.item_keys)
+        skipped = [name for name, _ in self.skipped or []]
+        for graph in self.data['graphs']:
+            if graph_discovery(self.data, graph)[0] and graph['name'] not in skipped:
+                items.update(item for item in graph['dt'] if item not in ['hash', 'input'])
+        return items
+
+    def key_index(self):
+        """Index of the magic vars of the script, checked against the items of the template"""
+        if self.keys is None:
+            raise TemplateError('%s has no magic vars.' % self.name)
+        return key_index(self.app_name, self.polled_items(), self.keys, self.script)
+
+    def config(self):
+        """Agent config of the items polled by the agent, empty if there are none"""
+        config = ''
+        if self.wrapper or self.discovery_rules:
+            # Every key is there before any line is rendered
+            self.key_index()
+        if self.wrapper:
+            config = render_config(self.app_name, self.item_keys, self.keys, self.wrapper, self.extra_items,
+                                   self.target)
+        if self.discovery_rules:
+            config += render_discovery_config(self.data, self.app_name, self.keys,
+                                              [name for name, _ in self.skipped or []])
+        return config
+
+
+def export_objects(stream):
+    """Yield (kind, identity, object) of the objects of a Zabbix export compared by diff_export(), one at a time"""
+    kinds = dict((path, (kind, field)) for path, kind, field in EXPORT_OBJECTS)
+    try:
+        for path, value in xml2dict.iterparse(stream, kinds):
+            kind, field = kinds[path]
+            yield kind, value.get(field, '') if value else '', value
+    except SyntaxError as err:
+        raise TemplateError('Invalid Zabbix export: %s' % err)
+
+
+def flatten(value, prefix=''):
+    """Texts of an object read by xml2dict, by path"""
+    if isinstance(value, dict):
+        fields = dict()
+        for tag, child in value.iteritems():
+            fields.update(flatten(child, '%s/%s' % (prefix, tag) if prefix else tag))
+        return fields
+    elif isinstance(value, list):
+        fields = dict()
+        for num, child in enumerate(value):
+            fields.update(flatten(child, '%s[%d]' % (prefix, num)))
+        return fields
+    return {prefix: value}
+
+
+def digest(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()
+
+
+def diff_export(path, tmpl, details=False):
+    """Keyed diff of a Zabbix export file and a Template.
+
+    The objects are items and discovery rules by key, graphs by name and
+    triggers by expression.  Returns the sorted list of the differences as
+    (change, kind, identity, fields), change being '+' for an object of the
+    template only, '-' for one of the export only and '~' for a changed one.
+    fields are the changed fields of a changed object as (field, export value,
+    template value), with details only, which reads the export twice.  Only
+    the digests of the exported objects are kept in memory otherwise.
+    """
+    new = dict()
+    for kind, ident, value in export_objects(StringIO.StringIO(tmpl.xml())):
+        new[(kind, ident)] = value
+    old = dict()
+    fh = open(path, 'rb')
+    try:
+        for kind, ident, value in export_objects(fh):
+            old[(kind, ident)] = digest(value)
+    finally:
+        fh.close()
+
+    changed = set(obj for obj in old if obj in new and old[obj] != digest(new[obj]))
+    fields = dict()
+    if details and changed:
+        fh = open(path, 'rb')
+        try:
+            for kind, ident, value in export_objects(fh):
+                if (kind, ident) in changed:
+                    old_fields = flatten(value)
+                    new_fields = flatten(new[(kind, ident)])
+                    fields[(kind, ident)] = [(field, old_fields.get(field), new_fields.get(field))
+                                             for field in sorted(set(old_fields) | set(new_fields))
+                                             if old_fields.get(field) != new_fields.get(field)]
+        finally:
+            fh.close()
+
+    diff = [('+', kind, ident, []) for kind, ident in new if (kind, ident) not in old]
+    diff.extend(('-', kind, ident, []) for kind, ident in old if (kind, ident) not in new)
+    diff.extend(('~', kind, ident, fields.get((kind, ident), [])) for kind, ident in changed)
+    return sorted(diff, key=lambda change: (change[1], change[2], change[0]))
+
+
+# Parsed triggers and magic vars, set in every worker process
+shared = None
+
+
+def init_worker(data, cache_dir):
+    global shared, cache
+    shared = data
+    cache = perlhash.Cache(cache_dir) if cache_dir else None
+
+
+def convert(path, outdir, target='agent', optimize=False):
+    """Write the template and agent config of a definition to outdir.
+
+    With the dependent and trapper targets, only the definitions polled by a
+    script having a wrapper, respectively a pusher, get dependent or trapper items.
+    With optimize, the trigger expressions are rewritten to cheaper ones.
+
+    Returns (definition, seconds, number of graphs, number of items, note).
+    """
+    start = time.time()
+    base = os.path.splitext(os.path.basename(path))[0]
+    try:
+        script = shared['scripts'][base]
+        skipped = []
+        tmpl = Template(load_definition(path), shared['triggers'][base], EXTRA_ITEMS.get(base, []),
+                        shared['keys'].get(script), WRAPPERS.get(script), skipped, script)
+        if target == 'dependent' and script in WRAPPERS or target == 'trapper' and script in PUSHERS:
+            tmpl.retarget(target)
+        if optimize:
+            tmpl.optimize_triggers()
+        fh = open(os.path.join(outdir, 'zabbix_agent_template_percona_%s.xml' % base), 'w')
+        tmpl.write_xml(fh)
+        fh.close()
+
+        config = tmpl.config()
+        notes = []
+        if script not in WRAPPERS and tmpl.item_keys:
+            notes.append('%s, %s has no wrapper' % ('agent config of the discovered objects only' if config
+                                                    else 'no agent config', script))
+        if config:
+            fh = open(os.path.join(outdir, 'userparameter_percona_%s.conf' % base), 'w')
+            fh.write(config)
+            fh.close()
+        if script in WRAPPERS or script in PUSHERS:
+            fh = open(os.path.join(outdir, KEY_INDEX % base), 'w')
+            write_key_index(tmpl.key_index(), fh)
+            fh.close()
+        if skipped:
+            notes.append('skipped graphs: %s' % '; '.join('%s (%s)' % graph for graph in skipped))
+        note = ', '.join(notes)
+    except (TemplateError, KeyError, IOError, yaml.YAMLError) as err:
+        return base, time.time() - start, 0, 0, 'ERROR: %s' % err
+
+    return base, time.time() - start, len(tmpl.data['graphs']) - len(skipped), len(tmpl.item_keys), note
+
+
+def convert_all(names, outdir, jobs, target='agent', optimize=False):
+    """Convert the definitions named, or all of them, across a process pool.
+
+    Returns the convert() results, sorted by definition.
+    """
+    paths = sorted(glob.glob(os.path.join(DEFINITIONS, '*.def')))
+    if names:
+        wanted = set(os.path.splitext(os.path.basename(name))[0] for name in names)
+        unknown = wanted - set(os.path.splitext(os.path.basename(path))[0] for path in paths)
+        if unknown:
+            raise TemplateError("No definition %s in %s." % (', '.join(sorted(unknown)), DEFINITIONS))
+        paths = [path for path in paths if os.path.splitext(os.path.basename(path))[0] in wanted]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    data = load_shared(paths)
+    # The biggest definitions first, so they do not finish last
+    paths.sort(key=lambda path: -os.path.getsize(path))
+    pool = multiprocessing.Pool(min(jobs, len(paths)) or 1, init_worker, (data, cache and cache.directory))
+    results = pool.map(_convert, [(path, outdir, target, optimize) for path in paths], chunksize=1)
+    pool.close()
+    pool.join()
+    return sorted(results)
+
+
+def _convert(args):
+    return convert(*args)
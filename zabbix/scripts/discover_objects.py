@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Zabbix agent low-level discovery of the disks, network interfaces and volumes.
+
+It prints the objects of a kind in the LLD JSON format, the discovery rules of
+the Percona GNU/Linux Zabbix template create the items, triggers and graphs of
+every object from their prototypes.
+
+  discover_objects.py diskstats     Block devices of /proc/diskstats, {#DEVICE}
+  discover_objects.py netdev        Network interfaces of /proc/net/dev, {#DEVICE}
+  discover_objects.py df            Mounted volumes of df, {#VOLUME}
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+Copyright: $CURRENT_YEAR$ Percona
+
+$version = '$VERSION$';
+"""
+
+import json
+import optparse
+import re
+import subprocess
+import sys
+
+# Devices without I/O worth graphing
+SKIP_DEVICES = re.compile(r'^(loop|ram|fd|sr)\d*$')
+SKIP_INTERFACES = ['lo']
+
+options = None
+
+
+def debug(val):
+    """Debugging output"""
+    if options and options.debug:
+        sys.stderr.write('DEBUG: %s\n' % val)
+
+
+def parse_diskstats(text):
+    """Block devices of /proc/diskstats which did any I/O"""
+    devices = []
+    for line in text.splitlines():
+        words = line.split()
+        if len(words) < 14 or SKIP_DEVICES.match(words[2]):
+            continue
+        # Reads and writes completed
+        if words[3] == '0' and words[7] == '0':
+            debug('%s is idle' % words[2])
+            continue
+        devices.append(words[2])
+    return devices
+
+
+def parse_netdev(text):
+    """Network interfaces of /proc/net/dev"""
+    devices = []
+    for line in text.splitlines():
+        name, sep, _ = line.partition(':')
+        name = name.strip()
+        if sep and '|' not in name and name not in SKIP_INTERFACES:
+            devices.append(name)
+    return devices
+
+
+def parse_df(text):
+    """Volumes of df -k -P, the ones of a block device, once"""
+    volumes = []
+    for line in text.splitlines()[1:]:
+        words = line.split()
+        if len(words) >= 6 and words[0].startswith('/') and words[0] not in volumes:
+            volumes.append(words[0])
+    return volumes
+
+
+# Kind: (command or file, parser, LLD macro)
+SOURCES = {'diskstats': ('/proc/diskstats', parse_diskstats, '{#DEVICE}'),
+           'netdev': ('/proc/net/dev', parse_netdev, '{#DEVICE}'),
+           'df': (['df', '-k', '-P'], parse_df, '{#VOLUME}')}
+
+
+def discover(kind):
+    """LLD data of the objects of a kind"""
+    source, parse, macro = SOURCES[kind]
+    debug(source)
+    if isinstance(source, list):
+        text = subprocess.Popen(source, stdout=subprocess.PIPE).communicate()[0]
+    else:
+        text = open(source).read()
+    return {'data': [{macro: name} for name in parse(text)]}
+
+
+def get_parser():
+    parser = optparse.OptionParser(usage='%%prog [options] %s' % '|'.join(sorted(SOURCES)))
+    parser.add_option('-d', '--debug', action='store_true', default=False, help='enable debugging')
+    return parser
+
+
+def main():
+    """Main function"""
+    global options
+
+    parser = get_parser()
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in SOURCES:
+        parser.error('one of %s is required.' % ', '.join(sorted(SOURCES)))
+
+    try:
+        print json.dumps(discover(args[0]), sort_keys=True)
+    except (IOError, OSError) as err:
+        print 'ERROR: %s' % err
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
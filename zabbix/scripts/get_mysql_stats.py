@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Zabbix agent lookup of the MySQL stats collected by the Cacti PHP script.
+
+It runs the script every 5 minutes and answers the item lookups from its cache
+file in the meantime.  The cache file is parsed once into an index stored
+beside it, keyed by the mtime of the cache, so a lookup is one stat and one
+dict access.  When the cache gets stale, a single agent process refreshes it
+under a lock, the other ones wait for it and use the new cache.
+
+  get_mysql_stats.py gg             Value of the magic var gg
+  get_mysql_stats.py json           All the values as JSON
+  get_mysql_stats.py running-slave  1 if both slave threads are running, else 0
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+Copyright: $CURRENT_YEAR$ Percona
+
+$version = '$VERSION$';
+"""
+
+import errno
+import fcntl
+import json
+import marshal
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, 'ss_get_mysql_stats.php')
+# Same as $cache_dir of ss_get_mysql_stats.php
+CACHE_DIR = '/tmp'
+# Age in seconds of the cache that gets refreshed
+MAX_AGE = 300
+# Bump when the index content changes
+INDEX_FORMAT = 1
+
+options = None
+
+
+class StatsError(Exception):
+
+    """Stats not available, printed instead of the value"""
+
+    pass
+
+
+def debug(val):
+    """Debugging output"""
+    if options and options.debug:
+        sys.stderr.write('DEBUG: %s\n' % val)
+
+
+class StatsCache(object):
+
+    """Cache file of the Cacti script and its index"""
+
+    def __init__(self, host='localhost', cache_dir=CACHE_DIR, php='/usr/bin/php', script=SCRIPT, max_age=MAX_AGE):
+        self.host = host
+        self.path = os.path.join(cache_dir, '%s-mysql_cacti_stats.txt' % host.replace(':', '').replace('/', '_'))
+        self.index_path = self.path + '.index'
+        self.lock_path = self.path + '.lock'
+        self.command = [php, '-q', script, '--host', host, '--items', 'gg']
+        self.max_age = max_age
+
+    def mtime(self):
+        """mtime of the cache file, None if there is none"""
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def fresh(self, mtime):
+        return mtime is not None and time.time() - mtime <= self.max_age
+
+    def refresh(self):
+        """Run the script unless another process just did it, one at a time"""
+        lock = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            mtime = self.mtime()
+            if self.fresh(mtime):
+                debug('refreshed by another process')
+                return mtime
+            # The script reuses a cache younger than half its poll time
+            try:
+                os.unlink(self.path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            debug(' '.join(self.command))
+            devnull = open(os.devnull, 'w')
+            try:
+                subprocess.call(self.command, stdout=devnull, stderr=devnull)
+            except OSError as err:
+                debug(err)
+            devnull.close()
+            return self.mtime()
+        finally:
+            lock.close()
+
+    def parse(self):
+        """Values of the cache file by magic var, -1 (missing) as 0"""
+        fh = open(self.path, 'r')
+        try:
+            # Shared lock, the script writes the file under an exclusive one
+            fcntl.flock(fh, fcntl.LOCK_SH)
+            text = fh.read()
+        finally:
+            fh.close()
+        values = dict()
+        for field in text.split():
+            short, sep, value = field.partition(':')
+            if sep:
+                values[short] = '0' if value == '-1' else value
+        return values
+
+    def values(self):
+        """All the values, from the index if it is up to date, else parsed and indexed"""
+        mtime = self.mtime()
+        if not self.fresh(mtime):
+            mtime = self.refresh()
+        if mtime is None:
+            raise StatsError('ERROR: run the command manually to investigate the problem: %s'
+                             % ' '.join(self.command))
+        try:
+            fh = open(self.index_path, 'rb')
+            try:
+                index = marshal.load(fh)
+            finally:
+                fh.close()
+            if index[0] == INDEX_FORMAT and index[1] == mtime:
+                return index[2]
+        except (IOError, EOFError, ValueError, TypeError, IndexError):
+            pass
+
+        debug('indexing %s' % self.path)
+        values = self.parse()
+        if values:
+            # Written aside and renamed, the readers never see half an index
+            tmp = '%s.%d' % (self.index_path, os.getpid())
+            try:
+                fh = open(tmp, 'wb')
+                marshal.dump((INDEX_FORMAT, mtime, values), fh)
+                fh.close()
+                os.rename(tmp, self.index_path)
+            except (IOError, OSError) as err:
+                debug(err)
+        return values
+
+    def get(self, item):
+        """Value of one magic var"""
+        values = self.values()
+        try:
+            return values[item]
+        except KeyError:
+            if not values:
+                raise StatsError('ERROR: no stats in %s' % self.path)
+            raise StatsError('ERROR: unknown item %s' % item)
+
+
+def running_slave():
+    """1 if both replication threads are running, else 0"""
+    env = dict(os.environ, HOME=os.path.expanduser('~zabbix'))
+    try:
+        proc = subprocess.Popen(['mysql', '-e', 'SHOW SLAVE STATUS\\G'], stdout=subprocess.PIPE, env=env)
+    except OSError:
+        return 0
+    running = [line.split(':', 1)[1].strip() for line in proc.communicate()[0].splitlines()
+               if line.strip().startswith(('Slave_IO_Running:', 'Slave_SQL_Running:'))]
+    return int(running == ['Yes', 'Yes'])
+
+
+def get_parser():
+    parser = optparse.OptionParser(usage='%prog [options] ITEM')
+    parser.add_option('-H', '--host', default='localhost', help='MySQL host [default: %default]')
+    parser.add_option('--cache-dir', dest='cache_dir', default=CACHE_DIR,
+                      help='directory of the cache of the script [default: %default]')
+    parser.add_option('--max-age', dest='max_age', type='int', default=MAX_AGE,
+                      help='seconds after which the stats are collected again [default: %default]')
+    parser.add_option('--script', default=SCRIPT, help='Cacti script collecting the stats [default: %default]')
+    parser.add_option('--php', default='/usr/bin/php', help='PHP binary [default: %default]')
+    parser.add_option('-d', '--debug', action='store_true', default=False, help='enable debugging')
+    return parser
+
+
+def main():
+    """Main function"""
+    global options
+
+    parser = get_parser()
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('one item is required.')
+    item = args[0]
+
+    if item == 'running-slave':
+        print running_slave()
+        return
+
+    cache = StatsCache(options.host, options.cache_dir, options.php, options.script, options.max_age)
+    try:
+        if item == 'json':
+            print json.dumps(cache.values(), sort_keys=True, separators=(',', ':'))
+        else:
+            print cache.get(item)
+    except StatsError as err:
+        print err
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
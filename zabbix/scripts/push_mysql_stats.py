@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Push all the MySQL stats to the trapper items of the Percona MySQL Zabbix template.
+
+It runs ss_get_mysql_stats.php once, translates its short keys to the item
+keys with the key index written by pmp-zabbix-template.py, or the $keys map of
+the script if there is no index, and sends all the values to the Zabbix server
+or proxy in a single sender protocol request.  Run it every 5 minutes,
+e.g. from /etc/cron.d:
+
+  */5 * * * * zabbix /var/lib/zabbix/percona/scripts/push_mysql_stats.py
+
+This program is part of $PROJECT_NAME$
+License: GPL License (see COPYING)
+Copyright: $CURRENT_YEAR$ Percona
+
+$version = '$VERSION$';
+"""
+
+import json
+import optparse
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# perlhash.py is installed next to this script, it is in zabbix/bin in the source tree
+sys.path.append(os.path.join(HERE, '..', 'bin'))
+
+import perlhash
+
+AGENT_CONFIG = '/etc/zabbix/zabbix_agentd.conf'
+SCRIPT = os.path.join(HERE, 'ss_get_mysql_stats.php')
+KEY_INDEX = os.path.join(HERE, 'percona_mysql_keys.json')
+KEY_INDEX_FORMAT = 1
+APP_NAME = 'MySQL'
+TRAPPER_PORT = 10051
+
+# Sender protocol header: signature and version, followed by the data length
+HEADER = 'ZBXD\x01'
+LENGTH = struct.Struct('<Q')
+
+
+class SenderError(Exception):
+
+    """Failure to collect or to push the stats"""
+
+    pass
+
+
+def debug(val):
+    """Debugging output"""
+    global options
+    if options.debug:
+        print 'DEBUG: %s' % val
+
+
+def item_key(app_name, item):
+    """Item key of a magic var, the same as format_item() of pmp-zabbix-template.py"""
+    return '%s.%s' % (re.sub(r'[^0-9A-Za-z.-]', '', app_name), item.replace('_', '-'))
+
+
+def load_keys(index_path, script, app_name):
+    """Short keys by item key, from the key index if there is one, else from the magic vars of the script"""
+    try:
+        fh = open(index_path)
+    except IOError:
+        debug('no key index %s, parsing %s' % (index_path, script))
+        return dict((item_key(app_name, item), short) for item, short in perlhash.load_array(script).items())
+    try:
+        index = json.load(fh)
+    except ValueError as err:
+        raise SenderError('invalid key index %s: %s' % (index_path, err))
+    finally:
+        fh.close()
+    if index.get('format') != KEY_INDEX_FORMAT:
+        raise SenderError('key index %s has format %s, %s expected' % (index_path, index.get('format'),
+                                                                         KEY_INDEX_FORMAT))
+    return dict((item['key'], item['short']) for item in index['items'].values())
+
+
+def agent_config(path):
+    """Hostname, Server and ServerActive of the agent config, the ones set"""
+    values = dict()
+    try:
+        lines = open(path).readlines()
+    except IOError:
+        return values
+    for line in lines:
+        match = re.match(r'\s*(Hostname|Server|ServerActive)\s*=\s*(.*?)\s*$', line)
+        if match:
+            values[match.group(1)] = match.group(2)
+    return values
+
+
+def server_address(value, port=TRAPPER_PORT):
+    """(host, port) of the first server of a Server or ServerActive setting"""
+    server = value.split(',')[0].strip()
+    match = re.match(r'^\[(.*)\](?::(\d+))?$', server) or re.match(r'^([^:]*)(?::(\d+))?$', server)
+    if match:
+        return match.group(1), int(match.group(2) or port)
+    # IPv6 address without a port
+    return server, port
+
+
+def collect(php, script, host, items):
+    """Run the Cacti script once, return the values by short key, -1 (missing) as 0 like the agent wrapper"""
+    cmd = [php, '-q', script, '--host', host, '--items', ','.join(items)]
+    debug(' '.join(cmd))
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as err:
+        raise SenderError('cannot run %s: %s' % (php, err))
+    out, err = proc.communicate()
+    values = dict()
+    for field in out.split():
+        short, sep, value = field.partition(':')
+        if sep:
+            values[short] = '0' if value == '-1' else value
+    if proc.returncode or not values:
+        raise SenderError('no stats, run the command manually to investigate the problem: %s\n%s'
+                          % (' '.join(cmd), (err or out).strip()))
+    return values
+
+
+def sender_data(zabbix_host, keys, values, clock):
+    """Items of a sender request, for the item keys having a value"""
+    return [{'host': zabbix_host, 'key': key, 'value': values[short], 'clock': clock}
+            for key, short in sorted(keys.items()) if short in values]
+
+
+def recv(sock, size):
+    """Read exactly size bytes"""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise SenderError('connection closed by the Zabbix server')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def send(server, port, data, timeout=10):
+    """Send all the items in one sender request, return the info of the server response"""
+    payload = json.dumps({'request': 'sender data', 'data': data, 'clock': int(time.time())})
+    try:
+        sock = socket.create_connection((server, port), timeout)
+        try:
+            sock.sendall(HEADER + LENGTH.pack(len(payload)) + payload)
+            header = recv(sock, len(HEADER))
+            if header != HEADER:
+                raise SenderError('invalid response from the Zabbix server: %r' % header)
+            body = recv(sock, LENGTH.unpack(recv(sock, LENGTH.size))[0])
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout) as err:
+        raise SenderError('cannot send to %s:%s: %s' % (server, port, err))
+    try:
+        response = json.loads(body)
+    except ValueError:
+        raise SenderError('invalid response from the Zabbix server: %r' % body[:200])
+    debug(response)
+    if response.get('response') != 'success':
+        raise SenderError('Zabbix server response: %s' % response.get('info', body))
+    return response.get('info', '')
+
+
+def get_parser():
+    parser = optparse.OptionParser()
+    parser.add_option('-H', '--host', default='localhost', help='MySQL host [default: %default]')
+    parser.add_option('-c', '--config', default=AGENT_CONFIG,
+                      help='agent config to read the Hostname and the server from [default: %default]')
+    parser.add_option('-s', '--zabbix-host', dest='zabbix_host',
+                      help='host name in Zabbix [default: Hostname of the agent config, else the system one]')
+    parser.add_option('-z', '--zabbix-server', dest='zabbix_server',
+                      help='Zabbix server or proxy, host[:port] [default: the first ServerActive or Server '
+                           'of the agent config]')
+    parser.add_option('-p', '--port', type='int', help='trapper port [default: %d]' % TRAPPER_PORT)
+    parser.add_option('--script', default=SCRIPT, help='Cacti script collecting the stats [default: %default]')
+    parser.add_option('--php', default='/usr/bin/php', help='PHP binary [default: %default]')
+    parser.add_option('--key-index', dest='key_index', default=KEY_INDEX,
+                      help='key index of pmp-zabbix-template.py, the magic vars of the script are parsed '
+                           'if there is none [default: %default]')
+    parser.add_option('--app-name', dest='app_name', default=APP_NAME,
+                      help='application name, prefix of the item keys without key index [default: %default]')
+    parser.add_option('-t', '--timeout', type='float', default=10, help='network timeout [default: %default]')
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+                      help='print the items in the zabbix_sender input format instead of sending them')
+    parser.add_option('-d', '--debug', action='store_true', default=False, help='enable debugging')
+    return parser
+
+
+def main():
+    """Main function"""
+    global options
+
+    parser = get_parser()
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+
+    config = agent_config(options.config)
+    zabbix_host = options.zabbix_host or config.get('Hostname') or socket.gethostname()
+    server = options.zabbix_server or config.get('ServerActive') or config.get('Server')
+    if not server and not options.dry_run:
+        parser.error('no Zabbix server, set it with --zabbix-server.')
+
+    try:
+        keys = load_keys(options.key_index, options.script, options.app_name)
+        values = collect(options.php, options.script, options.host, sorted(set(keys.values())))
+        data = sender_data(zabbix_host, keys, values, int(time.time()))
+        if options.dry_run:
+            for item in data:
+                print '"%s" %s %d %s' % (item['host'], item['key'], item['clock'], item['value'])
+            return
+        host, port = server_address(server)
+        print send(host, options.port or port, data, options.timeout)
+    except (SenderError, perlhash.ParseError, IOError) as err:
+        sys.stderr.write('ERROR: %s\n' % err)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()